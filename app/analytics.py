@@ -1,18 +1,21 @@
 from typing import Optional
 
+from uuid import uuid4
+
 import posthog
 from django.conf import settings
+from django.utils import timezone
 
 from app.apps import basic_posthog_event_properties
-from app.models import User
+from app.models import OutboxEvent, User
 from app.utils.mailchimp import track_event_for_user_in_mailchimp
 
 
-def identify_user(user):
+def identify_user(user, data=None):
     if user is None:
         return
 
-    data = user.get_analytics_data()
+    data = data or user.get_analytics_data()
     posthog.identify(user.id, data["set"])
 
     if user.primary_email is not None:
@@ -23,12 +26,40 @@ def identify_user(user):
 
 
 def capture_posthog_event(user: User, event: str, properties=dict()):
-    identify_user(user)
-    data = basic_posthog_event_properties
-    if hasattr(user, "get_analytics_data"):
-        data.update(user.get_analytics_data().get("register", {}))
-    data.update(properties)
-    posthog.capture(user.id, event=event, properties=data)
+    """
+    Queue an event for the outbox worker (`process_outbox`) to send.
+    """
+    if not settings.POSTHOG_PUBLIC_TOKEN:
+        return
+    OutboxEvent.enqueue(
+        OutboxEvent.POSTHOG_CAPTURE,
+        user,
+        event=event,
+        properties=properties,
+        # Lets PostHog deduplicate the event if a retry re-sends it
+        uuid=str(uuid4()),
+    )
+
+
+def send_posthog_events(user: User, events):
+    """
+    Identify the user once, then send all their queued events.
+    """
+    data = user.get_analytics_data()
+    identify_user(user, data)
+    for event in events:
+        posthog.capture(
+            user.id,
+            event=event.payload["event"],
+            properties={
+                **basic_posthog_event_properties,
+                **data.get("register", {}),
+                **event.payload.get("properties", {}),
+            },
+            timestamp=event.created_at,
+            uuid=event.payload.get("uuid", None),
+        )
+        event.sent_at = timezone.now()
 
 
 def signup(user):
@@ -15,15 +15,29 @@ class LeftBookClub(AppConfig):
         from . import signals
 
         self.configure_posthog()
+        self.configure_stripe()
         self.configure_shopify()
 
         from .slippers_autoload_components import register
 
         register()
 
-    def configure_shopify(self):
+    def configure_stripe(self):
+        from stripe.http_client import RequestsClient
+
+        from app.utils.http import get_session
+
         stripe.api_key = djstripe.settings.djstripe_settings.STRIPE_SECRET_KEY
         stripe.api_version = "2020-08-27"
+        # Stripe retries failed requests itself, so don't retry them twice
+        stripe.default_http_client = RequestsClient(
+            session=get_session("stripe", retries=0)
+        )
+
+    def configure_shopify(self):
+        from app.utils.shopify import use_pooled_shopify_connection
+
+        use_pooled_shopify_connection()
         shopify.Session(
             settings.SHOPIFY_DOMAIN, "2021-10", settings.SHOPIFY_PRIVATE_APP_PASSWORD
         )
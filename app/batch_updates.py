@@ -0,0 +1,174 @@
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django_dbq.models import Job
+from django_dbq.tasks import get_next_task_name
+from sentry_sdk import capture_exception
+
+from app.models import SubscriptionUpdateBatch
+
+# Batch subscription updates get their own queue and workers, so a large
+# batch doesn't hold up other jobs, or wait behind them
+BATCH_UPDATE_QUEUE = "subscriptions"
+BATCH_UPDATE_JOB = "update_subscription"
+BATCH_UPDATE_WORKERS = 4
+# Seconds a worker waits when the queue is empty
+BATCH_UPDATE_POLL_INTERVAL = 2
+# A job still processing after this long is taken to belong to a worker that
+# was killed, and is claimed again
+BATCH_UPDATE_JOB_LEASE = timedelta(minutes=15)
+
+
+def queue_batch_update_jobs(batch_id, subscription_ids, **options):
+    """
+    Queue one `update_subscription` job per subscription, in a single insert,
+    and start the batch's running totals.
+    """
+    batch, _ = SubscriptionUpdateBatch.objects.get_or_create(
+        id=batch_id, defaults={"options": options}
+    )
+    SubscriptionUpdateBatch.objects.filter(id=batch.id).update(
+        total=F("total") + len(subscription_ids)
+    )
+
+    next_task = get_next_task_name(BATCH_UPDATE_JOB)
+    jobs = [
+        Job(
+            name=BATCH_UPDATE_JOB,
+            queue_name=BATCH_UPDATE_QUEUE,
+            next_task=next_task,
+            workspace={
+                "batch_id": batch_id,
+                "subscription_id": subscription_id,
+                **options,
+            },
+        )
+        for subscription_id in subscription_ids
+    ]
+    return Job.objects.bulk_create(jobs, batch_size=1000)
+
+
+def claim_job(queue_name=BATCH_UPDATE_QUEUE):
+    # Unlike django_dbq's worker, skip jobs another worker has locked
+    # rather than waiting for them, so workers don't queue up behind each other
+    with transaction.atomic():
+        job = (
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(queue_name=queue_name),
+                (
+                    Q(state__in=(Job.STATES.READY, Job.STATES.NEW))
+                    & (Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()))
+                )
+                | Q(
+                    state=Job.STATES.PROCESSING,
+                    modified__lt=timezone.now() - BATCH_UPDATE_JOB_LEASE,
+                ),
+            )
+            .order_by("-priority", "created")
+            .first()
+        )
+        if job is None:
+            return None
+        job.state = Job.STATES.PROCESSING
+        job.save(update_fields=["state", "modified"])
+
+    batch_id = (job.workspace or {}).get("batch_id", None)
+    if batch_id is not None:
+        SubscriptionUpdateBatch.objects.filter(id=batch_id, started_at=None).update(
+            started_at=timezone.now()
+        )
+    return job
+
+
+def run_job(job):
+    """
+    Run a claimed job's tasks the way django_dbq's worker does.
+    """
+    try:
+        task_function = import_string(job.next_task)
+        task_function(job)
+        job.update_next_task()
+        job.state = Job.STATES.COMPLETE if not job.next_task else Job.STATES.READY
+    except Exception as e:
+        capture_exception(e)
+        job.state = Job.STATES.FAILED
+    job.save()
+
+    batch_id = (job.workspace or {}).get("batch_id", None)
+    if batch_id is not None and job.state != Job.STATES.READY:
+        SubscriptionUpdateBatch.record_result(
+            batch_id,
+            complete=job.state == Job.STATES.COMPLETE,
+            error=job.workspace.get("error", None),
+        )
+
+
+def work(queue_name=BATCH_UPDATE_QUEUE):
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+    print(f"Starting batch worker for queue {queue_name}")
+    while True:
+        close_old_connections()
+        try:
+            job = claim_job(queue_name)
+        except Exception as e:
+            print(f"Failed to claim job: {e}")
+            job = None
+        if job is None:
+            time.sleep(BATCH_UPDATE_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+
+def start_batch_workers(processes=BATCH_UPDATE_WORKERS, queue_name=BATCH_UPDATE_QUEUE):
+    """
+    Fork worker processes for a queue. They stop when this process exits.
+    """
+    connections.close_all()
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=work, args=(queue_name,), daemon=True)
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def batch_progress(batch):
+    """
+    Counts by state, throughput and ETA for a batch, from its running totals.
+    """
+    processing = Job.objects.filter(
+        workspace__batch_id=str(batch.id), state=Job.STATES.PROCESSING
+    ).count()
+
+    per_minute = 0
+    if batch.started_at is not None and batch.finished:
+        minutes = (timezone.now() - batch.started_at).total_seconds() / 60
+        per_minute = batch.finished / max(minutes, 1 / 60)
+
+    return {
+        "total": batch.total,
+        "finished": batch.finished,
+        "remaining": batch.remaining,
+        "percent": round(batch.finished / batch.total * 100) if batch.total else 0,
+        "started_at": batch.started_at,
+        "states": {
+            "waiting": max(0, batch.remaining - processing),
+            "processing": processing,
+            "complete": batch.complete,
+            "failed": batch.failed,
+        },
+        "per_minute": round(per_minute, 1),
+        "eta_minutes": round(batch.remaining / per_minute)
+        if batch.remaining and per_minute
+        else None,
+        "errors": sorted(batch.errors.items(), key=lambda error: -error[1]),
+    }
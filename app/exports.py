@@ -0,0 +1,92 @@
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
+from django_dbq.models import Job
+
+from app.models import LBCSubscription, resolve_subscription_properties
+
+MEMBER_EXPORT_JOB = "export_members"
+# Rows fetched from the database cursor, and resolved, at a time
+MEMBER_EXPORT_CHUNK_SIZE = 500
+MEMBER_EXPORT_DIRECTORY = "exports"
+
+
+def iter_resolved_subscriptions(queryset, chunk_size=MEMBER_EXPORT_CHUNK_SIZE):
+    """
+    Iterate a subscription queryset over a server-side cursor, resolving the
+    admin's derived properties a chunk at a time, so a large export never
+    holds more than one chunk in memory.
+    """
+    chunk = []
+    for subscription in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(subscription)
+        if len(chunk) >= chunk_size:
+            yield from resolve_subscription_properties(chunk)
+            chunk = []
+    if chunk:
+        yield from resolve_subscription_properties(chunk)
+
+
+def member_export_storage():
+    # Exports hold members' addresses, so they can be kept apart from
+    # the public media storage
+    storage_class = getattr(settings, "MEMBER_EXPORT_STORAGE", None)
+    if storage_class is None:
+        return default_storage
+    return import_string(storage_class)()
+
+
+def member_export_view():
+    """
+    The members admin's index view, to write an export outside of a request.
+    """
+    from app.wagtail_hooks import CustomerAdmin
+
+    model_admin = CustomerAdmin()
+    view = model_admin.index_view_class(model_admin)
+    view.list_export = model_admin.get_list_export(None)
+    return view
+
+
+def queue_member_export(queryset, filename):
+    """
+    Queue a job to write the subscriptions in `queryset` to a CSV file.
+    """
+    return Job.objects.create(
+        name=MEMBER_EXPORT_JOB,
+        workspace={
+            "filename": filename,
+            # Fix the rows now, so the export matches the filters it was asked for
+            "subscription_ids": list(queryset.values_list("pk", flat=True)),
+        },
+    )
+
+
+def write_member_export(subscription_ids, output):
+    view = member_export_view()
+    subscriptions = (
+        LBCSubscription.objects.filter(pk__in=subscription_ids)
+        .select_related("plan__product", "customer__subscriber")
+        .order_by("pk")
+    )
+    count = 0
+    for line in view.stream_csv(iter_resolved_subscriptions(subscriptions)):
+        output.write(line.encode("utf-8"))
+        count += 1
+    # Less the heading
+    return count - 1
+
+
+def run_member_export(job):
+    workspace = job.workspace
+    with tempfile.TemporaryFile() as output:
+        rows = write_member_export(workspace["subscription_ids"], output)
+        output.seek(0)
+        path = member_export_storage().save(
+            f"{MEMBER_EXPORT_DIRECTORY}/{workspace['filename']}-{job.id}.csv",
+            File(output),
+        )
+    job.workspace = {**workspace, "path": path, "rows": rows}
@@ -23,6 +23,7 @@ from app.models import ReadingGroup
 from app import analytics
 from app.models import MembershipPlanPage, User
 from app.utils.stripe import (
+    get_promotion_code,
     gift_giver_subscription_from_code,
     is_real_gift_code,
     is_redeemable_gift_code,
@@ -71,10 +72,10 @@ class GiftCodeForm(forms.Form):
     def clean(self) -> Optional[Dict[str, Any]]:
         cleaned_data = super().clean()
         code = cleaned_data.get("code")
-        possible_codes = stripe.PromotionCode.list(code=code).data
-        if code is None or len(possible_codes) == 0:
+        promo_code = get_promotion_code(code)
+        if code is None or promo_code is None:
             raise ValidationError("This isn't a real code")
-        if not possible_codes[0].metadata.get("gift_giver_subscription", False):
+        if not promo_code.metadata.get("gift_giver_subscription", False):
             raise ValidationError(
                 "This is a normal promo code, not a gift card code. To use this code, pick a membership plan from the homepage and enter the code in the checkout/payment page."
             )
@@ -639,7 +640,7 @@ class DonationForm(forms.Form):
 import re
 import uuid
 
-from django_dbq.models import Job
+from app.batch_updates import queue_batch_update_jobs
 
 
 class BatchUpdateSubscriptionsForm(forms.Form):
@@ -698,35 +699,33 @@ class BatchUpdateSubscriptionsForm(forms.Form):
         proration_behavior = self.cleaned_data.get("proration_behavior")
 
         # Split by comma, space, or new line
-        subscription_ids = re.split(r"[\s,]+", subscription_ids)
+        subscription_ids = [
+            subscription_id.strip()
+            for subscription_id in re.split(r"[\s,]+", subscription_ids)
+            if subscription_id.strip()
+        ]
+
+        if not (add_or_update_shipping or update_membership_fee):
+            return []
 
         # Create jobs for each subscription ID
-        for subscription_id in subscription_ids:
-            if add_or_update_shipping or update_membership_fee:
-                Job.objects.create(
-                    name="update_subscription",
-                    workspace={
-                        "batch_id": batch_id,
-                        "subscription_id": subscription_id.strip(),
-                        "proration_behavior": proration_behavior,
-                        "add_or_update_shipping": add_or_update_shipping,
-                        "optional_custom_shipping_fee": float(
-                            optional_custom_shipping_fee
-                        )
-                        if add_or_update_shipping
-                        and optional_custom_shipping_fee is not None
-                        and optional_custom_shipping_fee != ""
-                        else None,
-                        "update_membership_fee": update_membership_fee,
-                        "optional_custom_membership_fee": float(
-                            optional_custom_membership_fee
-                        )
-                        if update_membership_fee
-                        and optional_custom_membership_fee is not None
-                        and optional_custom_membership_fee != ""
-                        else None,
-                    },
-                )
+        return queue_batch_update_jobs(
+            batch_id,
+            subscription_ids,
+            proration_behavior=proration_behavior,
+            add_or_update_shipping=add_or_update_shipping,
+            optional_custom_shipping_fee=float(optional_custom_shipping_fee)
+            if add_or_update_shipping
+            and optional_custom_shipping_fee is not None
+            and optional_custom_shipping_fee != ""
+            else None,
+            update_membership_fee=update_membership_fee,
+            optional_custom_membership_fee=float(optional_custom_membership_fee)
+            if update_membership_fee
+            and optional_custom_membership_fee is not None
+            and optional_custom_membership_fee != ""
+            else None,
+        )
 
 
 ### V2 flow forms
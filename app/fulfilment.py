@@ -0,0 +1,141 @@
+from datetime import timedelta
+
+import shopify
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from sentry_sdk import capture_exception
+
+from app.models import ShopifyOrder
+from app.utils.shopify import (
+    ShopifyRateLimiter,
+    build_shopify_order,
+    shopify_order_enabled,
+)
+
+SHOPIFY_ORDER_BATCH_SIZE = 50
+SHOPIFY_ORDER_MAX_ATTEMPTS = 6
+SHOPIFY_ORDER_RETRY_DELAY = timedelta(minutes=1)
+SHOPIFY_ORDER_MAX_RETRY_DELAY = timedelta(hours=6)
+# How long a worker may hold a batch before another worker can claim it
+SHOPIFY_ORDER_LEASE = timedelta(minutes=15)
+
+
+def pending_shopify_orders():
+    return ShopifyOrder.objects.filter(
+        status=ShopifyOrder.QUEUED, next_attempt_at__lte=timezone.now()
+    )
+
+
+def retry_delay(attempts):
+    return min(
+        SHOPIFY_ORDER_RETRY_DELAY * 2 ** (attempts - 1), SHOPIFY_ORDER_MAX_RETRY_DELAY
+    )
+
+
+def claim_shopify_orders(batch_size=SHOPIFY_ORDER_BATCH_SIZE):
+    """
+    Take a batch of due orders off the queue for this worker.
+
+    Each order is saved as soon as Shopify accepts it, rather than in one
+    transaction for the batch, so a crash mid-batch can't lose the record
+    of an order Shopify already has.
+    """
+    with transaction.atomic():
+        orders = list(
+            pending_shopify_orders()
+            .select_for_update(skip_locked=True, of=("self",))
+            .select_related("user")
+            .order_by("id")[:batch_size]
+        )
+        ShopifyOrder.objects.filter(id__in=[order.id for order in orders]).update(
+            next_attempt_at=timezone.now() + SHOPIFY_ORDER_LEASE
+        )
+    return orders
+
+
+def submit_shopify_orders(batch_size=SHOPIFY_ORDER_BATCH_SIZE, limiter=None):
+    """
+    Create a batch of queued orders in Shopify over one session, keeping
+    within Shopify's rate limit. Returns the number of orders created.
+    """
+    if not shopify_order_enabled():
+        return 0
+
+    orders = claim_shopify_orders(batch_size)
+    if not orders:
+        return 0
+
+    limiter = limiter or ShopifyRateLimiter()
+    created = 0
+    with shopify.Session.temp(
+        settings.SHOPIFY_DOMAIN, "2021-10", settings.SHOPIFY_PRIVATE_APP_PASSWORD
+    ):
+        for order in orders:
+            if submit_shopify_order(order, limiter):
+                created += 1
+    return created
+
+
+def submit_shopify_order(order, limiter):
+    try:
+        o = build_shopify_order(
+            order.user,
+            line_items=order.line_items,
+            email=order.send_receipt,
+            tags=order.tags,
+        )
+        if not limiter.call(o.save):
+            raise ValueError(o.errors.full_messages())
+    except Exception as e:
+        capture_exception(e)
+        order.attempts += 1
+        order.last_error = str(e)
+        if order.attempts >= SHOPIFY_ORDER_MAX_ATTEMPTS:
+            order.status = ShopifyOrder.FAILED
+        order.next_attempt_at = timezone.now() + retry_delay(order.attempts)
+        order.save(
+            update_fields=["status", "attempts", "last_error", "next_attempt_at"]
+        )
+        return False
+
+    # Shopify has the order now, so whatever happens next it mustn't go back
+    # on the queue, or the next run would create it again
+    try:
+        record_shopify_order_created(order, o.id)
+    except Exception as e:
+        capture_exception(e)
+        print(
+            f"Shopify order {o.id} was created for queued order {order.id}"
+            f" but not recorded: {e}"
+        )
+        ShopifyOrder.objects.filter(id=order.id).update(
+            status=ShopifyOrder.REVIEW,
+            shopify_order_id=o.id,
+            last_error=f"Created in Shopify but not recorded: {e}",
+        )
+
+    if not settings.STRIPE_LIVE_MODE:
+        try:
+            limiter.call(o.cancel)
+        except Exception as e:
+            capture_exception(e)
+
+    return True
+
+
+def record_shopify_order_created(order, shopify_order_id):
+    order.status = ShopifyOrder.CREATED
+    order.shopify_order_id = shopify_order_id
+    order.submitted_at = timezone.now()
+    order.attempts += 1
+    order.last_error = ""
+    order.save(
+        update_fields=[
+            "status",
+            "shopify_order_id",
+            "submitted_at",
+            "attempts",
+            "last_error",
+        ]
+    )
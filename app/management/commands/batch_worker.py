@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from app.batch_updates import (
+    BATCH_UPDATE_QUEUE,
+    BATCH_UPDATE_WORKERS,
+    start_batch_workers,
+)
+
+
+class Command(BaseCommand):
+    help = "Run batch subscription updates across several worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=BATCH_UPDATE_WORKERS,
+            help="Worker processes to run",
+        )
+        parser.add_argument(
+            "--queue",
+            default=BATCH_UPDATE_QUEUE,
+            help="Job queue to work on",
+        )
+
+    def handle(self, *args, **options):
+        workers = start_batch_workers(
+            processes=options["processes"], queue_name=options["queue"]
+        )
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,109 @@
+import statistics
+import time
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+from app.utils.geo import cache_key as postcode_cache_key
+
+
+class Command(BaseCommand):
+    help = "Measure cache hit and miss latency for the keys the site relies on"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=200,
+            help="Number of reads to time per key family and scenario",
+        )
+        parser.add_argument(
+            "--alias",
+            default="default",
+            help="Which entry in settings.CACHES to benchmark",
+        )
+
+    def handle(self, *args, **options):
+        cache = caches[options["alias"]]
+        iterations = options["iterations"]
+
+        self.stdout.write(f"Benchmarking {cache.__class__.__name__} ({iterations}x)")
+
+        for family, keys in get_key_families(cache).items():
+            self.stdout.write(f"\n{family} ({len(keys)} keys)")
+            for scenario, timings in benchmark_keys(cache, keys, iterations).items():
+                self.stdout.write(f"  {scenario:<12} {format_timings(timings)}")
+
+
+def get_key_families(cache):
+    """
+    Real keys for the heaviest cache users: Shopify products, postcodes.io
+    lookups and wagtail-cache's rendered pages.
+    """
+    from app.models import User
+    from app.models.wagtail import BookPage, MerchandisePage
+
+    product_ids = [
+        id
+        for page_type in (BookPage, MerchandisePage)
+        for id in page_type.objects.values_list("shopify_product_id", flat=True)[:25]
+    ]
+    postcodes = (
+        User.objects.exclude(postcode=None)
+        .exclude(postcode="")
+        .values_list("postcode", flat=True)
+        .distinct()[:50]
+    )
+    keyring = cache.get("keyring") or {}
+    page_keys = [key for keys in keyring.values() for key in keys][:50]
+
+    return {
+        "shopify_product": [f"shopify_product.{id}" for id in product_ids],
+        "postcodes.io": [postcode_cache_key(postcode) for postcode in postcodes],
+        "wagtailcache": ["keyring"] + page_keys,
+    }
+
+
+def benchmark_keys(cache, keys, iterations):
+    # Only time reads against keys that are actually populated,
+    # otherwise every "hit" would secretly be a miss
+    populated = [key for key in keys if cache.get(key) is not None]
+    timings = {"miss": [], "shared hit": [], "local hit": []}
+
+    for i in range(iterations):
+        missing_key = f"benchmark.{uuid4()}"
+        timings["miss"].append(time_read(cache, missing_key))
+
+        if not populated:
+            continue
+
+        key = populated[i % len(populated)]
+        if hasattr(cache, "clear_local"):
+            cache.clear_local()
+            timings["shared hit"].append(time_read(cache, key))
+            timings["local hit"].append(time_read(cache, key))
+        else:
+            timings["shared hit"].append(time_read(cache, key))
+
+    return timings
+
+
+def time_read(cache, key):
+    start = time.perf_counter()
+    cache.get(key)
+    return (time.perf_counter() - start) * 1000
+
+
+def format_timings(timings):
+    if not timings:
+        return "no populated keys"
+
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return (
+        f"mean {statistics.mean(timings):.3f}ms  "
+        f"p50 {statistics.median(timings):.3f}ms  "
+        f"p95 {p95:.3f}ms  "
+        f"n={len(timings)}"
+    )
@@ -1,86 +1,331 @@
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import djstripe.models
+import stripe
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from djstripe.enums import SubscriptionStatus
+from sentry_sdk import capture_exception, capture_message
+
 from app.models import User
-from app.utils.shopify import create_shopify_order
-import stripe
+from app.models.stripe import StripeSyncCheckpoint
+from app.utils.http import format_http_metrics
+from app.utils.python import chunk_array
+from app.utils.shopify import queue_shopify_order
+from app.utils.stripe import STRIPE_REQUESTS_PER_SECOND, StripeRateLimiter
+
+CHECKPOINT_NAME = "ensure_stripe_subscriptions_processed"
+# Re-check subscriptions created shortly before the last run started,
+# in case their checkout was still in progress then
+LOOKBACK = timedelta(days=1)
 
 
 class Command(BaseCommand):
+    help = "Create Shopify orders for subscriptions the checkout flow didn't process"
+
     def add_arguments(self, parser):
         parser.add_argument(
-            '--dry-run',
-            action='store_true',
-            help='Simulate the command without making changes',
+            "--dry-run",
+            action="store_true",
+            help="Simulate the command without making changes",
+        )
+        parser.add_argument(
+            "--ignore-all",
+            action="store_true",
+            help="Mark all unprocessed subscriptions as processed without creating Shopify orders",
+        )
+        parser.add_argument(
+            "--local",
+            action="store_true",
+            help="Find candidates in the local dj-stripe mirror instead of listing them from Stripe",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Check every subscription, not just those created since the last run",
+        )
+        parser.add_argument(
+            "--since-days",
+            type=int,
+            default=None,
+            help="Check subscriptions created in the last N days",
         )
         parser.add_argument(
-            '--ignore-all',
-            action='store_true',
-            help='Mark all unprocessed subscriptions as processed without creating Shopify orders',
+            "--restart",
+            action="store_true",
+            help="Start over rather than resuming an interrupted run",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Subscriptions to process at once",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=STRIPE_REQUESTS_PER_SECOND,
+            help="Maximum Stripe API requests per second",
         )
 
     def handle(self, *args, **options):
-        dry_run = options['dry_run']
-        ignore_all = options['ignore_all']
-
-        customers = stripe.Customer.list(limit=100)
-    
-        for customer in customers.auto_paging_iter():
-            subscriptions = stripe.Subscription.list(customer=customer.id)
-            for subscription in subscriptions.auto_paging_iter():
-                # Skip non-active subscriptions
-                if subscription.status != 'active':
-                    print(f"Customer: {customer.email}")
-                    print(f"  Subscription ID: {subscription.id}")
-                    print(f"  Status: {subscription.status} (skipped - not active)\n")
-                    if not dry_run:
-                        stripe.Subscription.modify(subscription.id, metadata={"processed": "True"})
-                        print(f"Customer {customer.email} subscription marked as processed\n")
-                    continue
-                print(f"Customer: {customer.email}")
-                print(f"  Subscription ID: {subscription.id}")
-                print(f"  Status: {subscription.status}")
-                try:
-                    print(f"Customer {customer.email} metadata: {subscription.metadata}")
-                    if not subscription.metadata:
-                        if ignore_all:
-                            if not dry_run:
-                                stripe.Subscription.modify(subscription.id, metadata={"processed": "True"})
-                            print(f"Customer {customer.email} subscription marked as processed (ignore-all)\n")
-                            continue
-
-                        user = User.objects.filter(email=customer.email).first()
-                        if user:
-                            if user.primary_product:
-                                if not dry_run:
-                                    create_shopify_order(
-                                        user,
-                                        line_items=[
-                                            {
-                                                "title": f"Membership Subscription Purchase — {user.primary_product.name}",
-                                                "quantity": 1,
-                                                "price": 0,
-                                            }
-                                        ],
-                                        tags=["Membership Subscription Purchase", "Manual Sync"],
-                                    )
-                                print(f"Customer {customer.email} created shopify order {user.primary_product.name}")
-                                
-                            else:
-                                print(f"Customer {customer.email} has no primary product")
-                            if not dry_run:
-                                stripe.Subscription.modify(subscription.id, metadata={"processed": "True"})
-                            print(f"Customer {customer.email} subscription processed")
-                        else:
-                            print(f"Customer {customer.email} user not found\n")
-                    else:
-                        print(f"Customer {customer.email}: already processed.\n")
-                    
-                except Exception as e:
-                    from sentry_sdk import capture_exception, capture_message
-                    
-                    print(f"User {customer.email} error: {e}")
-
-                    # Log to Sentry
-                    capture_exception(e)
-                    capture_message(
-                        f"[StripeCheckoutSuccess] Failed to complete processing for user {customer.email}"
-                    )
\ No newline at end of file
+        reconciler = SubscriptionReconciler(
+            dry_run=options["dry_run"],
+            ignore_all=options["ignore_all"],
+            concurrency=options["concurrency"],
+            rate=options["rate"],
+            stdout=self.stdout,
+        )
+        if options["local"]:
+            reconciler.run_from_mirror(since_days=options["since_days"])
+        else:
+            reconciler.run_from_stripe(
+                scan_all=options["all"],
+                since_days=options["since_days"],
+                restart=options["restart"],
+            )
+        reconciler.print_summary()
+
+
+def unprocessed_mirrored_subscriptions():
+    """
+    Subscriptions the local mirror says haven't been processed: active ones
+    without any metadata, and other non-cancelled ones not yet marked.
+    """
+    active = Q(status=SubscriptionStatus.active)
+    return djstripe.models.Subscription.objects.exclude(
+        status=SubscriptionStatus.canceled
+    ).filter(
+        (active & (Q(metadata__isnull=True) | Q(metadata={})))
+        | (~active & ~Q(metadata__has_key="processed"))
+    )
+
+
+class SubscriptionReconciler:
+    """
+    Finds subscriptions that never got their Shopify order (say, because the
+    customer closed the tab before the checkout success page loaded), creates
+    the order and marks the subscription as processed.
+    """
+
+    def __init__(
+        self,
+        dry_run=False,
+        ignore_all=False,
+        concurrency=8,
+        rate=STRIPE_REQUESTS_PER_SECOND,
+        stdout=None,
+    ):
+        self.dry_run = dry_run
+        self.ignore_all = ignore_all
+        self.concurrency = concurrency
+        self.limiter = StripeRateLimiter(rate)
+        self.stdout = stdout
+        self.outcomes = Counter()
+        self.errors = Counter()
+        self.pages = 0
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+        else:
+            print(message)
+
+    def run_from_stripe(self, scan_all=False, since_days=None, restart=False):
+        """
+        Page through subscriptions, newest first, processing each page
+        concurrently and saving the cursor after every page.
+        """
+        checkpoint, _ = StripeSyncCheckpoint.objects.get_or_create(
+            name=CHECKPOINT_NAME
+        )
+
+        if checkpoint.in_progress and not restart:
+            self.write(
+                f"Resuming run started at {checkpoint.started_at} after {checkpoint.cursor}"
+            )
+        else:
+            if scan_all:
+                checkpoint.since = None
+            elif since_days is not None:
+                checkpoint.since = timezone.now() - timedelta(days=since_days)
+            elif checkpoint.completed_at is not None and checkpoint.started_at:
+                checkpoint.since = checkpoint.started_at - LOOKBACK
+            else:
+                checkpoint.since = None
+            checkpoint.cursor = None
+            checkpoint.started_at = timezone.now()
+            if not self.dry_run:
+                checkpoint.save()
+
+        params = {"limit": 100, "expand": ["data.customer"]}
+        if checkpoint.since is not None:
+            params["created"] = {"gte": int(checkpoint.since.timestamp())}
+            self.write(f"Checking subscriptions created since {checkpoint.since}")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                if checkpoint.cursor is not None:
+                    params["starting_after"] = checkpoint.cursor
+                self.limiter.wait()
+                page = stripe.Subscription.list(**params)
+                self.pages += 1
+                if len(page.data) == 0:
+                    break
+
+                self.process_concurrently(executor, page.data)
+
+                checkpoint.cursor = page.data[-1].id
+                if not self.dry_run:
+                    checkpoint.save(update_fields=["cursor", "updated_at"])
+
+                if not page.has_more:
+                    break
+
+        checkpoint.cursor = None
+        checkpoint.completed_at = timezone.now()
+        if not self.dry_run:
+            checkpoint.save()
+
+    def run_from_mirror(self, since_days=None):
+        """
+        Find subscriptions that look unprocessed in dj-stripe's local copy,
+        and only ask Stripe about those.
+        """
+        subscriptions = unprocessed_mirrored_subscriptions()
+        if since_days is not None:
+            subscriptions = subscriptions.filter(
+                created__gte=timezone.now() - timedelta(days=since_days)
+            )
+        ids = list(subscriptions.values_list("id", flat=True))
+        self.write(f"{len(ids)} subscriptions look unprocessed in the local mirror")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for chunk in chunk_array(ids, 100):
+                self.process_concurrently(executor, chunk)
+
+    def process_concurrently(self, executor, subscriptions):
+        batch_size = math.ceil(len(subscriptions) / self.concurrency)
+        # Wait for the whole page, so the checkpoint never skips anything
+        list(
+            executor.map(
+                self.process_batch, chunk_array(list(subscriptions), batch_size)
+            )
+        )
+
+    def process_batch(self, subscriptions):
+        try:
+            for subscription in subscriptions:
+                self.process_item(subscription)
+        finally:
+            # Each worker thread has its own database connection
+            connections.close_all()
+
+    def process_item(self, subscription):
+        if isinstance(subscription, str):
+            # An ID from the local mirror: check Stripe's current copy
+            try:
+                self.limiter.wait()
+                subscription = stripe.Subscription.retrieve(
+                    subscription, expand=["customer"]
+                )
+            except Exception as e:
+                self.record_error(e, f"Failed to retrieve subscription {subscription}")
+                with self.lock:
+                    self.outcomes["error"] += 1
+                return
+
+        email = getattr(subscription.customer, "email", None)
+        outcome = self.process_subscription(subscription, email)
+        with self.lock:
+            self.outcomes[outcome] += 1
+        self.write(f"{email} {subscription.id}: {outcome}")
+
+    def process_subscription(self, subscription, email):
+        try:
+            if subscription.status != "active":
+                if subscription.metadata.get("processed", None) is not None:
+                    return "already processed"
+                self.mark_processed(subscription)
+                return "skipped, not active"
+
+            if subscription.metadata:
+                return "already processed"
+
+            if self.ignore_all:
+                self.mark_processed(subscription)
+                return "ignored"
+
+            user = User.objects.filter(email=email).first() if email else None
+            if user is None:
+                return "user not found"
+
+            if user.primary_product:
+                if not self.dry_run:
+                    # The fulfilment worker submits these within Shopify's rate limit
+                    queue_shopify_order(
+                        user,
+                        line_items=[
+                            {
+                                "title": f"Membership Subscription Purchase — {user.primary_product.name}",
+                                "quantity": 1,
+                                "price": 0,
+                            }
+                        ],
+                        tags=["Membership Subscription Purchase", "Manual Sync"],
+                        reference=subscription.id,
+                    )
+                outcome = "queued shopify order"
+            else:
+                outcome = "no primary product"
+
+            self.mark_processed(subscription)
+            return outcome
+
+        except Exception as e:
+            self.record_error(
+                e, f"Failed to process subscription {subscription.id} for {email}"
+            )
+            return "error"
+
+    def record_error(self, e, message):
+        with self.lock:
+            self.errors[e.__class__.__name__] += 1
+        capture_exception(e)
+        capture_message(f"[ensure_stripe_subscriptions_processed] {message}: {e}")
+
+    def mark_processed(self, subscription):
+        if self.dry_run:
+            return
+        self.limiter.wait()
+        updated = stripe.Subscription.modify(
+            subscription.id, metadata={"processed": "True"}
+        )
+        # Keep the mirror in step even if the webhook is slow or lost
+        djstripe.models.Subscription.objects.filter(id=subscription.id).update(
+            metadata=dict(updated.metadata)
+        )
+
+    def print_summary(self):
+        elapsed = time.monotonic() - self.started_at
+        total = sum(self.outcomes.values())
+        self.write(
+            f"\nChecked {total} subscriptions in {elapsed:.1f}s "
+            f"({total / elapsed if elapsed else 0:.1f}/s, "
+            f"{self.pages} Stripe list pages)"
+            + (" (dry run)" if self.dry_run else "")
+        )
+        for outcome, count in self.outcomes.most_common():
+            self.write(f"  {outcome}: {count}")
+        for error, count in self.errors.most_common():
+            self.write(f"  error {error}: {count}")
+        self.write(format_http_metrics())
@@ -1,44 +1,93 @@
+import time
+from collections import defaultdict
+
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
-from app.utils.geo import (
-    bulk_postcode_geo,
-    normalise_postcode,
-    point_from_postcode_result,
-)
+from app.utils.geo import bulk_geocode_postcodes, country_code_for, normalise_postcode
+from app.utils.http import format_http_metrics
+from app.utils.python import chunk_iterable
 
 
 class Command(BaseCommand):
-    @transaction.atomic
-    def handle(self, *args, **options):
-        from app.models.django import User
+    help = "Geocode the postcodes of users who don't have coordinates yet"
 
-        # Bulk get / set postcodes
-        users_with_postcodes = (
-            User.objects.filter(coordinates__isnull=True)
-            .exclude(postcode="")
-            .exclude(postcode=None)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Users to geocode and save per transaction",
         )
-        # print("Getting postcode data for", users_with_postcodes.count(), users_with_postcodes)
-        postcode_data = bulk_postcode_geo(
-            [
-                u.postcode
-                for u in users_with_postcodes
-                if u.postcode is not None and u.postcode != ""
-            ]
+
+    def handle(self, *args, **options):
+        geocode_users(chunk_size=options["chunk_size"], stdout=self.stdout)
+
+
+def geocode_users(chunk_size=1000, stdout=None):
+    """
+    Stream users without coordinates through bulk_geocode_postcodes a chunk
+    at a time, grouped by country.
+
+    Each chunk is committed on its own, and only users without coordinates are
+    selected, so an interrupted run picks up where it left off.
+    """
+    from app.models.django import User
+
+    users = (
+        User.objects.filter(coordinates__isnull=True)
+        .exclude(postcode="")
+        .exclude(postcode=None)
+        .only("id", "postcode", "country")
+        .order_by("id")
+    )
+
+    started_at = time.monotonic()
+    processed = located = 0
+
+    for chunk in chunk_iterable(users.iterator(chunk_size=chunk_size), chunk_size):
+        postcodes_by_country = defaultdict(set)
+        for user in chunk:
+            postcodes_by_country[country_code_for(user.country)].add(
+                normalise_postcode(user.postcode)
+            )
+        points = {
+            (country_code, postcode): point
+            for country_code, postcodes in postcodes_by_country.items()
+            for postcode, point in bulk_geocode_postcodes(
+                postcodes, country_code
+            ).items()
+        }
+
+        located_users = []
+        for user in chunk:
+            point = points.get(
+                (country_code_for(user.country), normalise_postcode(user.postcode)),
+                None,
+            )
+            if point is not None:
+                user.coordinates = point
+                located_users.append(user)
+
+        with transaction.atomic():
+            User.objects.bulk_update(located_users, ["coordinates"])
+
+        processed += len(chunk)
+        located += len(located_users)
+        elapsed = time.monotonic() - started_at
+        message = (
+            f"Geocoded {located}/{processed} users "
+            f"({processed / elapsed if elapsed else 0:.1f} users/s)"
         )
-        # print("Coord data", postcode_data)
-        for postcode_payload in postcode_data:
-            # print("Searching", postcode_payload['query'])
-            for user in users_with_postcodes:
-                result = postcode_payload.get("result", None)
-                # print("Against user", user.postcode)
-                if (
-                    normalise_postcode(user.postcode)
-                    == normalise_postcode(postcode_payload["query"])
-                    and result is not None
-                ):
-                    # print("--> MATCH", user, postcode_payload)
-                    point = point_from_postcode_result(result)
-                    user.coordinates = point
-                    user.save()
+        if stdout is not None:
+            stdout.write(message)
+        else:
+            print(message)
+
+    message = format_http_metrics()
+    if stdout is not None:
+        stdout.write(message)
+    else:
+        print(message)
+
+    return located
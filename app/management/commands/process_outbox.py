@@ -0,0 +1,42 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.outbox import OUTBOX_BATCH_SIZE, process_outbox
+
+# Seconds to wait when the outbox is empty
+OUTBOX_POLL_INTERVAL = 5
+
+
+class Command(BaseCommand):
+    help = "Send queued PostHog and Mailchimp events"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send one batch, then exit",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=OUTBOX_BATCH_SIZE,
+            help="Events to send per batch",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+
+        while True:
+            close_old_connections()
+            try:
+                sent = process_outbox(batch_size=batch_size)
+            except Exception as e:
+                print(f"Failed to process outbox: {e}")
+                sent = 0
+
+            if options["once"]:
+                return
+            if sent < batch_size:
+                sleep(OUTBOX_POLL_INTERVAL)
@@ -10,12 +10,37 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         # Register cron commands
         def run_ensure_stripe_subscriptions_processed():
-            management.call_command(
-                "ensure_stripe_subscriptions_processed"
-            )
+            management.call_command("ensure_stripe_subscriptions_processed", local=True)
 
         register_cron(run_ensure_stripe_subscriptions_processed, timedelta(days=1))
 
+        # Catch anything the local mirror missed because a webhook was lost
+        def run_ensure_stripe_subscriptions_processed_from_stripe():
+            management.call_command("ensure_stripe_subscriptions_processed")
+
+        register_cron(
+            run_ensure_stripe_subscriptions_processed_from_stripe, timedelta(days=7)
+        )
+
+        # Catch up on any Shopify product webhooks we missed
+        def run_incremental_shopify_sync():
+            management.call_command("sync_shopify_products", incremental=True)
+
+        register_cron(run_incremental_shopify_sync, timedelta(hours=1))
+
+        # Catch up on any promotion code webhooks we missed
+        def run_sync_promotion_codes():
+            management.call_command("sync_promotion_codes")
+
+        register_cron(run_sync_promotion_codes, timedelta(days=1))
+
+        def run_prune_outbox():
+            from app.outbox import prune_outbox
+
+            prune_outbox()
+
+        register_cron(run_prune_outbox, timedelta(days=1))
+
         print("Starting cron worker")
 
         # Start the periodic job queue (`groundwork` via `schedule`)
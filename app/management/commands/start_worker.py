@@ -1,10 +1,29 @@
+import threading
+
 from django.core import management
 from django.core.management.base import BaseCommand
 
+from app.batch_updates import start_batch_workers
+
 
 class Command(BaseCommand):
     help = "Run background processes"
 
     def handle(self, *args, **options):
+        # Fork the batch update workers before starting any threads
+        start_batch_workers()
+
+        # Send queued analytics and Mailchimp events alongside the job queue
+        threading.Thread(
+            target=management.call_command, args=("process_outbox",), daemon=True
+        ).start()
+
+        # Create queued Shopify orders in batches
+        threading.Thread(
+            target=management.call_command,
+            args=("submit_shopify_orders",),
+            daemon=True,
+        ).start()
+
         # Start the one-off job queue (`django_dbq`)
         management.call_command("worker", rate_limit=30)
@@ -0,0 +1,47 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.fulfilment import SHOPIFY_ORDER_BATCH_SIZE, submit_shopify_orders
+from app.utils.shopify import ShopifyRateLimiter
+
+# Seconds to wait when no orders are due
+SHOPIFY_ORDER_POLL_INTERVAL = 10
+
+
+class Command(BaseCommand):
+    help = "Create queued orders in Shopify"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Submit one batch, then exit",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=SHOPIFY_ORDER_BATCH_SIZE,
+            help="Orders to submit per batch",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        # Shared across batches, so the bucket stays in step with Shopify's
+        limiter = ShopifyRateLimiter()
+
+        while True:
+            close_old_connections()
+            try:
+                created = submit_shopify_orders(batch_size=batch_size, limiter=limiter)
+                if created:
+                    print(f"Created {created} Shopify orders")
+            except Exception as e:
+                print(f"Failed to submit Shopify orders: {e}")
+                created = 0
+
+            if options["once"]:
+                return
+            if created < batch_size:
+                sleep(SHOPIFY_ORDER_POLL_INTERVAL)
@@ -0,0 +1,25 @@
+import stripe
+from django.core.management.base import BaseCommand
+
+from app.models.stripe import StripePromotionCode
+from app.utils.python import chunk_iterable
+
+
+class Command(BaseCommand):
+    help = "Copy every Stripe promotion code into the local gift code index"
+
+    def handle(self, *args, **options):
+        synced = sync_promotion_codes()
+        self.stdout.write(f"Synced {synced} promotion codes")
+
+
+def sync_promotion_codes(chunk_size=100):
+    """
+    Catch up on promotion code changes whose webhooks were missed.
+    """
+    synced = 0
+    promo_codes = stripe.PromotionCode.list(limit=100).auto_paging_iter()
+    for chunk in chunk_iterable(promo_codes, chunk_size):
+        StripePromotionCode.bulk_sync_from_stripe_data(chunk)
+        synced += len(chunk)
+    return synced
@@ -11,11 +11,23 @@ from app.models.wagtail import MerchandisePage
 class Command(BaseCommand):
     help = "Sync shopify products"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only sync products updated since the last sync",
+        )
+
     @transaction.atomic
     def handle(self, *args, **options):
-        run()
+        sync(incremental=options["incremental"])
+
+
+def run(job=None, *args, **kwargs):
+    workspace = getattr(job, "workspace", None) or {}
+    sync(incremental=workspace.get("incremental", False))
 
 
-def run(*args, **kwargs):
-    BookPage.sync_shopify_products_to_pages()
-    MerchandisePage.sync_shopify_products_to_pages()
+def sync(incremental=False):
+    BookPage.sync_shopify_products_to_pages(incremental=incremental)
+    MerchandisePage.sync_shopify_products_to_pages(incremental=incremental)
@@ -6,8 +6,15 @@ from django.core.cache import cache
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
+from app.batch_updates import BATCH_UPDATE_WORKERS
 from app.models import BookPage, LBCSubscription
 from app.models.wagtail import MerchandisePage
+from app.utils.stripe import SharedStripeRateLimiter
+
+# Shared by every batch worker process
+stripe_limiter = SharedStripeRateLimiter(
+    name="batch_update_subscriptions", processes=BATCH_UPDATE_WORKERS
+)
 
 
 class Command(BaseCommand):
@@ -94,6 +101,7 @@ def process(
     **kwargs,
 ):
     #### Refresh data
+    stripe_limiter.wait()
     st_sub = stripe.Subscription.retrieve(subscription_id)
     djstripe.models.Subscription.sync_from_stripe_data(st_sub)
     dj_sub = LBCSubscription.objects.get(id=subscription_id)
@@ -154,6 +162,7 @@ def process(
     )
 
     def execute(*args, **kwargs):
+        stripe_limiter.wait()
         stripe.Subscription.modify(*args, **kwargs)
 
     return [execute, args, kwargs]
@@ -1,23 +1,96 @@
+import hashlib
 import json
+import logging
 from urllib.parse import unquote
 
 import posthog
 from django.conf import settings
+from django.core.cache import cache
+
+from app.utils.cache import (
+    register_cache_dependencies,
+    start_tracking_cache_dependencies,
+    stop_tracking_cache_dependencies,
+)
+from app.utils.stripe import start_stripe_request_cache, stop_stripe_request_cache
+
+
+# Links are permanent in PostHog, so this only needs to outlive a session
+POSTHOG_IDENTITY_LINK_TTL = 60 * 60 * 24 * 30
+POSTHOG_ALIAS_REPORT_INTERVAL = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def posthog_alias_count_key(kind):
+    return f"posthog_alias_count.{kind}"
+
+
+def posthog_alias_counts():
+    """
+    Alias calls sent and suppressed so far, by every worker.
+    """
+    counts = cache.get_many(
+        [posthog_alias_count_key(kind) for kind in ("sent", "suppressed")]
+    )
+    return {
+        kind: counts.get(posthog_alias_count_key(kind), 0)
+        for kind in ("sent", "suppressed")
+    }
+
+
+def count_posthog_aliases(sent=0, suppressed=0):
+    # Counted in the shared cache, so the totals cover every worker
+    # and outlive restarts
+    for kind, delta in (("sent", sent), ("suppressed", suppressed)):
+        if delta:
+            key = posthog_alias_count_key(kind)
+            cache.add(key, 0, None)
+            count = cache.incr(key, delta)
+    if suppressed and (
+        count // POSTHOG_ALIAS_REPORT_INTERVAL
+        > (count - suppressed) // POSTHOG_ALIAS_REPORT_INTERVAL
+    ):
+        counts = posthog_alias_counts()
+        logger.info(
+            "PostHog identity linking: %s alias calls sent, %s suppressed",
+            counts["sent"],
+            counts["suppressed"],
+        )
+
+
+def posthog_identity_link_cache_key(distinct_id, session_key, user_id):
+    digest = hashlib.md5(f"{distinct_id}|{session_key}|{user_id}".encode()).hexdigest()
+    return f"posthog_identity_link.{digest}"
 
 
 def frontend_backend_posthog_identity_linking(get_response):
 
     def middleware(request):
-        if settings.POSTHOG_PUBLIC_TOKEN:
+        if settings.POSTHOG_PUBLIC_TOKEN and request.user.is_authenticated:
+            distinct_id = None
             posthog_cookie = request.COOKIES.get(f"ph_{posthog.project_api_key}_posthog")
             if posthog_cookie:
                 cookie_dict = json.loads(unquote(posthog_cookie))
-                if cookie_dict["distinct_id"] and request.user.is_authenticated:
-                    posthog.alias(cookie_dict["distinct_id"], request.user.primary_email)
-
-            if request.session.session_key is not None and request.user.is_authenticated:
-                posthog.alias(request.session.session_key, request.user.primary_email)
-                posthog.alias(request.session.session_key, request.user.id)
+                distinct_id = cookie_dict.get("distinct_id", None)
+
+            session_key = request.session.session_key
+            aliases = (1 if distinct_id else 0) + (2 if session_key is not None else 0)
+
+            # Only alias each combination of identities once
+            key = posthog_identity_link_cache_key(
+                distinct_id, session_key, request.user.id
+            )
+            if aliases > 0 and cache.get(key, False):
+                count_posthog_aliases(suppressed=aliases)
+            elif aliases > 0:
+                if distinct_id:
+                    posthog.alias(distinct_id, request.user.primary_email)
+                if session_key is not None:
+                    posthog.alias(session_key, request.user.primary_email)
+                    posthog.alias(session_key, request.user.id)
+                cache.set(key, True, POSTHOG_IDENTITY_LINK_TTL)
+                count_posthog_aliases(sent=aliases)
 
         response = get_response(request)
 
@@ -37,13 +110,18 @@ def update_stripe_customer_subscription(get_response):
             or "update-membership/success" in request.path
         )
 
-        if membership_request:
-            # Code to be executed for each request before
-            # the view (and later middleware) are called.
-            if request.user.is_authenticated:
-                request.user.refresh_stripe_data()
+        # Fetch each Stripe object at most once while handling this request
+        start_stripe_request_cache()
+        try:
+            if membership_request:
+                # Code to be executed for each request before
+                # the view (and later middleware) are called.
+                if request.user.is_authenticated:
+                    request.user.refresh_stripe_data(if_stale=True)
 
-        response = get_response(request)
+            response = get_response(request)
+        finally:
+            stop_stripe_request_cache()
 
         # Code to be executed for each request/response after
         # the view is called.
@@ -51,3 +129,26 @@ def update_stripe_customer_subscription(get_response):
         return response
 
     return middleware
+
+
+def track_cache_dependencies(get_response):
+    """
+    Record the pages, snippets and settings used to render a response,
+    so that wagtail-cache entries can be evicted when they change.
+    """
+
+    def middleware(request):
+        start_tracking_cache_dependencies()
+        try:
+            response = get_response(request)
+        finally:
+            tags = stop_tracking_cache_dependencies()
+
+        # wagtail-cache flags requests whose response it is about to store
+        if tags and getattr(request, "_wagtailcache_update", False):
+            # Match the URI wagtail-cache uses for its own keyring
+            register_cache_dependencies(unquote(request.build_absolute_uri()), tags)
+
+        return response
+
+    return middleware
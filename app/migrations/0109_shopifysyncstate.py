@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0108_rename_country_readinggroup_in_person_country"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShopifySyncState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("collection_id", models.CharField(max_length=300, unique=True)),
+                (
+                    "last_updated_at",
+                    models.DateTimeField(
+                        blank=True,
+                        help_text="The most recent product `updated_at` seen in this collection",
+                        null=True,
+                    ),
+                ),
+                ("last_synced_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
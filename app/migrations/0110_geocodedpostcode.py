@@ -0,0 +1,55 @@
+# Generated by Django 4.2 on 2026-10-17 10:30
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0109_shopifysyncstate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GeocodedPostcode",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "postcode",
+                    models.CharField(help_text="Normalised postcode", max_length=20),
+                ),
+                ("country", models.CharField(default="GB", max_length=2)),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("postcodes.io", "postcodes.io"),
+                            ("mapbox", "Mapbox"),
+                        ],
+                        default="postcodes.io",
+                        max_length=20,
+                    ),
+                ),
+                ("result", models.JSONField(blank=True, null=True)),
+                (
+                    "coordinates",
+                    django.contrib.gis.db.models.fields.PointField(
+                        blank=True, null=True, srid=4326
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "unique_together": {("postcode", "country")},
+            },
+        ),
+    ]
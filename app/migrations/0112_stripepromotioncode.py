@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-17 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0111_outboxevent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripePromotionCode",
+            fields=[
+                (
+                    "id",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("code", models.CharField(db_index=True, max_length=255)),
+                ("active", models.BooleanField(default=True)),
+                (
+                    "max_redemptions",
+                    models.PositiveIntegerField(blank=True, null=True),
+                ),
+                ("times_redeemed", models.PositiveIntegerField(default=0)),
+                (
+                    "coupon_id",
+                    models.CharField(blank=True, default="", max_length=255),
+                ),
+                ("metadata", models.JSONField(blank=True, default=dict)),
+                ("created", models.DateTimeField(blank=True, null=True)),
+                ("synced_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
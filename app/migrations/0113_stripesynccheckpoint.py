@@ -0,0 +1,48 @@
+# Generated by Django 4.2 on 2026-10-17 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0112_stripepromotioncode"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StripeSyncCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, unique=True)),
+                (
+                    "cursor",
+                    models.CharField(
+                        blank=True,
+                        help_text="ID of the last object fully processed by the current run",
+                        max_length=255,
+                        null=True,
+                    ),
+                ),
+                (
+                    "since",
+                    models.DateTimeField(
+                        blank=True,
+                        help_text="Only objects created after this",
+                        null=True,
+                    ),
+                ),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("completed_at", models.DateTimeField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
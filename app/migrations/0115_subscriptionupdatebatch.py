@@ -0,0 +1,80 @@
+# Generated by Django 4.2 on 2026-10-17 15:05
+
+from collections import Counter, defaultdict
+
+from django.db import migrations, models
+
+
+def summarise_existing_batches(apps, schema_editor):
+    Job = apps.get_model("django_dbq", "Job")
+    SubscriptionUpdateBatch = apps.get_model("app", "SubscriptionUpdateBatch")
+
+    batches = defaultdict(
+        lambda: {"options": None, "total": 0, "complete": 0, "failed": 0}
+    )
+    errors = defaultdict(Counter)
+    for workspace, state in (
+        Job.objects.filter(name="update_subscription", workspace__has_key="batch_id")
+        .values_list("workspace", "state")
+        .iterator()
+    ):
+        batch = batches[workspace["batch_id"]]
+        if batch["options"] is None:
+            batch["options"] = {
+                key: value
+                for key, value in workspace.items()
+                if key not in ("batch_id", "subscription_id")
+                and not key.startswith(("error", "context", "retry", "original"))
+            }
+        if state == "FAILED" and "retry_job_id" in workspace:
+            continue
+        batch["total"] += 1
+        if state == "COMPLETE":
+            batch["complete"] += 1
+        elif state == "FAILED":
+            batch["failed"] += 1
+            error = (workspace.get("error") or "Unknown error")[:200]
+            errors[workspace["batch_id"]][error] += 1
+
+    SubscriptionUpdateBatch.objects.bulk_create(
+        [
+            SubscriptionUpdateBatch(id=batch_id, errors=dict(errors[batch_id]), **batch)
+            for batch_id, batch in batches.items()
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+    # Index the job table without locking it
+    atomic = False
+
+    dependencies = [
+        ("app", "0114_shopifyorder"),
+        ("django_dbq", "0006_alter_job_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SubscriptionUpdateBatch",
+            fields=[
+                ("id", models.UUIDField(primary_key=True, serialize=False)),
+                ("options", models.JSONField(blank=True, default=dict)),
+                ("total", models.PositiveIntegerField(default=0)),
+                ("complete", models.PositiveIntegerField(default=0)),
+                ("failed", models.PositiveIntegerField(default=0)),
+                ("errors", models.JSONField(blank=True, default=dict)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        # Matches the `workspace__batch_id=...` lookups, which compare
+        # `workspace -> 'batch_id'`, and their ordering by creation
+        migrations.RunSQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS django_dbq_job_batch_id_idx "
+            "ON django_dbq_job ((workspace -> 'batch_id'), created)",
+            "DROP INDEX CONCURRENTLY IF EXISTS django_dbq_job_batch_id_idx",
+        ),
+        migrations.RunPython(summarise_existing_batches, migrations.RunPython.noop),
+    ]
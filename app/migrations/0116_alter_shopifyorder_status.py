@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0115_subscriptionupdatebatch"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="shopifyorder",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("created", "Created"),
+                    ("failed", "Failed"),
+                    ("review", "Needs review"),
+                ],
+                default="queued",
+                max_length=10,
+            ),
+        ),
+    ]
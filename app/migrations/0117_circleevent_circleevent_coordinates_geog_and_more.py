@@ -0,0 +1,40 @@
+# Generated by Django 4.2 on 2026-10-17 23:45
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+import django.db.models.functions.comparison
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0116_alter_shopifyorder_status"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="circleevent",
+            index=django.contrib.postgres.indexes.GistIndex(
+                django.db.models.functions.comparison.Cast(
+                    "coordinates",
+                    output_field=django.contrib.gis.db.models.fields.PointField(
+                        geography=True
+                    ),
+                ),
+                name="circleevent_coordinates_geog",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="readinggroup",
+            index=django.contrib.postgres.indexes.GistIndex(
+                django.db.models.functions.comparison.Cast(
+                    "coordinates",
+                    output_field=django.contrib.gis.db.models.fields.PointField(
+                        geography=True
+                    ),
+                ),
+                name="readinggroup_coordinates_geog",
+            ),
+        ),
+    ]
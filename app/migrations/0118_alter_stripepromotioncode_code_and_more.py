@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 00:05
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0117_circleevent_circleevent_coordinates_geog_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="stripepromotioncode",
+            name="code",
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="stripepromotioncode",
+            index=models.Index(
+                django.db.models.functions.text.Upper("code"),
+                name="stripepromotioncode_code_upper",
+            ),
+        ),
+    ]
@@ -10,12 +10,16 @@ from django.conf import settings
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.geos import Point
 from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.postgres.indexes import GistIndex
 from django.db import models
 from groundwork.core.datasources import RestDatasource, SyncConfig, SyncedModel
 from wagtail.admin import widgets  # to use Wagtail's special datetime widget
 from wagtail.admin.panels import FieldPanel
 from wagtail.fields import RichTextField
 
+from app.utils.geo import as_geography
+from app.utils.http import get_session
+
 ResourceT = TypeVar("ResourceT")
 
 import json
@@ -66,15 +70,24 @@ class CircleAPIResource(RestDatasource[ResourceT]):
             else:
                 page += 1
 
-    def fetch_url(self, *args, **kwargs):
-        kwargs["query"] = kwargs.get("query", {})
+    def fetch_url(self, url: str, query: Dict[str, Any] = None) -> Any:
+        query = query or {}
 
         if self.community_id is None:
-            communities = super().fetch_url(f"{self.base_url}/communities", query={})
+            communities = self.fetch_json(f"{self.base_url}/communities", query={})
             self.community_id = communities[0]["id"]
-        kwargs["query"]["community_id"] = self.community_id
+        query["community_id"] = self.community_id
+
+        return self.fetch_json(url, query=query)
+
+    def fetch_json(self, url: str, query: Dict[str, Any]) -> Any:
+        # RestDatasource.fetch_url opens a new connection for every page
+        res = get_session("circle").get(url, params=query, headers=self.get_headers())
 
-        return super().fetch_url(*args, **kwargs)
+        if not res.ok:
+            raise OSError(f"{url}: http {res.status_code}")
+
+        return res.json()
 
 
 @dataclass
@@ -258,6 +271,12 @@ class CircleEvent(SyncedModel):
     coordinates = gis_models.PointField(null=True, blank=True)
     body_html = RichTextField(blank=True, null=True)
 
+    class Meta(SyncedModel.Meta):
+        indexes = [
+            # Ordered by `nearest`
+            GistIndex(as_geography("coordinates"), name="circleevent_coordinates_geog"),
+        ]
+
     title_widget = forms.TextInput(attrs={"placeholder": "Enter Full Title"})
     # using the correct widget for your field type and desired effect
     date_widget = widgets.AdminDateInput(attrs={"placeholder": "dd-mm-yyyy"})
@@ -1,8 +1,8 @@
-from typing import Optional
+from typing import Dict, List, Optional
 
 import json
 from collections import namedtuple
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import djstripe
 import stripe
@@ -11,18 +11,24 @@ from allauth.account.utils import user_display
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.gis.db import models as gis_models
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Prefetch
 from django.utils import timezone
 from django.utils.functional import cached_property
 from sentry_sdk import capture_exception
 
 from app.apps import basic_posthog_event_properties
 from app.utils.stripe import (
+    DONATION_PRODUCT_NAME,
     SHIPPING_PRODUCT_NAME,
     get_primary_product_for_djstripe_subscription,
     get_primary_product_subscription_item_for_djstripe_subscription,
     get_shipping_product_for_djstripe_subscription,
     interval_string_for_plan,
+    mark_stripe_customer_synced,
+    retrieve_stripe_object,
+    stripe_customer_recently_synced,
     subscription_with_promocode,
 )
 
@@ -36,6 +42,119 @@ def custom_user_casual_name(user: AbstractUser) -> str:
     return user.username
 
 
+VALID_SUBSCRIPTION_STATUSES = [
+    djstripe.enums.SubscriptionStatus.active,
+    djstripe.enums.SubscriptionStatus.trialing,
+    djstripe.enums.SubscriptionStatus.past_due,
+    djstripe.enums.SubscriptionStatus.unpaid,
+]
+
+
+@dataclass
+class MembershipSnapshot:
+    """
+    A user's customer record and subscriptions (with items, plans and products),
+    loaded in one go so that membership properties don't each re-query Stripe models.
+    """
+
+    customer: Optional[djstripe.models.Customer] = None
+    subscriptions: List[LBCSubscription] = field(default_factory=list)
+
+    @classmethod
+    def load_for_user(cls, user: "User") -> "MembershipSnapshot":
+        try:
+            customer = user.djstripe_customers.prefetch_related(
+                Prefetch(
+                    "subscriptions",
+                    queryset=LBCSubscription.objects.select_related(
+                        "plan__product"
+                    ).prefetch_related("items__plan__product"),
+                )
+            ).first()
+        except:
+            customer = None
+        if customer is None:
+            return cls()
+        return cls(customer=customer, subscriptions=list(customer.subscriptions.all()))
+
+    @classmethod
+    def load_for_users(cls, users) -> Dict[int, "MembershipSnapshot"]:
+        """
+        Snapshots for many users at once, keyed by user ID, in a fixed number of queries.
+        """
+        snapshots = {user.pk: cls() for user in users}
+        # Ordered so each user gets the same customer as `load_for_user`'s `.first()`
+        customers = (
+            djstripe.models.Customer.objects.filter(subscriber__in=list(snapshots))
+            .order_by("djstripe_id")
+            .prefetch_related(
+                Prefetch(
+                    "subscriptions",
+                    queryset=LBCSubscription.objects.select_related(
+                        "plan__product"
+                    ).prefetch_related("items__plan__product"),
+                )
+            )
+        )
+        for customer in customers:
+            if snapshots[customer.subscriber_id].customer is None:
+                snapshots[customer.subscriber_id] = cls(
+                    customer=customer, subscriptions=list(customer.subscriptions.all())
+                )
+        return snapshots
+
+    @staticmethod
+    def is_gift(sub) -> bool:
+        return "gift_mode" in (sub.metadata or {})
+
+    @cached_property
+    def active_subscription(self) -> Optional[LBCSubscription]:
+        now = timezone.now()
+        candidates = [
+            sub
+            for sub in self.subscriptions
+            # Was started + wasn't cancelled
+            if sub.status in VALID_SUBSCRIPTION_STATUSES
+            # Is in period
+            and (sub.current_period_end is not None and sub.current_period_end > now)
+            # Isn't a gift card
+            and not self.is_gift(sub)
+        ]
+        candidates.sort(key=lambda sub: sub.created, reverse=True)
+        return candidates[0] if candidates else None
+
+    @cached_property
+    def old_subscription(self) -> Optional[LBCSubscription]:
+        candidates = [
+            sub
+            for sub in self.subscriptions
+            if sub.ended_at is not None and not self.is_gift(sub)
+        ]
+        candidates.sort(key=lambda sub: sub.ended_at, reverse=True)
+        return candidates[0] if candidates else None
+
+    @cached_property
+    def gifts_bought(self) -> List[LBCSubscription]:
+        gifts = [sub for sub in self.subscriptions if self.is_gift(sub)]
+        gifts.sort(key=lambda sub: sub.created, reverse=True)
+        return gifts
+
+    @cached_property
+    def primary_product(self) -> Optional[djstripe.models.Product]:
+        sub = self.active_subscription
+        if sub is None:
+            return None
+        if sub.plan is not None:
+            return sub.plan.product
+        for si in sub.items.all():
+            if si.plan.product.name not in [
+                SHIPPING_PRODUCT_NAME,
+                DONATION_PRODUCT_NAME,
+            ]:
+                return si.plan.product
+        return None
+
+
 class User(AbstractUser):
     gdpr_email_consent = models.BooleanField(
         null=True,
@@ -69,25 +188,48 @@ class User(AbstractUser):
     def display_name(self):
         return user_display(self)
 
-    def refresh_stripe_data(self):
+    def refresh_stripe_data(self, if_stale=False):
+        """
+        Sync the customer and their subscriptions from Stripe.
+
+        With `if_stale`, skip it if a webhook has only just synced them.
+        """
+        # A customer may have been created since the snapshot was taken
+        self.clear_membership_cache()
         try:
-            if self.stripe_customer is not None:
+            customer_id = self.stripe_customer_id()
+            if customer_id is not None and not (
+                if_stale and stripe_customer_recently_synced(customer_id)
+            ):
                 # Refetch customer data
-                customer = stripe.Customer.retrieve(self.stripe_customer.id)
+                customer = retrieve_stripe_object(
+                    stripe.Customer, customer_id, refresh=not if_stale
+                )
                 djstripe.models.Customer.sync_from_stripe_data(customer)
                 # Update subscriptions
                 self.stripe_customer._sync_subscriptions()
+                mark_stripe_customer_synced(customer_id)
         except Exception as e:
             capture_exception(e)
             pass
+        self.clear_membership_cache()
+
+    @cached_property
+    def membership(self) -> MembershipSnapshot:
+        return MembershipSnapshot.load_for_user(self)
+
+    def clear_membership_cache(self):
+        """
+        Drop the memoized membership state, e.g. after syncing from Stripe.
+        """
+        for attr in ("membership", "active_subscription"):
+            self.__dict__.pop(attr, None)
 
     @property
     def stripe_customer(self) -> djstripe.models.Customer:
-        try:
-            customer = self.djstripe_customers.first()
-            return customer
-        except:
-            return None
+        # Remembered even when missing: whatever creates or syncs a customer
+        # calls `clear_membership_cache`
+        return self.membership.customer
 
     def stripe_customer_id(self) -> str:
         customer = self.stripe_customer
@@ -95,48 +237,15 @@ class User(AbstractUser):
             return customer.id
         return None
 
-    valid_subscription_statuses = [
-        djstripe.enums.SubscriptionStatus.active,
-        djstripe.enums.SubscriptionStatus.trialing,
-        djstripe.enums.SubscriptionStatus.past_due,
-        djstripe.enums.SubscriptionStatus.unpaid,
-    ]
+    valid_subscription_statuses = VALID_SUBSCRIPTION_STATUSES
 
     @cached_property
     def active_subscription(self) -> LBCSubscription:
-        try:
-            sub = (
-                LBCSubscription.objects.filter(
-                    customer=self.stripe_customer,
-                    # Was started + wasn't cancelled
-                    status__in=self.valid_subscription_statuses,
-                    # Is in period
-                    current_period_end__gt=timezone.now(),
-                    # Isn't a gift card
-                    metadata__gift_mode__isnull=True,
-                )
-                .order_by("-created")
-                .first()
-            )
-            return sub
-        except:
-            return None
+        return self.membership.active_subscription
 
     @property
     def old_subscription(self) -> LBCSubscription:
-        try:
-            sub = (
-                self.stripe_customer.subscriptions.filter(
-                    ended_at__isnull=False,
-                    # Isn't a gift card
-                    metadata__gift_mode__isnull=True,
-                )
-                .order_by("-ended_at")
-                .first()
-            )
-            return sub
-        except:
-            return None
+        return self.membership.old_subscription
 
     @property
     def is_member(self):
@@ -160,10 +269,7 @@ class User(AbstractUser):
 
     @property
     def has_never_subscribed(self):
-        return (
-            self.stripe_customer is None
-            or self.stripe_customer.subscriptions.count() == 0
-        )
+        return len(self.membership.subscriptions) == 0
 
     def subscription_status(self):
         if self.is_member:
@@ -174,10 +280,7 @@ class User(AbstractUser):
     def primary_product(self) -> LBCProduct:
         try:
             if self.active_subscription is not None:
-                product = get_primary_product_for_djstripe_subscription(
-                    self.active_subscription
-                )
-                return product
+                return self.membership.primary_product
         except:
             return None
 
@@ -191,15 +294,7 @@ class User(AbstractUser):
 
     @property
     def gifts_bought(self):
-        if self.stripe_customer is not None:
-            return (
-                self.stripe_customer.subscriptions.filter(
-                    metadata__gift_mode__isnull=False
-                )
-                .all()
-                .order_by("-created")
-            )
-        return list()
+        return self.membership.gifts_bought
 
     @property
     def gift_giver(self):
@@ -220,6 +315,7 @@ class User(AbstractUser):
             return self.stripe_customer, False
 
         customer = djstripe.models.Customer.create(subscriber=self)
+        self.clear_membership_cache()
         try:
             customer = customer._api_update(
                 name=str(self), metadata={"gdpr_email_consent": self.gdpr_email_consent}
@@ -353,7 +449,7 @@ class User(AbstractUser):
                 "staff": self.is_staff,
             },
             # Properties to be set on the event
-            "register": basic_posthog_event_properties,
+            "register": {**basic_posthog_event_properties},
         }
 
         if self.primary_product is not None:
@@ -385,3 +481,194 @@ class User(AbstractUser):
         user_data["set"].update(data)
 
         return user_data
+
+
+class GeocodedPostcode(models.Model):
+    """
+    Every postcode we've geocoded, so that re-geocoding (say, after
+    the cache is flushed) never has to go back to the APIs.
+    """
+
+    POSTCODES_IO = "postcodes.io"
+    MAPBOX = "mapbox"
+
+    postcode = models.CharField(max_length=20, help_text="Normalised postcode")
+    country = models.CharField(max_length=2, default="GB")
+    source = models.CharField(
+        max_length=20,
+        choices=[(POSTCODES_IO, "postcodes.io"), (MAPBOX, "Mapbox")],
+        default=POSTCODES_IO,
+    )
+    # The full postcodes.io result, for constituency codes and so on
+    result = models.JSONField(blank=True, null=True)
+    coordinates = gis_models.PointField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("postcode", "country"),)
+
+    def __str__(self):
+        return f"{self.postcode} ({self.country})"
+
+
+class OutboxEvent(models.Model):
+    """
+    A PostHog or Mailchimp side effect, queued so that views and webhooks
+    don't wait on third-party APIs. Sent by the `process_outbox` worker.
+    """
+
+    POSTHOG_CAPTURE = "posthog_capture"
+    MAILCHIMP_EVENT = "mailchimp_event"
+    MAILCHIMP_TAGS = "mailchimp_tags"
+
+    kind = models.CharField(
+        max_length=30,
+        choices=[
+            (POSTHOG_CAPTURE, "PostHog event"),
+            (MAILCHIMP_EVENT, "Mailchimp event"),
+            (MAILCHIMP_TAGS, "Mailchimp tags"),
+        ],
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    payload = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(sent_at__isnull=True),
+                name="outbox_pending_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for {self.user_id}"
+
+    @classmethod
+    def enqueue(cls, kind, user, **payload):
+        if user is None or user.pk is None:
+            return None
+        return cls.objects.create(kind=kind, user=user, payload=payload)
+
+
+class ShopifyOrder(models.Model):
+    """
+    A Shopify order waiting to be created, or the record of one that was.
+    Submitted in batches over one session by the `submit_shopify_orders` worker.
+    """
+
+    QUEUED = "queued"
+    CREATED = "created"
+    FAILED = "failed"
+    # Created in Shopify but not recorded here, so never retried automatically
+    REVIEW = "review"
+
+    status = models.CharField(
+        max_length=10,
+        choices=[
+            (QUEUED, "Queued"),
+            (CREATED, "Created"),
+            (FAILED, "Failed"),
+            (REVIEW, "Needs review"),
+        ],
+        default=QUEUED,
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    line_items = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder)
+    tags = models.JSONField(default=list, blank=True)
+    send_receipt = models.BooleanField(default=False)
+    reference = models.CharField(
+        max_length=255,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="What the order is for, e.g. a Stripe subscription ID, so it is only queued once",
+    )
+    shopify_order_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    submitted_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status="queued"),
+                name="shopify_order_pending_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Shopify order for {self.user_id} ({self.status})"
+
+
+class SubscriptionUpdateBatch(models.Model):
+    """
+    Running totals for a batch of `update_subscription` jobs, updated as each
+    job finishes, so the status page doesn't have to count the jobs.
+    """
+
+    id = models.UUIDField(primary_key=True)
+    options = models.JSONField(default=dict, blank=True)
+    total = models.PositiveIntegerField(default=0)
+    complete = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # Error message to number of failed jobs
+    errors = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Subscription update batch {self.id}"
+
+    @property
+    def finished(self):
+        return self.complete + self.failed
+
+    @property
+    def remaining(self):
+        return max(0, self.total - self.finished)
+
+    @staticmethod
+    def error_key(error):
+        return (error or "Unknown error")[:200]
+
+    @classmethod
+    def record_result(cls, batch_id, complete, error=None):
+        with transaction.atomic():
+            batch = cls.objects.select_for_update().filter(id=batch_id).first()
+            if batch is None:
+                return
+            if complete:
+                batch.complete += 1
+            else:
+                batch.failed += 1
+                key = cls.error_key(error)
+                batch.errors[key] = batch.errors.get(key, 0) + 1
+            batch.save(update_fields=["complete", "failed", "errors", "updated_at"])
+
+    @classmethod
+    def record_retry(cls, batch_id, error=None):
+        """
+        The failed job is replaced by a new one, which will be counted
+        when it finishes.
+        """
+        with transaction.atomic():
+            batch = cls.objects.select_for_update().filter(id=batch_id).first()
+            if batch is None:
+                return
+            batch.failed = max(0, batch.failed - 1)
+            key = cls.error_key(error)
+            if batch.errors.get(key, 0) > 1:
+                batch.errors[key] -= 1
+            else:
+                batch.errors.pop(key, None)
+            batch.save(update_fields=["failed", "errors", "updated_at"])
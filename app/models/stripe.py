@@ -1,15 +1,18 @@
 from typing import Any, Dict, List, Optional, Tuple
 
 import re
+import uuid
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 
 import djstripe.models
 import stripe
 from django import forms
+from django.core.cache import cache
 from django.core.validators import RegexValidator
 from django.db import models
-from django.db.models.functions import Length
+from django.db.models import Prefetch, prefetch_related_objects
+from django.db.models.functions import Upper
 from django.forms import RadioSelect
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
@@ -20,7 +23,6 @@ from djmoney.models.fields import Money, MoneyField
 from wagtail.admin.panels import FieldPanel
 from wagtail.snippets.models import register_snippet
 
-from app.utils import flatten_list
 from app.utils.books import get_current_book
 from app.utils.django import add_proxy_method
 from app.utils.python import diff_month
@@ -179,7 +181,11 @@ class LBCSubscription(djstripe.models.Subscription):
         donation_si: Optional[djstripe.models.SubscriptionItem] = None
 
     def _named_subscription_items(self):
-        sis = self.items.select_related("plan__product").all()
+        if "items" in getattr(self, "_prefetched_objects_cache", {}):
+            # Already loaded alongside the subscription, e.g. by MembershipSnapshot
+            sis = self.items.all()
+        else:
+            sis = self.items.select_related("plan__product").all()
 
         details = self.NamedSubscriptionItems()
 
@@ -323,6 +329,71 @@ class LBCSubscription(djstripe.models.Subscription):
 add_proxy_method(djstripe.models.Subscription, LBCSubscription, "lbc")
 
 
+def resolve_subscription_properties(subscriptions) -> List[LBCSubscription]:
+    """
+    Work out the derived properties the members admin shows (items, primary
+    product, plan price, membership) for a list of subscriptions in a fixed
+    number of queries, rather than several per subscription.
+
+    `shipping_zone` needs nothing more once these are loaded, as zones come
+    from the compiled zone table.
+    """
+    from app.models import MembershipPlanPrice, MembershipSnapshot
+
+    subscriptions = list(subscriptions)
+    # Skipped for relations the queryset already selected
+    prefetch_related_objects(
+        subscriptions,
+        "plan__product",
+        "customer__subscriber",
+        Prefetch(
+            "items",
+            queryset=djstripe.models.SubscriptionItem.objects.select_related(
+                "plan__product"
+            ),
+        ),
+    )
+
+    users = {}
+    for sub in subscriptions:
+        if sub.customer is not None and sub.customer.subscriber is not None:
+            users.setdefault(sub.customer.subscriber.pk, []).append(
+                sub.customer.subscriber
+            )
+    snapshots = MembershipSnapshot.load_for_users(
+        [same_user[0] for same_user in users.values()]
+    )
+    for pk, same_user in users.items():
+        for user in same_user:
+            user.__dict__.setdefault("membership", snapshots[pk])
+
+    prices = MembershipPlanPrice.from_sis(
+        [sub.membership_si for sub in subscriptions if sub.membership_si is not None]
+    )
+    for sub in subscriptions:
+        if sub.membership_si is not None:
+            sub.__dict__["membership_plan_price"] = prices[sub.membership_si.id]
+        else:
+            sub.__dict__["membership_plan_price"] = None
+
+        # As `get_primary_product_for_djstripe_subscription`
+        if sub.plan is not None:
+            sub.__dict__["primary_product"] = sub.plan.product
+        else:
+            si = next(
+                (
+                    si
+                    for si in sorted(sub.items.all(), key=lambda si: si.pk)
+                    if si.plan.product.name
+                    not in [SHIPPING_PRODUCT_NAME, DONATION_PRODUCT_NAME]
+                ),
+                None,
+            )
+            sub.__dict__["primary_product"] = si.plan.product if si else None
+
+    return subscriptions
+
+
 @register_snippet
 class LBCProduct(djstripe.models.Product):
     """
@@ -443,17 +514,9 @@ class ShippingZone(models.Model):
 
     @classmethod
     def get_for_country(self, iso_a2: str):
-        # Check for a zone that has this code
-        # If no zone, default to ROW pricing
-        # settings.DEFAULT_SHIPPING_PRICE
-        zone = (
-            ShippingZone.objects.filter(countries__icontains=iso_a2)
-            .order_by(Length("countries").asc())
-            .first()
-        )
-        if zone is None:
-            zone = ShippingZone.default_zone
-        return zone
+        # The zone listing this country with the fewest other countries,
+        # defaulting to ROW pricing
+        return shipping_zone_table().get_for_country(iso_a2)
 
     @property
     def country_codes(self):
@@ -462,14 +525,7 @@ class ShippingZone(models.Model):
             included = [c.code for c in self.countries]
         else:
             # ROW should exclude countries specified in other zones
-            all_zones = ShippingZone.objects.all()
-            countries_in_zones = {
-                getattr(c, "code")
-                for c in flatten_list(zone.countries for zone in list(all_zones))
-            }
-            included = [
-                c for c in list(set(self.all_country_codes) - countries_in_zones)
-            ]
+            included = shipping_zone_table().unzoned_country_codes
         return list(set(included).intersection(set(self.stripe_allowed_countries)))
 
     def is_country_included(self, iso_a2: str) -> bool:
@@ -480,27 +536,14 @@ class ShippingZone(models.Model):
     @classmethod
     @property
     def default_zone(self):
-        defined_row = ShippingZone.objects.filter(rest_of_world=True).first()
-        if defined_row:
-            if defined_row.code != self.row_code:
-                defined_row.code = self.row_code
-                defined_row.save()
-            return defined_row
-        return ShippingZone(
-            nickname="Rest Of World",
-            rest_of_world=True,
-            code=self.row_code,
-            countries=[],
-        )
+        return shipping_zone_table().default_zone
 
     @classmethod
     def get_for_code(cls, code: str):
         if code is not None:
-            try:
-                zone = ShippingZone.objects.get(code=code)
+            zone = shipping_zone_table().zones_by_code.get(code, None)
+            if zone is not None:
                 return zone
-            except:
-                pass
         return ShippingZone.default_zone
 
     stripe_allowed_countries = [
@@ -745,3 +788,175 @@ class ShippingZone(models.Model):
     all_country_codes = list(
         set(dict(django_countries).keys()).intersection(set(stripe_allowed_countries))
     )
+
+
+@dataclass
+class ShippingZoneTable:
+    """
+    Every shipping zone, compiled into lookups that need no queries.
+    """
+
+    version: str
+    zones_by_code: Dict[str, ShippingZone]
+    zones_by_country: Dict[str, ShippingZone]
+    default_zone: ShippingZone
+    # Countries not listed in any zone, which ROW covers
+    unzoned_country_codes: List[str]
+
+    def get_for_country(self, iso_a2: str) -> ShippingZone:
+        return self.zones_by_country.get(str(iso_a2).upper(), self.default_zone)
+
+
+def compile_shipping_zone_table(version) -> ShippingZoneTable:
+    zones = list(ShippingZone.objects.order_by("id"))
+
+    defined_row = next((zone for zone in zones if zone.rest_of_world), None)
+    if defined_row:
+        if defined_row.code != ShippingZone.row_code:
+            defined_row.code = ShippingZone.row_code
+            defined_row.save()
+        default_zone = defined_row
+    else:
+        default_zone = ShippingZone(
+            nickname="Rest Of World",
+            rest_of_world=True,
+            code=ShippingZone.row_code,
+            countries=[],
+        )
+
+    # A country in several zones belongs to the most specific one:
+    # the zone with the shortest list of countries, as stored
+    zones_by_country = {}
+    for zone in sorted(
+        zones, key=lambda zone: len(",".join(c.code for c in zone.countries))
+    ):
+        for country in zone.countries:
+            zones_by_country.setdefault(country.code, zone)
+
+    return ShippingZoneTable(
+        version=version,
+        zones_by_code={zone.code: zone for zone in zones},
+        zones_by_country=zones_by_country,
+        default_zone=default_zone,
+        unzoned_country_codes=list(
+            set(ShippingZone.all_country_codes) - set(zones_by_country)
+        ),
+    )
+
+
+SHIPPING_ZONES_VERSION_KEY = "shipping_zones.version"
+_shipping_zone_table: Optional[ShippingZoneTable] = None
+
+
+def shipping_zone_table() -> ShippingZoneTable:
+    """
+    The compiled zone table, built once per process and rebuilt when any
+    process saves or deletes a zone.
+    """
+    global _shipping_zone_table
+    version = cache.get(SHIPPING_ZONES_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(SHIPPING_ZONES_VERSION_KEY, version, None)
+    table = _shipping_zone_table
+    if table is None or table.version != version:
+        table = _shipping_zone_table = compile_shipping_zone_table(version)
+    return table
+
+
+def invalidate_shipping_zones():
+    global _shipping_zone_table
+    _shipping_zone_table = None
+    cache.set(SHIPPING_ZONES_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+class StripePromotionCode(models.Model):
+    """
+    The fields of a Stripe promotion code that gift card checks need, kept in
+    sync by webhooks and `sync_promotion_codes` so checks don't hit Stripe.
+    """
+
+    id = models.CharField(max_length=255, primary_key=True)
+    code = models.CharField(max_length=255)
+    active = models.BooleanField(default=True)
+    max_redemptions = models.PositiveIntegerField(null=True, blank=True)
+    times_redeemed = models.PositiveIntegerField(default=0)
+    coupon_id = models.CharField(max_length=255, blank=True, default="")
+    metadata = models.JSONField(default=dict, blank=True)
+    created = models.DateTimeField(null=True, blank=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Codes are looked up case-insensitively, with `code__iexact`
+            models.Index(Upper("code"), name="stripepromotioncode_code_upper"),
+        ]
+
+    def __str__(self):
+        return self.code
+
+    @classmethod
+    def from_stripe_data(cls, data):
+        coupon = data.get("coupon", None)
+        return cls(
+            id=data["id"],
+            code=data["code"],
+            active=data.get("active", True),
+            max_redemptions=data.get("max_redemptions", None),
+            times_redeemed=data.get("times_redeemed", 0),
+            coupon_id=(coupon.get("id", "") if isinstance(coupon, dict) else coupon)
+            or "",
+            metadata=dict(data.get("metadata", None) or {}),
+            created=datetime.fromtimestamp(data["created"], tz=timezone.utc)
+            if data.get("created", None)
+            else None,
+        )
+
+    @classmethod
+    def sync_from_stripe_data(cls, data):
+        return cls.bulk_sync_from_stripe_data([data])[0]
+
+    @classmethod
+    def bulk_sync_from_stripe_data(cls, data):
+        return cls.objects.bulk_create(
+            [cls.from_stripe_data(promo_code) for promo_code in data],
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[
+                "code",
+                "active",
+                "max_redemptions",
+                "times_redeemed",
+                "coupon_id",
+                "metadata",
+                "created",
+                "synced_at",
+            ],
+        )
+
+
+class StripeSyncCheckpoint(models.Model):
+    """
+    Progress through a long Stripe listing, so an interrupted run can resume.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    cursor = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        help_text="ID of the last object fully processed by the current run",
+    )
+    since = models.DateTimeField(
+        null=True, blank=True, help_text="Only objects created after this"
+    )
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def in_progress(self):
+        return self.cursor is not None
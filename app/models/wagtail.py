@@ -1,6 +1,5 @@
 from typing import Optional
 
-import time
 import pytz
 from datetime import datetime
 from django.utils import timezone
@@ -8,9 +7,11 @@ from django.utils import timezone
 import djstripe.models
 import orjson
 import shopify
+from dateutil.parser import parse
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GistIndex
 from django.core.cache import cache
 from django.core.validators import MinValueValidator
 from django.db import models
@@ -48,14 +49,26 @@ from app.models.blocks import *
 from app.models.circle import CircleEvent
 from app.utils.abstract_model_querying import abstract_page_query_filter
 from app.utils.books import get_current_book
-from app.utils.cache import django_cached
-from app.utils.shopify import metafields_to_dict
+from app.utils.cache import django_cached, django_cached_key
+from app.utils.geojson import feature_collection, with_distance
+from app.utils.shopify import (
+    ShopifyRateLimiter,
+    bulk_product_metafields,
+    iterate_collection_products,
+    metafields_to_dict,
+)
 from app.utils.stripe import create_shipping_zone_metadata, get_shipping_product
 
 from .stripe import LBCProduct, ShippingZone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.gis.db import models as gis_models
-from app.utils.geo import postcode_geo, point_from_postcode_result, address_geo
+from app.utils.geo import (
+    address_geo,
+    as_geography,
+    nearest,
+    point_from_postcode_result,
+    postcode_geo,
+)
 from django.core.exceptions import ValidationError
 from django_countries import countries
 from django_countries.fields import CountryField
@@ -132,6 +145,12 @@ class ReadingGroup(ClusterableModel, models.Model):
 
     class Meta:
         ordering = ["next_event"]
+        indexes = [
+            # Ordered by `nearest`
+            GistIndex(
+                as_geography("coordinates"), name="readinggroup_coordinates_geog"
+            ),
+        ]
 
     def __str__(self):
         if not self.next_event:
@@ -192,7 +211,7 @@ class ReadingGroup(ClusterableModel, models.Model):
                 "contact_link_or_email": self.contact_link_or_email,
                 "more_information": self.more_information,
                 "postcode": self.in_person_postcode,
-                "all_dates": [d.isoformat() for d in self.upcoming_dates],
+                "all_dates": [d.isoformat() for d in upcoming],
             },
             }
         
@@ -418,13 +437,19 @@ class MembershipPlanPrice(Orderable, ClusterableModel):
             return (self.plan.deliveries_per_year / 365.25) * self.interval_count
         return self.plan.deliveries_per_year
 
+    def ships_free_to(self, zone) -> bool:
+        # Reads prefetched zones when there are some, e.g. in the price matrix
+        return any(
+            free_zone.code == zone.code for free_zone in self.free_shipping_zones.all()
+        )
+
     def shipping_fee(self, zone) -> Money:
-        if self.free_shipping_zones.filter(code=zone.code).exists():
+        if self.ships_free_to(zone):
             return Money(0, zone.rate_currency)
         return zone.rate * self.deliveries_per_billing_period
 
     def equivalent_monthly_shipping_fee(self, zone) -> Money:
-        if self.free_shipping_zones.filter(code=zone.code).exists():
+        if self.ships_free_to(zone):
             return Money(0, zone.rate_currency)
         return (
             zone.rate
@@ -621,6 +646,35 @@ class MembershipPlanPrice(Orderable, ClusterableModel):
             ).first()
         return current_plan_price
 
+    @classmethod
+    def from_sis(cls, sis) -> dict:
+        """
+        `from_si` for many subscription items at once, keyed by item ID,
+        from a single load of the prices.
+        """
+        # Model ordering, so ties resolve like `from_si`'s `.first()`
+        prices = list(cls.objects.prefetch_related("products"))
+        by_plan = {}
+        for price in prices:
+            for product in price.products.all():
+                by_plan.setdefault(
+                    (price.interval, price.interval_count, product.djstripe_id), price
+                )
+
+        resolved = {}
+        for si in sis:
+            ids = {
+                str(si.metadata.get("wagtail_price")),
+                str(si.plan.metadata.get("wagtail_price")),
+            }
+            resolved[si.id] = next(
+                (price for price in prices if str(price.id) in ids),
+                by_plan.get(
+                    (si.plan.interval, si.plan.interval_count, si.plan.product.djstripe_id)
+                ),
+            )
+        return resolved
+
     @property
     def discount_percent(self):
         if self.interval != "year":
@@ -792,6 +846,23 @@ class BlogPage(WagtailCacheMixin, ArticleSeoMixin, Page):
     seo_image_sources = ArticleSeoMixin.seo_image_sources + ["feed_image"]
 
 
+class ShopifySyncState(models.Model):
+    """
+    High-water mark for incremental syncs of a Shopify collection.
+    """
+
+    collection_id = models.CharField(max_length=300, unique=True)
+    last_updated_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="The most recent product `updated_at` seen in this collection",
+    )
+    last_synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Shopify collection {self.collection_id}"
+
+
 def shopify_product_id_key(page):
     return page.shopify_product_id
 
@@ -868,6 +939,18 @@ class BaseShopifyProductPage(ArticleSeoMixin, Page):
             instance.save_revision().publish()
         return instance
 
+    @classmethod
+    def get_changed_fields(cls, instance, args):
+        """
+        The subset of `args` that differ from what's already stored on `instance`,
+        comparing values the way they'd come back out of the database.
+        """
+        return {
+            key: value
+            for key, value in args.items()
+            if cls._meta.get_field(key).to_python(value) != getattr(instance, key)
+        }
+
     @classmethod
     def update_instance_for_product(cls, product, metafields):
         update_args = {
@@ -876,15 +959,34 @@ class BaseShopifyProductPage(ArticleSeoMixin, Page):
             # Keep the originally published page slug for SEO reasons
             if key != "slug"
         }
-        cls.objects.filter(shopify_product_id=product.id).update(**update_args)
         instance = cls.objects.filter(shopify_product_id=product.id).first()
-        if instance is not None:
-            if product.attributes.get("status", "draft") == "draft":
+        if instance is None:
+            return None
+
+        is_draft = product.attributes.get("status", "draft") == "draft"
+        changed_args = cls.get_changed_fields(instance, update_args)
+        if not changed_args and instance.live != is_draft:
+            # Nothing to write, so don't churn revisions or the page cache
+            return instance
+
+        cls.objects.filter(shopify_product_id=product.id).update(**changed_args)
+        instance = cls.objects.filter(shopify_product_id=product.id).first()
+        if is_draft:
+            if instance.live:
                 instance.unpublish()
-            else:
-                instance.save_revision().publish()
+        else:
+            instance.save_revision().publish()
         return instance
 
+    @classmethod
+    def sync_product(cls, product, metafields):
+        cls.clear_shopify_product_cache(product.id)
+
+        if cls.objects.filter(shopify_product_id=product.id).exists():
+            return cls.update_instance_for_product(product, metafields)
+        else:
+            return cls.create_instance_for_product(product, metafields)
+
     @classmethod
     def sync_from_shopify_product_id(cls, shopify_product_id):
         with shopify.Session.temp(
@@ -894,10 +996,17 @@ class BaseShopifyProductPage(ArticleSeoMixin, Page):
             metafields = product.metafields()
             metafields = metafields_to_dict(metafields)
 
-            if cls.objects.filter(shopify_product_id=shopify_product_id).exists():
-                return cls.update_instance_for_product(product, metafields)
-            else:
-                return cls.create_instance_for_product(product, metafields)
+            return cls.sync_product(product, metafields)
+
+    @classmethod
+    def clear_shopify_product_cache(cls, shopify_product_id):
+        # Pages rendering this product are evicted when it is (un)published
+        cache.delete_many(
+            [
+                django_cached_key(ns, str, shopify_product_id)
+                for ns in ("shopify_product", "shopify_product_metafields")
+            ]
+        )
 
     @property
     @django_cached("shopify_product", get_key=shopify_product_id_key)
@@ -928,19 +1037,50 @@ class BaseShopifyProductPage(ArticleSeoMixin, Page):
                 return {}
 
     @classmethod
-    def sync_shopify_products_to_pages(cls, collection_id=None):
+    def sync_shopify_products_to_pages(cls, collection_id=None, incremental=False):
+        """
+        Sync every product in the collection, or with `incremental=True` only those
+        updated since the last sync of this collection.
+
+        Incremental syncs can't see products that were removed from, or added to,
+        the collection without otherwise being edited; a full sync catches those.
+        """
         if collection_id is None:
             collection_id = cls.shopify_collection_id
+
+        sync_state, _ = ShopifySyncState.objects.get_or_create(
+            collection_id=str(collection_id)
+        )
+        filters = {}
+        if incremental and sync_state.last_updated_at is not None:
+            filters["updated_at_min"] = sync_state.last_updated_at.isoformat()
+
+        last_updated_at = sync_state.last_updated_at
         with shopify.Session.temp(
             settings.SHOPIFY_DOMAIN, "2021-10", settings.SHOPIFY_PRIVATE_APP_PASSWORD
         ):
-            cache.clear()
-            collection_listing = shopify.CollectionListing.find(collection_id)
-            product_ids = collection_listing.product_ids(limit=250)
-            for product_id in product_ids:
-                cls.sync_from_shopify_product_id(product_id)
-                # Very simple solution to Shopify 2 calls/second ratelimiting
-                time.sleep(0.5)
+            limiter = ShopifyRateLimiter()
+            for products in iterate_collection_products(
+                collection_id, limiter, **filters
+            ):
+                metafields = bulk_product_metafields(
+                    [product.id for product in products]
+                )
+                for product in products:
+                    if product.id not in metafields:
+                        metafields[product.id] = metafields_to_dict(
+                            limiter.call(product.metafields, limit=250)
+                        )
+                    cls.sync_product(product, metafields[product.id])
+
+                    updated_at = parse(product.attributes.get("updated_at"))
+                    if last_updated_at is None or updated_at > last_updated_at:
+                        last_updated_at = updated_at
+
+        # Only move the watermark once the whole collection has synced,
+        # since products aren't paged in updated_at order
+        sync_state.last_updated_at = last_updated_at
+        sync_state.save()
 
     @property
     def seo_description(self) -> str:
@@ -1227,23 +1367,12 @@ class ReadingGroupsPage(WagtailCacheMixin, Page):
         context["layers"] = {}
 
         # Reading Groups
-        reading_groups = list(
-            ReadingGroup.objects.filter(is_approved=True)
-            .order_by("group_name")
-            .all()
-        )
-        context["reading_groups"] = reading_groups
+        context["reading_groups"] = list(cls.get_reading_groups())
 
+        # The features themselves are served, cached, from the map layer endpoint
         context["sources"]["reading_groups"] = {
             "type": "geojson",
-            "data": {
-                "type": "FeatureCollection",
-                "features": [
-                    group.as_geojson_feature
-                    for group in context["reading_groups"]
-                    if group.as_geojson_feature.get("geometry", None) is not None
-                ],
-            },
+            "data": reverse("map_layer", args=["reading_groups"]),
         }
 
         context["layers"].update(
@@ -1288,6 +1417,31 @@ class ReadingGroupsPage(WagtailCacheMixin, Page):
 
         return context
 
+    @classmethod
+    def get_reading_groups(cls):
+        return (
+            ReadingGroup.objects.filter(is_approved=True)
+            .prefetch_related("additional_dates")
+            .order_by("group_name")
+        )
+
+    @classmethod
+    def get_nearest_features(cls, point, limit=5):
+        return [
+            with_distance(group.as_geojson_feature, group.distance)
+            for group in nearest(cls.get_reading_groups(), point, limit)
+        ]
+
+    @classmethod
+    def get_geojson(cls, bbox=None):
+        reading_groups = cls.get_reading_groups()
+        if bbox is not None:
+            # Bounding box containment can use the spatial index on coordinates
+            reading_groups = reading_groups.filter(coordinates__contained=bbox)
+        return feature_collection(
+            group.as_geojson_feature for group in reading_groups
+        )
+
     def get_context(self, request, *args, **kwargs):
         context = super().get_context(request, *args, **kwargs)
         context.update(ReadingGroupsPage.get_map_context())
@@ -1308,22 +1462,12 @@ class MapPage(WagtailCacheMixin, Page):
         context["layers"] = {}
 
         # Events
-        context["events"] = list(
-            CircleEvent.objects.filter(starts_at__gte=datetime.now())
-            .order_by("starts_at")
-            .all()
-        )
+        context["events"] = list(cls.get_events())
 
+        # The features themselves are served, cached, from the map layer endpoint
         context["sources"]["events"] = {
             "type": "geojson",
-            "data": {
-                "type": "FeatureCollection",
-                "features": [
-                    event.as_geojson_feature
-                    for event in context["events"]
-                    if event.as_geojson_feature.get("geometry", None) is not None
-                ],
-            },
+            "data": reverse("map_layer", args=["events"]),
         }
 
         context["layers"].update(
@@ -1387,7 +1531,36 @@ class MapPage(WagtailCacheMixin, Page):
 
         return context
 
+    @classmethod
+    def get_events(cls):
+        return CircleEvent.objects.filter(starts_at__gte=datetime.now()).order_by(
+            "starts_at"
+        )
+
+    @classmethod
+    def get_nearest_features(cls, point, limit=5):
+        return [
+            with_distance(event.as_geojson_feature, event.distance)
+            for event in nearest(cls.get_events(), point, limit)
+            if event.as_geojson_feature is not None
+        ]
+
+    @classmethod
+    def get_geojson(cls, bbox=None):
+        events = cls.get_events()
+        if bbox is not None:
+            # Bounding box containment can use the spatial index on coordinates
+            events = events.filter(coordinates__contained=bbox)
+        return feature_collection(events.values_list("as_geojson_feature", flat=True))
+
     def get_context(self, request, *args, **kwargs):
         context = super().get_context(request, *args, **kwargs)
         context.update(MapPage.get_map_context())
         return context
+
+
+# Map layers served by MapLayerView, keyed by their map source ID
+MAP_LAYERS = {
+    "reading_groups": ReadingGroupsPage.get_geojson,
+    "events": MapPage.get_geojson,
+}
@@ -0,0 +1,120 @@
+from collections import defaultdict
+from datetime import timedelta
+
+import posthog
+from django.db import transaction
+from django.utils import timezone
+from sentry_sdk import capture_exception
+
+from app.analytics import send_posthog_events
+from app.models import OutboxEvent
+from app.utils.mailchimp import (
+    mailchimp_contact_for_user,
+    send_mailchimp_event,
+    send_mailchimp_tags,
+)
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_DELAY = timedelta(seconds=30)
+OUTBOX_MAX_RETRY_DELAY = timedelta(hours=6)
+OUTBOX_RETENTION = timedelta(days=30)
+# How long a worker has to send the events it claims before they're due again
+OUTBOX_LEASE = timedelta(minutes=15)
+
+
+def pending_outbox_events():
+    return OutboxEvent.objects.filter(
+        sent_at=None,
+        attempts__lt=OUTBOX_MAX_ATTEMPTS,
+        next_attempt_at__lte=timezone.now(),
+    )
+
+
+def retry_delay(attempts):
+    return min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+
+
+def claim_outbox_events(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Take a batch of due events off the queue for this worker.
+
+    The events are leased rather than locked for the length of the send,
+    so no transaction is held open while PostHog and Mailchimp respond.
+    """
+    with transaction.atomic():
+        # Skip rows another worker is claiming
+        events = list(
+            pending_outbox_events()
+            .select_for_update(skip_locked=True, of=("self",))
+            .select_related("user")
+            .order_by("id")[:batch_size]
+        )
+        leased_until = timezone.now() + OUTBOX_LEASE
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(
+            next_attempt_at=leased_until
+        )
+    for event in events:
+        event.next_attempt_at = leased_until
+    return events
+
+
+def process_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Send a batch of queued events, grouped by user so that each user is
+    identified in PostHog and upserted in Mailchimp once per batch rather
+    than once per event. Returns the number of events sent.
+    """
+    events = claim_outbox_events(batch_size)
+    if not events:
+        return 0
+
+    events_by_user = defaultdict(list)
+    for event in events:
+        events_by_user[event.user].append(event)
+
+    for user, user_events in events_by_user.items():
+        send_user_events(user, user_events)
+
+    OutboxEvent.objects.bulk_update(
+        events, ["attempts", "next_attempt_at", "sent_at", "last_error"]
+    )
+
+    # The PostHog client sends in the background, so push this batch out now
+    posthog.flush()
+    return sum(1 for event in events if event.sent_at is not None)
+
+
+def send_user_events(user, events):
+    try:
+        posthog_events = [
+            event for event in events if event.kind == OutboxEvent.POSTHOG_CAPTURE
+        ]
+        if posthog_events:
+            send_posthog_events(user, posthog_events)
+
+        mailchimp_events = [
+            event
+            for event in events
+            if event.kind in (OutboxEvent.MAILCHIMP_EVENT, OutboxEvent.MAILCHIMP_TAGS)
+        ]
+        if mailchimp_events:
+            if mailchimp_contact_for_user(user) is None:
+                raise ValueError(f"Couldn't create a Mailchimp contact for {user}")
+            for event in mailchimp_events:
+                if event.kind == OutboxEvent.MAILCHIMP_TAGS:
+                    send_mailchimp_tags(user, **event.payload)
+                else:
+                    send_mailchimp_event(user, **event.payload)
+                event.sent_at = timezone.now()
+    except Exception as e:
+        capture_exception(e)
+        for event in events:
+            if event.sent_at is None:
+                event.attempts += 1
+                event.last_error = str(e)
+                event.next_attempt_at = timezone.now() + retry_delay(event.attempts)
+
+
+def prune_outbox():
+    OutboxEvent.objects.filter(sent_at__lt=timezone.now() - OUTBOX_RETENTION).delete()
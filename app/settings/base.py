@@ -100,6 +100,7 @@ MIDDLEWARE += [
     "livereload.middleware.LiveReloadScript",
     "app.middleware.update_stripe_customer_subscription",
     "app.middleware.frontend_backend_posthog_identity_linking",
+    "app.middleware.track_cache_dependencies",
 ]
 
 ROOT_URLCONF = "app.urls"
@@ -448,6 +449,9 @@ JOBS = {
     "update_subscription": {
         "tasks": ["app.management.commands.update_subscription.run"],
     },
+    "export_members": {
+        "tasks": ["app.exports.run_member_export"],
+    },
 }
 
 
@@ -458,14 +462,39 @@ WAGTAIL_CACHE = os.getenv("WAGTAIL_CACHE", False)
 
 INSTALLED_APPS += ["wagtailcache"]
 
+# The shared cache tier is Redis where available, so that every web and worker
+# process sees the same cache, falling back to the local filesystem.
+if os.getenv("REDIS_URL"):
+    CACHE_SHARED_BACKEND = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("REDIS_URL"),
+    }
+else:
+    CACHE_SHARED_BACKEND = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CACHE_LOCATION", os.path.join(BASE_DIR, "cache")),
+    }
+
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
-        "LOCATION": os.path.join(BASE_DIR, "cache"),
+        "BACKEND": "app.utils.cache_backends.TieredCache",
         "KEY_PREFIX": "wagtailcache",
         "TIMEOUT": int(
             os.getenv("WAGTAIL_CACHE_TIMEOUT_SECONDS", 60 * 60 * 24)
         ),  # in seconds
+        "OPTIONS": {
+            "SHARED": CACHE_SHARED_BACKEND,
+            # Set to 0 to disable the in-process tier
+            "LOCAL_TIMEOUT": int(os.getenv("CACHE_LOCAL_TIMEOUT_SECONDS", 30)),
+            "LOCAL_MAX_ENTRIES": int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", 1000)),
+            # Cache bookkeeping that every process must see immediately
+            "LOCAL_EXCLUDE_KEYS": [
+                "keyring",
+                "cache_dependency.",
+                "map_layer_version.",
+                "posthog_alias_count.",
+            ],
+        },
     }
 }
 
@@ -38,6 +38,8 @@ if os.getenv("AWS_S3_REGION_NAME"):
     # can be ignored
     AWS_S3_CUSTOM_DOMAIN = os.getenv("AWS_S3_CUSTOM_DOMAIN")
     MEDIA_URL = os.getenv("MEDIA_URL")
+    # Member exports are only downloaded through the admin, never public
+    MEMBER_EXPORT_STORAGE = "app.storage.PrivateDigitalOceanSpacesStorage"
 else:
     MEDIA_ROOT = os.getenv(MEDIA_ROOT)
     MEDIA_URL = os.getenv("MEDIA_URL", "/media/")
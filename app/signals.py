@@ -1,16 +1,64 @@
 import shopify
 import stripe
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from djstripe import webhooks
 from djstripe.models import Customer
 from sentry_sdk import capture_exception
 from shopify_webhook.signals import products_create, products_delete, products_update
-from wagtail import hooks
+from wagtail.models import Page
+from wagtail.signals import page_published, page_unpublished
 
 from app import analytics
-from app.models.wagtail import BookPage
+from app.models.circle import CircleEvent
+from app.models.stripe import ShippingZone, invalidate_shipping_zones
+from app.models.wagtail import (
+    BookPage,
+    EventDate,
+    MembershipPlanPage,
+    MembershipPlanPrice,
+    ReadingGroup,
+)
+from app.utils.cache import (
+    instance_dependency,
+    invalidate_cache_dependencies,
+    is_cache_dependency,
+    model_dependency,
+    page_dependency,
+)
+from app.utils.geojson import invalidate_map_layers
 from app.utils.mailchimp import tag_user_in_mailchimp
-from app.utils.stripe import gift_recipient_subscription_from_code
+from app.utils.price_matrix import invalidate_price_matrix
+from app.utils.stripe import (
+    gift_recipient_subscription_from_code,
+    mark_stripe_customer_synced,
+    sync_promotion_code,
+)
+
+
+@webhooks.handler(
+    "customer.created",
+    "customer.updated",
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+)
+def remember_stripe_customer_sync(event, **kwargs):
+    # Handlers for full event types run after dj-stripe's "customer" and
+    # "customer.subscription" handlers, so the data has been synced by now
+    object = event.data.get("object", {})
+    if object.get("object", None) == "customer":
+        mark_stripe_customer_synced(object.get("id", None))
+    else:
+        mark_stripe_customer_synced(object.get("customer", None))
+
+
+@webhooks.handler("promotion_code")
+def index_promotion_code(event, **kwargs):
+    try:
+        sync_promotion_code(event.data.get("object", {}))
+    except Exception as e:
+        capture_exception(e)
 
 
 @webhooks.handler("customer.subscription.deleted")
@@ -92,13 +140,64 @@ def sync(*args, data: shopify.Product, **kwargs):
     BookPage.objects.filter(shopify_product_id=product_id).delete()
 
 
-from wagtailcache.cache import clear_cache
+@receiver(page_published)
+def invalidate_published_page(sender, instance, **kwargs):
+    tags = [page_dependency(instance.id)]
+    if instance.first_published_at == instance.last_published_at:
+        # A newly live page can show up in menus and listings
+        # that have never loaded it before
+        tags += [model_dependency(sender)]
+        parent = instance.get_parent()
+        if parent is not None:
+            tags += [page_dependency(parent.id)]
+    invalidate_cache_dependencies(*tags)
+
+
+@receiver(page_unpublished)
+def invalidate_unpublished_page(sender, instance, **kwargs):
+    invalidate_cache_dependencies(page_dependency(instance.id))
+
+
+@receiver(post_save)
+def invalidate_saved_snippet(sender, instance, created=False, **kwargs):
+    # Pages are invalidated when published, not on every draft save
+    if issubclass(sender, Page) or not is_cache_dependency(sender):
+        return
+    tags = [instance_dependency(instance)]
+    if created:
+        tags += [model_dependency(sender)]
+    invalidate_cache_dependencies(*tags)
+
+
+@receiver(post_delete)
+def invalidate_deleted_dependency(sender, instance, **kwargs):
+    if is_cache_dependency(sender):
+        invalidate_cache_dependencies(instance_dependency(instance))
+
+
+@receiver(post_save, sender=ReadingGroup)
+@receiver(post_delete, sender=ReadingGroup)
+@receiver(post_save, sender=EventDate)
+@receiver(post_delete, sender=EventDate)
+def invalidate_reading_groups_map_layer(*args, **kwargs):
+    invalidate_map_layers("reading_groups")
+
+
+@receiver(post_save, sender=CircleEvent)
+@receiver(post_delete, sender=CircleEvent)
+def invalidate_events_map_layer(*args, **kwargs):
+    invalidate_map_layers("events")
+
+
+@receiver(post_save, sender=ShippingZone)
+@receiver(post_delete, sender=ShippingZone)
+def invalidate_shipping_zone_table(*args, **kwargs):
+    invalidate_shipping_zones()
 
 
-@hooks.register("after_create_page")
-@hooks.register("after_edit_page")
-@hooks.register("after_publish_page")
-@hooks.register("after_unpublish_page")
-@hooks.register("after_delete_page")
-def clear_wagtailcache(*args, **kwargs):
-    clear_cache()
+@receiver(page_published, sender=MembershipPlanPage)
+@receiver(page_unpublished, sender=MembershipPlanPage)
+@receiver(post_save, sender=MembershipPlanPrice)
+@receiver(post_delete, sender=MembershipPlanPrice)
+def invalidate_price_matrix_on_change(*args, **kwargs):
+    invalidate_price_matrix()
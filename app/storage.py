@@ -31,3 +31,8 @@ class DigitalOceanSpacesStorage(S3Boto3Storage):
             fragment=url_parts.fragment,
         )
         return url_parts.geturl()
+
+
+class PrivateDigitalOceanSpacesStorage(DigitalOceanSpacesStorage):
+    default_acl = "private"
+    querystring_auth = True
@@ -1,24 +1,74 @@
+from types import SimpleNamespace
+
+import os
 import random
 import string
 import time
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from http import HTTPStatus
+from io import BytesIO
 from multiprocessing.sharedctypes import Value
+from unittest import mock
 
 import djstripe.models
-from django.test import TestCase
+from django.contrib.gis.geos import Point
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django_dbq.models import Job
 from djmoney.money import Money
 from djstripe.enums import ProductType
-
-from app.forms import UpgradeAction, UpgradeForm
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from app import analytics, middleware
+from app.batch_updates import (
+    BATCH_UPDATE_JOB_LEASE,
+    BATCH_UPDATE_QUEUE,
+    batch_progress,
+    claim_job,
+)
+from app.exports import iter_resolved_subscriptions, write_member_export
+from app.forms import BatchUpdateSubscriptionsForm, UpgradeAction, UpgradeForm
+from app.fulfilment import pending_shopify_orders, submit_shopify_orders
 from app.models import *
+from app.models.stripe import StripePromotionCode
+from app.outbox import claim_outbox_events, process_outbox
+from app.utils.cache import (
+    get_dependency_cache,
+    invalidate_cache_dependencies,
+    page_dependency,
+    register_cache_dependencies,
+)
+from app.utils.cache_backends import TieredCache
+from app.utils.geo import bulk_geocode_postcodes
+from app.utils.http import (
+    DEFAULT_TIMEOUT,
+    PooledSession,
+    http_metrics,
+    reset_http_metrics,
+)
+from app.utils.price_matrix import build_price_matrix
 from app.utils.python import uid
+from app.utils.shopify import (
+    ShopifyRateLimiter,
+    bulk_product_metafields,
+    queue_shopify_order,
+)
 from app.utils.stripe import (
+    SharedStripeRateLimiter,
     configure_gift_giver_subscription_and_code,
     create_gift_recipient_subscription,
     create_gift_subscription_and_promo_code,
+    forget_stripe_object,
+    is_real_gift_code,
+    is_redeemable_gift_code,
     recreate_one_off_stripe_price,
+    retrieve_stripe_object,
+    start_stripe_request_cache,
+    stop_stripe_request_cache,
 )
 from app.views import (
     CompletedGiftPurchaseView,
@@ -27,11 +77,14 @@ from app.views import (
     SubscriptionCheckoutView,
     UpgradeView,
 )
+from app.wagtail_hooks import CustomerAdmin
 
 
 class PlansAndShippingTestCase(TestCase):
     def setUp(self):
         ShippingZone.objects.all().delete()
+        # Zones from earlier tests were rolled back without any signals
+        invalidate_shipping_zones()
 
     # No zone, ROW should include all acceptable countries
     # and all codes are cool with stripe
@@ -78,6 +131,102 @@ class PlansAndShippingTestCase(TestCase):
         calculated_zone = ShippingZone.get_for_country("FR")
         self.assertEqual(calculated_zone, expected_zone)
 
+    def test_zone_lookups_are_compiled_once(self):
+        zone = ShippingZone.objects.create(
+            nickname="Test", code="EU", countries=["FR", "DE"]
+        )
+        ShippingZone.get_for_country("FR")
+        with self.assertNumQueries(0):
+            self.assertEqual(ShippingZone.get_for_country("de"), zone)
+            self.assertEqual(ShippingZone.get_for_code("EU"), zone)
+            self.assertNotIn("FR", ShippingZone.default_zone.country_codes)
+
+        zone.countries = ["FR"]
+        zone.save()
+        self.assertEqual(ShippingZone.get_for_country("DE").code, ShippingZone.row_code)
+
+    def test_price_matrix_has_every_zone(self):
+        ShippingZone.objects.create(
+            nickname="Test", code="EU", countries=["FR"], rate=Money(3, "GBP")
+        )
+        matrix = build_price_matrix()
+        self.assertEqual(matrix["countries"]["FR"], "EU")
+        self.assertEqual(matrix["default_zone"], ShippingZone.row_code)
+        self.assertSetEqual(set(matrix["zones"]), {"EU", ShippingZone.row_code})
+
+    def test_shipping_cost_frame_renders_for_zone(self):
+        product = LBCProduct.objects.create(
+            id="prod_shipping_frame", name="Some Product", type=ProductType.service
+        )
+        plan = MembershipPlanPage(
+            title="Shipping frame plan",
+            slug="shipping-frame-plan",
+            deliveries_per_year=12,
+            prices=[
+                MembershipPlanPrice(
+                    price=Money(10, "GBP"), interval="month", interval_count=1
+                ),
+            ],
+        )
+        Page.get_first_root_node().add_child(instance=plan)
+        ShippingZone.objects.create(
+            nickname="Test", code="EU", countries=["FR"], rate=Money(3, "GBP")
+        )
+
+        response = self.client.get(
+            reverse(
+                "shippingcosts",
+                kwargs={
+                    "price_id": plan.prices.first().id,
+                    "product_id": product.id,
+                    "zone_code": "EU",
+                },
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertContains(response, 'id="shipping-costs"')
+        self.assertContains(response, "13")
+
+        # Unknown zones share the rest of the world's cache entry
+        with mock.patch("app.views.cache") as cache:
+            cache.get.return_value = None
+            for zone_code in ("NOWHERE", "ELSEWHERE"):
+                self.client.get(
+                    reverse(
+                        "shippingcosts",
+                        kwargs={
+                            "price_id": plan.prices.first().id,
+                            "product_id": product.id,
+                            "zone_code": zone_code,
+                        },
+                    )
+                )
+        keys = {call.args[0] for call in cache.set.call_args_list}
+        self.assertEqual(len(keys), 1)
+        self.assertIn(f".{ShippingZone.row_code}.", keys.pop())
+
+    def test_old_shipping_cost_urls_redirect_to_their_zone(self):
+        ShippingZone.objects.create(nickname="Test", code="EU", countries=["FR"])
+        response = self.client.get(
+            reverse(
+                "shippingcosts_for_country",
+                kwargs={"price_id": 1, "product_id": "prod_test", "country_id": "FR"},
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.FOUND)
+        self.assertTrue(
+            response["Location"].startswith(
+                reverse(
+                    "shippingcosts",
+                    kwargs={
+                        "price_id": 1,
+                        "product_id": "prod_test",
+                        "zone_code": "EU",
+                    },
+                )
+            )
+        )
+
     # Get zone for code !!!not in^ should work => ROW
     def test_row_country_checker(self):
         input_codes = ["FR", "DE"]
@@ -286,9 +435,497 @@ class PlansAndShippingTestCase(TestCase):
                 self.assertEqual(item["price_data"]["unit_amount_decimal"], 0)
 
 
+class MembershipSnapshotTestCase(SimpleTestCase):
+    def make_sub(self, **kwargs):
+        defaults = dict(
+            id=uid(),
+            status="active",
+            created=timezone.now(),
+            current_period_end=timezone.now() + timedelta(days=10),
+            metadata={},
+        )
+        return LBCSubscription(**{**defaults, **kwargs})
+
+    def test_active_subscription_is_newest_valid_non_gift(self):
+        older = self.make_sub(created=timezone.now() - timedelta(days=30))
+        newer = self.make_sub()
+        gift = self.make_sub(metadata={"gift_mode": True})
+        cancelled = self.make_sub(status="canceled", ended_at=timezone.now())
+        snapshot = MembershipSnapshot(subscriptions=[older, gift, cancelled, newer])
+        self.assertEqual(snapshot.active_subscription, newer)
+        self.assertEqual(snapshot.old_subscription, cancelled)
+        self.assertEqual(snapshot.gifts_bought, [gift])
+
+    def test_no_subscriptions(self):
+        snapshot = MembershipSnapshot()
+        self.assertIsNone(snapshot.active_subscription)
+        self.assertIsNone(snapshot.old_subscription)
+        self.assertEqual(snapshot.gifts_bought, [])
+
+
+class MissingStripeCustomerTestCase(TestCase):
+    def test_missing_customer_is_remembered_until_cleared(self):
+        id = uid()
+        user = User.objects.create_user(
+            id, f"unit-test-{id}@leftbookclub.com", "default_pw_12345_xyz_lbc"
+        )
+        with self.assertNumQueries(1):
+            self.assertIsNone(user.stripe_customer)
+            self.assertIsNone(user.stripe_customer)
+            self.assertIsNone(user.active_subscription)
+
+        user.clear_membership_cache()
+        with self.assertNumQueries(1):
+            self.assertIsNone(user.stripe_customer)
+
+
+class TieredCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = TieredCache(
+            uid(),
+            {
+                "OPTIONS": {
+                    "SHARED": {
+                        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                        "LOCATION": uid(),
+                    },
+                    "LOCAL_EXCLUDE_KEYS": ["keyring"],
+                }
+            },
+        )
+
+    def test_reads_are_served_locally_until_cleared(self):
+        self.cache.set("shopify_product.1", "old")
+        self.cache.shared.set("shopify_product.1", "new")
+        self.assertEqual(self.cache.get("shopify_product.1"), "old")
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get("shopify_product.1"), "new")
+
+    def test_excluded_keys_always_read_shared(self):
+        self.cache.set("keyring", {"/": ["a"]})
+        self.cache.shared.set("keyring", {"/": ["a", "b"]})
+        self.assertEqual(self.cache.get("keyring"), {"/": ["a", "b"]})
+
+    def test_get_many_falls_through_to_shared(self):
+        self.cache.shared.set("postcodes.io-E84QN", {"postcode": "E8 4QN"})
+        self.cache.set("postcodes.io-N19GU", {"postcode": "N1 9GU"})
+        self.assertEqual(
+            self.cache.get_many(["postcodes.io-E84QN", "postcodes.io-N19GU", "x"]),
+            {
+                "postcodes.io-E84QN": {"postcode": "E8 4QN"},
+                "postcodes.io-N19GU": {"postcode": "N1 9GU"},
+            },
+        )
+
+    def test_delete_clears_both_tiers(self):
+        self.cache.set("shopify_product.1", "product")
+        self.cache.delete("shopify_product.1")
+        self.assertIsNone(self.cache.get("shopify_product.1"))
+        self.assertIsNone(self.cache.shared.get("shopify_product.1"))
+
+
+class PooledSessionTestCase(SimpleTestCase):
+    def setUp(self):
+        class StatusAdapter(BaseAdapter):
+            def send(self, request, **kwargs):
+                self.timeout = kwargs.get("timeout")
+                response = Response()
+                response.status_code = int(request.url.rsplit("/", 1)[-1])
+                response.request = request
+                return response
+
+        reset_http_metrics()
+        self.adapter = StatusAdapter()
+        self.session = PooledSession("test")
+        self.session.mount("https://example.test", self.adapter)
+
+    def test_requests_get_a_default_timeout(self):
+        self.session.get("https://example.test/200")
+        self.assertEqual(self.adapter.timeout, DEFAULT_TIMEOUT)
+        self.session.get("https://example.test/200", timeout=1)
+        self.assertEqual(self.adapter.timeout, 1)
+
+    def test_metrics_count_requests_and_errors(self):
+        self.session.get("https://example.test/200")
+        self.session.get("https://example.test/503")
+        metrics = http_metrics()["test"]
+        self.assertEqual(metrics["requests"], 2)
+        self.assertEqual(metrics["errors"], 1)
+        self.assertEqual(metrics["last_error"], "HTTP 503")
+
+
+@override_settings(POSTHOG_PUBLIC_TOKEN="test")
+class ShopifyMetafieldsTestCase(SimpleTestCase):
+    def test_metafields_are_fetched_in_batches(self):
+        def response(query, variables):
+            nodes = [
+                {
+                    "id": id,
+                    "metafields": {
+                        "edges": [
+                            {"node": {"key": "isbn", "value": "123", "type": "string"}}
+                        ],
+                        # Product 3 has more metafields than one page holds
+                        "pageInfo": {"hasNextPage": id.endswith("/3")},
+                    },
+                }
+                for id in variables["ids"]
+            ]
+            return {"data": {"nodes": nodes}}
+
+        with mock.patch(
+            "app.utils.shopify.execute_graphql", side_effect=response
+        ) as execute:
+            metafields = bulk_product_metafields(range(1, 6), batch_size=2)
+
+        self.assertEqual(
+            [call.kwargs["variables"]["ids"] for call in execute.call_args_list],
+            [
+                ["gid://shopify/Product/1", "gid://shopify/Product/2"],
+                ["gid://shopify/Product/3", "gid://shopify/Product/4"],
+                ["gid://shopify/Product/5"],
+            ],
+        )
+        self.assertEqual(set(metafields), {1, 2, 4, 5})
+        self.assertEqual(metafields[1], {"isbn": "123"})
+
+    def test_limiter_syncs_from_graphql_throttle_status(self):
+        limiter = ShopifyRateLimiter(capacity=100, leak_rate=1)
+        limiter.update_from_throttle_status(
+            {"maximumAvailable": 1000, "currentlyAvailable": 400, "restoreRate": 50}
+        )
+        self.assertEqual(limiter.capacity, 1000)
+        self.assertEqual(limiter.leak_rate, 50)
+        self.assertEqual(limiter.used, 600)
+
+        with mock.patch("app.utils.shopify.time.sleep") as sleep:
+            limiter.wait(cost=500)
+        # 100 over capacity, restored at 50 a second
+        self.assertAlmostEqual(sleep.call_args.args[0], 2, places=1)
+
+
+class BulkGeocodeTestCase(TestCase):
+    def test_misses_fall_back_to_mapbox_and_are_remembered(self):
+        postcode = uid().upper()
+        with mock.patch.dict(
+            os.environ, {"MAPBOX_PRIVATE_API_KEY": "test"}
+        ), mock.patch(
+            "app.utils.geo.fetch_postcodes_io_batch",
+            return_value=[{"query": postcode, "result": None}],
+        ) as postcodes_io, mock.patch(
+            "app.utils.geo.address_geo", return_value=None
+        ) as mapbox:
+            self.assertEqual(bulk_geocode_postcodes([postcode]), {})
+            self.assertEqual(bulk_geocode_postcodes([postcode]), {})
+
+        self.assertEqual(postcodes_io.call_count, 1)
+        mapbox.assert_called_once_with(postcode, country="GB")
+
+    def test_postcodes_outside_the_uk_use_their_country(self):
+        postcode = uid().upper()
+        point = Point(2.35, 48.85)
+        with mock.patch.dict(
+            os.environ, {"MAPBOX_PRIVATE_API_KEY": "test"}
+        ), mock.patch(
+            "app.utils.geo.fetch_postcodes_io_batch"
+        ) as postcodes_io, mock.patch(
+            "app.utils.geo.address_geo", return_value=point
+        ) as mapbox:
+            self.assertEqual(
+                bulk_geocode_postcodes([postcode], "FR"), {postcode: point}
+            )
+
+        postcodes_io.assert_not_called()
+        mapbox.assert_called_once_with(postcode, country="FR")
+        self.assertTrue(
+            GeocodedPostcode.objects.filter(
+                postcode=postcode, country="FR", source=GeocodedPostcode.MAPBOX
+            ).exists()
+        )
+
+
+class OutboxTestCase(TestCase):
+    def test_events_are_queued_then_sent_with_one_identify_per_user(self):
+        id = uid()
+        user = User.objects.create_user(
+            id, f"unit-test-{id}@leftbookclub.com", "default_pw_12345_xyz_lbc"
+        )
+
+        with mock.patch("app.analytics.posthog") as posthog:
+            analytics.buy_book(user)
+            analytics.buy_gift(user)
+            posthog.capture.assert_not_called()
+
+            queued = OutboxEvent.objects.filter(kind=OutboxEvent.POSTHOG_CAPTURE)
+            self.assertEqual(queued.filter(sent_at=None).count(), 2)
+
+            process_outbox()
+
+        self.assertEqual(posthog.identify.call_count, 1)
+        self.assertEqual(posthog.capture.call_count, 2)
+        self.assertEqual(queued.filter(sent_at=None).count(), 0)
+
+    def test_claimed_events_are_leased_to_one_worker(self):
+        id = uid()
+        user = User.objects.create_user(
+            id, f"unit-test-{id}@leftbookclub.com", "default_pw_12345_xyz_lbc"
+        )
+        OutboxEvent.enqueue(OutboxEvent.POSTHOG_CAPTURE, user, event="test")
+
+        self.assertEqual(len(claim_outbox_events()), 1)
+        # Another worker finds nothing due until the lease runs out
+        self.assertEqual(claim_outbox_events(), [])
+
+
+@override_settings(SHOPIFY_PRIVATE_APP_PASSWORD="test")
+class ShopifyOrderQueueTestCase(TestCase):
+    def test_orders_are_queued_once_and_retried_on_failure(self):
+        id = uid()
+        user = User.objects.create_user(
+            id, f"unit-test-{id}@leftbookclub.com", "default_pw_12345_xyz_lbc"
+        )
+        for _ in range(2):
+            queue_shopify_order(user, tags=["Manual Sync"], reference="sub_test")
+        self.assertEqual(ShopifyOrder.objects.filter(reference="sub_test").count(), 1)
+
+        with mock.patch("app.fulfilment.shopify"), mock.patch(
+            "app.fulfilment.build_shopify_order", side_effect=ValueError("No address")
+        ):
+            self.assertEqual(submit_shopify_orders(), 0)
+
+        order = ShopifyOrder.objects.get(reference="sub_test")
+        self.assertEqual(order.status, ShopifyOrder.QUEUED)
+        self.assertEqual(order.attempts, 1)
+        self.assertEqual(order.last_error, "No address")
+        self.assertGreater(order.next_attempt_at, timezone.now())
+
+    def test_orders_created_in_shopify_are_never_requeued(self):
+        id = uid()
+        user = User.objects.create_user(
+            id, f"unit-test-{id}@leftbookclub.com", "default_pw_12345_xyz_lbc"
+        )
+        queue_shopify_order(user, tags=["Manual Sync"], reference="sub_review")
+
+        limiter = mock.Mock()
+        limiter.call.side_effect = lambda fn: fn()
+        shopify_order = mock.Mock(id=1234)
+        shopify_order.save.return_value = True
+        with mock.patch("app.fulfilment.shopify"), mock.patch(
+            "app.fulfilment.build_shopify_order", return_value=shopify_order
+        ), mock.patch(
+            "app.fulfilment.record_shopify_order_created",
+            side_effect=DatabaseError("Connection lost"),
+        ):
+            self.assertEqual(submit_shopify_orders(limiter=limiter), 1)
+
+        order = ShopifyOrder.objects.get(reference="sub_review")
+        self.assertEqual(order.status, ShopifyOrder.REVIEW)
+        self.assertEqual(order.shopify_order_id, 1234)
+        self.assertFalse(pending_shopify_orders().filter(id=order.id).exists())
+
+
+class BatchUpdateSubscriptionsTestCase(TestCase):
+    def test_jobs_are_queued_together_and_summarised(self):
+        form = BatchUpdateSubscriptionsForm(
+            data={
+                "subscription_ids": "sub_1, sub_2\nsub_3",
+                "add_or_update_shipping": True,
+                "batch_id": "6d1c1d4e-53a4-4b8c-9c55-27f1e2b3a0aa",
+                "proration_behavior": "none",
+            }
+        )
+        self.assertEqual(len(form.process_request()), 3)
+
+        jobs = Job.objects.filter(
+            workspace__batch_id="6d1c1d4e-53a4-4b8c-9c55-27f1e2b3a0aa"
+        )
+        self.assertEqual(jobs.filter(queue_name=BATCH_UPDATE_QUEUE).count(), 3)
+
+        SubscriptionUpdateBatch.record_result(
+            "6d1c1d4e-53a4-4b8c-9c55-27f1e2b3a0aa",
+            complete=False,
+            error="Sub is canceled",
+        )
+        batch = SubscriptionUpdateBatch.objects.get(
+            id="6d1c1d4e-53a4-4b8c-9c55-27f1e2b3a0aa"
+        )
+        progress = batch_progress(batch)
+        self.assertEqual(progress["total"], 3)
+        self.assertEqual(progress["remaining"], 2)
+        self.assertEqual(progress["states"]["waiting"], 2)
+        self.assertEqual(progress["errors"], [("Sub is canceled", 1)])
+
+    def test_jobs_left_processing_by_a_killed_worker_are_reclaimed(self):
+        job = Job.objects.create(
+            name="update_subscription",
+            queue_name=BATCH_UPDATE_QUEUE,
+            state=Job.STATES.PROCESSING,
+        )
+        self.assertIsNone(claim_job())
+
+        Job.objects.filter(id=job.id).update(
+            modified=timezone.now() - BATCH_UPDATE_JOB_LEASE - timedelta(minutes=1)
+        )
+        self.assertEqual(claim_job().id, job.id)
+
+    def test_rate_is_shared_out_without_redis(self):
+        limiter = SharedStripeRateLimiter(rate=10, processes=2)
+        with mock.patch("app.utils.stripe.time.sleep") as sleep:
+            limiter.wait()
+            limiter.wait()
+        # Each of the 2 processes gets 5 requests a second
+        self.assertAlmostEqual(sleep.call_args.args[0], 0.2, places=1)
+
+
+class StripeRequestCacheTestCase(SimpleTestCase):
+    def test_objects_are_retrieved_once_per_request(self):
+        retrieved = []
+
+        class Subscription:
+            OBJECT_NAME = "subscription"
+
+            @classmethod
+            def retrieve(cls, id, **kwargs):
+                retrieved.append(id)
+                return {"id": id, **kwargs}
+
+        start_stripe_request_cache()
+        try:
+            retrieve_stripe_object(Subscription, "sub_1")
+            retrieve_stripe_object(Subscription, "sub_1")
+            self.assertEqual(len(retrieved), 1)
+
+            forget_stripe_object(Subscription, "sub_1")
+            retrieve_stripe_object(Subscription, "sub_1")
+            self.assertEqual(len(retrieved), 2)
+        finally:
+            stop_stripe_request_cache()
+
+        retrieve_stripe_object(Subscription, "sub_1")
+        self.assertEqual(len(retrieved), 3)
+
+
+class MemberExportTestCase(SimpleTestCase):
+    def test_export_headings_are_labelled(self):
+        model_admin = CustomerAdmin()
+        view = model_admin.index_view_class(model_admin)
+        view.list_export = model_admin.list_export
+
+        header = next(view.stream_csv(iter([])))
+        self.assertTrue(
+            header.lower().startswith("recipient name,recipient email,"), header
+        )
+        self.assertNotIn("recipient_name", header)
+
+    def test_exports_resolve_a_chunk_at_a_time(self):
+        queryset = mock.Mock()
+        queryset.iterator.return_value = iter(range(5))
+        with mock.patch(
+            "app.exports.resolve_subscription_properties", side_effect=list
+        ) as resolve:
+            rows = list(iter_resolved_subscriptions(queryset, chunk_size=2))
+
+        self.assertEqual(rows, [0, 1, 2, 3, 4])
+        queryset.iterator.assert_called_once_with(chunk_size=2)
+        self.assertEqual(
+            [call.args[0] for call in resolve.call_args_list], [[0, 1], [2, 3], [4]]
+        )
+
+
+class MemberExportFileTestCase(TestCase):
+    def test_background_exports_have_the_same_headings(self):
+        output = BytesIO()
+        self.assertEqual(write_member_export([], output), 0)
+        self.assertTrue(
+            output.getvalue()
+            .decode("utf-8")
+            .lower()
+            .startswith("recipient name,recipient email,")
+        )
+
+
+class PromotionCodeIndexTestCase(TestCase):
+    def test_gift_codes_are_checked_against_the_local_index(self):
+        StripePromotionCode.sync_from_stripe_data(
+            {
+                "id": "promo_test",
+                "code": "GIFTCODE1",
+                "active": True,
+                "max_redemptions": 1,
+                "times_redeemed": 0,
+                "coupon": {"id": "coupon_test"},
+                "metadata": {"gift_giver_subscription": "sub_test"},
+                "created": 1700000000,
+            }
+        )
+
+        with mock.patch("stripe.PromotionCode.list") as list_promotion_codes:
+            self.assertTrue(is_redeemable_gift_code("giftcode1"))
+            StripePromotionCode.objects.filter(id="promo_test").update(times_redeemed=1)
+            self.assertFalse(is_redeemable_gift_code("GIFTCODE1"))
+            self.assertTrue(is_real_gift_code("GIFTCODE1"))
+            list_promotion_codes.assert_not_called()
+
+
+@override_settings(
+    POSTHOG_PUBLIC_TOKEN="test",
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class PosthogIdentityLinkingTestCase(SimpleTestCase):
+    def test_repeat_requests_are_not_aliased_again(self):
+        handler = middleware.frontend_backend_posthog_identity_linking(
+            lambda request: HttpResponse()
+        )
+        user = SimpleNamespace(
+            is_authenticated=True, id=uid(), primary_email="unit-test@leftbookclub.com"
+        )
+        suppressed = middleware.posthog_alias_counts()["suppressed"]
+
+        with mock.patch("app.middleware.posthog") as posthog:
+            for _ in range(3):
+                request = RequestFactory().get("/")
+                request.user = user
+                request.session = SimpleNamespace(session_key=f"session-{user.id}")
+                handler(request)
+
+        self.assertEqual(posthog.alias.call_count, 2)
+        self.assertEqual(
+            middleware.posthog_alias_counts()["suppressed"] - suppressed, 4
+        )
+
+
+@override_settings(
+    WAGTAIL_CACHE=True,
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class CacheDependencyTestCase(SimpleTestCase):
+    def test_invalidation_only_evicts_dependent_pages(self):
+        cache = get_dependency_cache()
+        cache.set(
+            "keyring",
+            {
+                "http://testserver/books/": ["books-response"],
+                "http://testserver/about/": ["about-response"],
+            },
+        )
+        cache.set("books-response", "books")
+        cache.set("about-response", "about")
+        register_cache_dependencies(
+            "http://testserver/books/", {page_dependency(1), page_dependency(3)}
+        )
+        register_cache_dependencies("http://testserver/about/", {page_dependency(2)})
+
+        invalidate_cache_dependencies(page_dependency(3))
+
+        self.assertIsNone(cache.get("books-response"))
+        self.assertEqual(cache.get("about-response"), "about")
+        self.assertEqual(list(cache.get("keyring")), ["http://testserver/about/"])
+
+
 class ComplexPlansAndPrices(TestCase):
     @classmethod
     def setUpTestData(cls):
+        invalidate_shipping_zones()
         contemporary_monthly = LBCProduct.objects.create(
             id="prod_contemporary_monthly",
             name="Some Product",
@@ -1018,6 +1655,44 @@ class UpgradeTestCase(TestCase):
             len(updated_subscription_items.data), len(subscription_items.data)
         )
 
+    def test_resolved_subscription_properties_match(self):
+        stripe_context = SubscriptionCheckoutView.create_checkout_context(
+            product=self.plan.monthly_price.products.first(),
+            price=self.plan.monthly_price,
+            zone=ShippingZone.default_zone,
+        )
+        subscription = stripe.Subscription.create(
+            customer=self.user.stripe_customer.id,
+            items=stripe_context["checkout_args"]["line_items"],
+            metadata={"created_by_script": "true"},
+        )
+        djstripe.models.Subscription.sync_from_stripe_data(subscription)
+
+        subscriptions = LBCSubscription.objects.filter(
+            id=subscription.id
+        ).select_related("plan__product", "customer__subscriber")
+        fields = (
+            "primary_product",
+            "membership_plan_price",
+            "shipping_zone",
+            "should_upgrade",
+            "recipient_name",
+            "is_active_member",
+        )
+
+        def values(sub):
+            return [
+                value() if callable(value) else value
+                for value in (getattr(sub, field) for field in fields)
+            ]
+
+        expected = values(subscriptions.get())
+        self.assertEqual(expected[1], self.plan.monthly_price)
+
+        (resolved,) = resolve_subscription_properties(subscriptions)
+        with self.assertNumQueries(0):
+            self.assertEqual(values(resolved), expected)
+
     def test_legacy_customer_should_upgrade(self):
         # A price was never created for this user in the past.
         # They're on some random price for a product that also has a newer, higher price.
@@ -30,8 +30,11 @@ from app.views import (
     GiftCodeRedeemView,
     GiftMembershipSetupView,
     LoginRequiredTemplateView,
+    MemberExportDownloadView,
+    MemberExportView,
     ProductRedirectView,
     RefreshDataView,
+    ShippingCostForCountryView,
     ShippingCostView,
     ShippingForProductView,
     StripeCheckoutSuccessView,
@@ -160,6 +163,16 @@ urlpatterns = [
         BatchUpdateSubscriptionsStatusView.as_view(),
         name="batch_update_subscriptions_batch_status",
     ),
+    path(
+        "member-exports/<uuid:job_id>/",
+        MemberExportView.as_view(),
+        name="member_export",
+    ),
+    path(
+        "member-exports/<uuid:job_id>/download/",
+        MemberExportDownloadView.as_view(),
+        name="member_export_download",
+    ),
     ### V2 signup flow
     # CreateMembershipView
     # SelectReadingSpeedView
@@ -212,6 +225,11 @@ urlpatterns = [
     path(
         ShippingCostView.url_pattern, ShippingCostView.as_view(), name="shippingcosts"
     ),
+    path(
+        ShippingCostForCountryView.url_pattern,
+        ShippingCostForCountryView.as_view(),
+        name="shippingcosts_for_country",
+    ),
     path(CartOptionsView.url_pattern, CartOptionsView.as_view(), name="cartoptions"),
     path("anonymous/product/<int:id>/", ProductRedirectView.as_view(), name="product"),
     path(settings.SYNC_SHOPIFY_WEBHOOK_ENDPOINT, SyncShopifyWebhookEndpoint.as_view()),
@@ -232,7 +250,10 @@ urlpatterns = [
         ),
         name="membership_options_grid",
     ),
+    path("anonymous/prices.json", views.PriceMatrixView.as_view(), name="price_matrix"),
     path("geo/postcode/<str:postcode>/<str:country_code>/", views.postcode_lookup_view, name="postcode_lookup"),
+    path("geo/layers/<str:layer_id>.geojson", views.MapLayerView.as_view(), name="map_layer"),
+    path("geo/nearby/<str:postcode>/<str:country_code>/", views.nearby_view, name="nearby"),
 
     # re_path(r'^wagtail-transfer/', include(wagtailtransfer_urls)),
     # For anything not caught by a more specific rule above, hand over to Wagtail's serving mechanism
@@ -1,5 +1,19 @@
-from django.core.cache import cache
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache
 from django.db.models import QuerySet
+from django.db.models.signals import post_init
+from wagtail.contrib.settings.models import BaseGenericSetting, BaseSiteSetting
+from wagtail.models import Page
+from wagtail.snippets.models import get_snippet_models
+from wagtailcache.cache import clear_cache
+from wagtailcache.settings import wagtailcache_settings
 
 
 def django_cached_key(ns, get_key, *args, **kwargs):
@@ -52,3 +66,182 @@ def cached_fn(key, timeout_seconds=60 * 5, cache_type="default"):
         return resulting_fn
 
     return
+
+
+# Dependency-tracked page cache invalidation.
+#
+# While a request is being rendered, every page, snippet and setting that gets
+# loaded from the database is recorded as a dependency "tag". If the response is
+# stored by wagtail-cache, its URL is registered against each tag, so that a change
+# to one object only evicts the cached pages that actually used it.
+
+_dependency_tracking = threading.local()
+
+
+def page_dependency(page_id):
+    return f"page:{page_id}"
+
+
+def model_dependency(model):
+    return f"model:{model._meta.label_lower}"
+
+
+def instance_dependency(instance):
+    if isinstance(instance, Page):
+        return page_dependency(instance.pk)
+    return f"{instance._meta.label_lower}:{instance.pk}"
+
+
+def is_cache_dependency(model):
+    return (
+        issubclass(model, (Page, BaseSiteSetting, BaseGenericSetting))
+        or model in get_snippet_models()
+    )
+
+
+_dependency_tracking_connected = False
+
+
+def track_loaded_cache_dependency(sender, instance, **kwargs):
+    if is_tracking_cache_dependencies():
+        track_instance_cache_dependency(instance)
+
+
+def connect_cache_dependency_tracking():
+    """
+    Listen for loaded instances of the dependency models only, rather than for
+    every model instantiated site-wide. Snippets are registered after this app
+    is ready, so this runs when tracking first starts.
+    """
+    global _dependency_tracking_connected
+    if _dependency_tracking_connected:
+        return
+    for model in apps.get_models():
+        if is_cache_dependency(model):
+            post_init.connect(
+                track_loaded_cache_dependency,
+                sender=model,
+                dispatch_uid=f"track_cache_dependency.{model._meta.label_lower}",
+            )
+    _dependency_tracking_connected = True
+
+
+def start_tracking_cache_dependencies():
+    connect_cache_dependency_tracking()
+    _dependency_tracking.tags = set()
+
+
+def stop_tracking_cache_dependencies():
+    tags = getattr(_dependency_tracking, "tags", None) or set()
+    _dependency_tracking.tags = None
+    return tags
+
+
+def is_tracking_cache_dependencies():
+    return getattr(_dependency_tracking, "tags", None) is not None
+
+
+def track_cache_dependency(*tags):
+    if is_tracking_cache_dependencies():
+        _dependency_tracking.tags.update(tags)
+
+
+def track_instance_cache_dependency(instance):
+    if instance.pk is not None:
+        track_cache_dependency(
+            instance_dependency(instance), model_dependency(instance)
+        )
+
+
+def get_dependency_cache():
+    return caches[wagtailcache_settings.WAGTAIL_CACHE_BACKEND]
+
+
+def dependency_cache_key(tag):
+    return f"cache_dependency.{tag}"
+
+
+def dependency_redis(dependency_cache):
+    """
+    The Redis cache behind the dependency cache, if it has one, for atomic set
+    operations on the URL sets.
+    """
+    backend = getattr(dependency_cache, "shared", dependency_cache)
+    if isinstance(backend, RedisCache):
+        return backend
+    return None
+
+
+@contextmanager
+def dependency_lock(dependency_cache, timeout=10):
+    # Without Redis, serialise updates to the URL sets with a cache lock
+    key = dependency_cache_key("lock")
+    deadline = time.monotonic() + timeout
+    acquired = dependency_cache.add(key, True, timeout)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(0.01)
+        acquired = dependency_cache.add(key, True, timeout)
+    try:
+        yield
+    finally:
+        if acquired:
+            dependency_cache.delete(key)
+
+
+def register_cache_dependencies(url, tags):
+    dependency_cache = get_dependency_cache()
+    keys = [dependency_cache_key(tag) for tag in tags]
+
+    redis = dependency_redis(dependency_cache)
+    if redis is not None:
+        # SADD is atomic, so concurrent renders can't drop each other's URLs
+        timeout = redis.get_backend_timeout(DEFAULT_TIMEOUT)
+        with redis._cache.get_client(write=True).pipeline() as pipe:
+            for key in keys:
+                key = redis.make_and_validate_key(key)
+                pipe.sadd(key, url)
+                if timeout is not None:
+                    pipe.expire(key, timeout)
+            pipe.execute()
+        return
+
+    with dependency_lock(dependency_cache):
+        existing = dependency_cache.get_many(keys)
+        dependency_cache.set_many(
+            {key: existing.get(key, set()) | {url} for key in keys}
+        )
+
+
+def pop_dependent_urls(dependency_cache, keys):
+    redis = dependency_redis(dependency_cache)
+    if redis is not None:
+        keys = [redis.make_and_validate_key(key) for key in keys]
+        # Read and delete in one transaction, so no URL is added in between
+        with redis._cache.get_client(write=True).pipeline() as pipe:
+            for key in keys:
+                pipe.smembers(key)
+            pipe.delete(*keys)
+            *members, _ = pipe.execute()
+        return {url.decode() for urls in members for url in urls}
+
+    with dependency_lock(dependency_cache):
+        urls = set().union(*dependency_cache.get_many(keys).values())
+        dependency_cache.delete_many(keys)
+    return urls
+
+
+def invalidate_cache_dependencies(*tags):
+    """
+    Evict every cached page that was rendered using any of the given tags.
+    """
+    if not wagtailcache_settings.WAGTAIL_CACHE or not tags:
+        return
+
+    dependency_cache = get_dependency_cache()
+    urls = pop_dependent_urls(
+        dependency_cache, [dependency_cache_key(tag) for tag in tags]
+    )
+
+    # clear_cache() falls back to clearing _everything_ when there's no keyring
+    if urls and "keyring" in dependency_cache:
+        clear_cache(urls=[f"^{re.escape(url)}$" for url in urls])
@@ -0,0 +1,179 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+
+_MISSING = object()
+
+
+class TieredCache(BaseCache):
+    """
+    A small in-process LRU cache in front of a shared backend.
+
+    Reads are served from the local tier when possible and fall through to the
+    shared tier otherwise; writes go to both. Local entries live for at most
+    `LOCAL_TIMEOUT` seconds, so values written by other processes become visible
+    within that window.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "app.utils.cache_backends.TieredCache",
+            "KEY_PREFIX": "wagtailcache",
+            "TIMEOUT": 60 * 60 * 24,
+            "OPTIONS": {
+                "SHARED": {
+                    "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                    "LOCATION": "redis://localhost:6379",
+                },
+                "LOCAL_TIMEOUT": 30,
+                "LOCAL_MAX_ENTRIES": 1000,
+                # Keys (or key prefixes) that are read-modify-written across
+                # processes, like wagtail-cache's keyring, should always hit
+                # the shared tier.
+                "LOCAL_EXCLUDE_KEYS": ["keyring"],
+            },
+        }
+    }
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+
+        # Tiers inherit key construction from this cache so that
+        # both tiers see the same keys as a plain backend would
+        inherited = {
+            "KEY_PREFIX": self.key_prefix,
+            "VERSION": self.version,
+            "KEY_FUNCTION": self.key_func,
+            "TIMEOUT": params.get("TIMEOUT", 300),
+        }
+
+        shared_params = {**inherited, **options.get("SHARED", {})}
+        shared_backend = import_string(
+            shared_params.pop(
+                "BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+            )
+        )
+        self.shared = shared_backend(shared_params.pop("LOCATION", ""), shared_params)
+
+        self.local_timeout = int(options.get("LOCAL_TIMEOUT", 30))
+        self.local_exclude_keys = tuple(options.get("LOCAL_EXCLUDE_KEYS", []))
+        self.local = None
+        if self.local_timeout > 0:
+            self.local = LocMemCache(
+                f"tiered-{location or id(self)}",
+                {
+                    **inherited,
+                    "TIMEOUT": self.local_timeout,
+                    "OPTIONS": {
+                        "MAX_ENTRIES": int(options.get("LOCAL_MAX_ENTRIES", 1000)),
+                        "CULL_FREQUENCY": int(options.get("LOCAL_CULL_FREQUENCY", 3)),
+                    },
+                },
+            )
+
+    def _uses_local(self, key):
+        return self.local is not None and not key.startswith(self.local_exclude_keys)
+
+    def _local_timeout(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    def _set_local(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        if not self._uses_local(key):
+            return
+        local_timeout = self._local_timeout(timeout)
+        if local_timeout <= 0:
+            self.local.delete(key, version=version)
+        else:
+            self.local.set(key, value, local_timeout, version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            self._set_local(key, value, timeout, version=version)
+        return added
+
+    def get(self, key, default=None, version=None):
+        if self._uses_local(key):
+            value = self.local.get(key, _MISSING, version=version)
+            if value is not _MISSING:
+                return value
+
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            return default
+
+        self._set_local(key, value, version=version)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        self._set_local(key, value, timeout, version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        if self._uses_local(key):
+            self.local.touch(key, self._local_timeout(timeout), version=version)
+        return self.shared.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        if self._uses_local(key):
+            self.local.delete(key, version=version)
+        return self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        if self._uses_local(key) and self.local.has_key(key, version=version):
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = {}
+        if self.local is not None:
+            found = self.local.get_many(
+                [key for key in keys if self._uses_local(key)], version=version
+            )
+
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = self.shared.get_many(missing, version=version)
+            for key, value in fetched.items():
+                self._set_local(key, value, version=version)
+            found.update(fetched)
+
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed_keys = self.shared.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed_keys:
+                self._set_local(key, value, timeout, version=version)
+        return failed_keys
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if self.local is not None:
+            self.local.delete_many(
+                [key for key in keys if self._uses_local(key)], version=version
+            )
+        self.shared.delete_many(keys, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        if self._uses_local(key):
+            self.local.delete(key, version=version)
+        return self.shared.incr(key, delta, version=version)
+
+    def clear(self):
+        if self.local is not None:
+            self.local.clear()
+        self.shared.clear()
+
+    def clear_local(self):
+        if self.local is not None:
+            self.local.clear()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
@@ -1,12 +1,30 @@
 import os
+import pycountry
 import requests
 from typing import Union
+from django.contrib.gis.db.models import PointField
+from django.contrib.gis.db.models.functions import Distance
 from django.contrib.gis.geos import Point
 from django.core.cache import cache
+from django.db.models import FloatField, Func, Value
+from django.db.models.functions import Cast
 
-from app.utils.python import batch_and_aggregate, get, get_path
+from app.utils.python import batch_and_aggregate, chunk_array, get, get_path
+from app.utils.http import get_session
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from urllib.parse import quote
 
+POSTCODES_IO_BATCH_SIZE = 100
+POSTCODES_IO_CONCURRENCY = 4
+# GeocodedPostcode is the source of truth, the cache just saves a query
+POSTCODE_CACHE_TTL = 60 * 60 * 24 * 30
+# Postcodes a geocoder couldn't place aren't retried for this long
+POSTCODE_MISS_TTL = 60 * 60 * 24 * 7
+MAPBOX_CONCURRENCY = 4
+POSTCODES_IO = "postcodes.io"
+MAPBOX = "mapbox"
+
 
 def address_geo(address: str, postcode: Union[str, None] = "", country: Union[str, None] = "GB"):
     api_token = os.getenv('MAPBOX_PRIVATE_API_KEY')
@@ -29,7 +47,7 @@ def address_geo(address: str, postcode: Union[str, None] = "", country: Union[st
 
     try:
         # Make the API request
-        response = requests.get(url, params=params)
+        response = get_session("mapbox").get(url, params=params)
         response.raise_for_status()
 
         # Parse the JSON response
@@ -61,6 +79,44 @@ def point_from_postcode_result(postcode_result):
     return Point(postcode_result["longitude"], postcode_result["latitude"])
 
 
+# Shared by the concurrent batch requests below
+postcodes_io = get_session("postcodes.io", pool_size=POSTCODES_IO_CONCURRENCY)
+
+
+def stored_postcode_results(postcodes, country="GB"):
+    """
+    Previously geocoded postcodes.io results, by normalised postcode.
+    """
+    from app.models.django import GeocodedPostcode
+
+    return dict(
+        GeocodedPostcode.objects.filter(
+            postcode__in=postcodes, country=country, result__isnull=False
+        ).values_list("postcode", "result")
+    )
+
+
+def store_postcode_results(results, country="GB"):
+    from app.models.django import GeocodedPostcode
+
+    GeocodedPostcode.objects.bulk_create(
+        [
+            GeocodedPostcode(
+                postcode=postcode,
+                country=country,
+                source=GeocodedPostcode.POSTCODES_IO,
+                result=result,
+                coordinates=point_from_postcode_result(result),
+            )
+            for postcode, result in results.items()
+            if result is not None
+        ],
+        update_conflicts=True,
+        unique_fields=["postcode", "country"],
+        update_fields=["source", "result", "coordinates", "updated_at"],
+    )
+
+
 def postcode_geo(postcode: str):
     postcode = normalise_postcode(postcode)
 
@@ -68,58 +124,299 @@ def postcode_geo(postcode: str):
     if cached_data is not None:
         return cached_data
 
-    response = requests.get(f"https://api.postcodes.io/postcodes/{postcode}")
+    stored_data = stored_postcode_results([postcode]).get(postcode, None)
+    if stored_data is not None:
+        cache.set(cache_key(postcode), stored_data, POSTCODE_CACHE_TTL)
+        return stored_data
+
+    response = postcodes_io.get(
+        f"https://api.postcodes.io/postcodes/{postcode}", timeout=10
+    )
     data = response.json()
     status = get(data, "status")
     result = get(data, "result")
-    cache.set(cache_key(postcode), result, 60 * 60 if result is None else 9999999)
+    cache.set(
+        cache_key(postcode), result, 60 * 60 if result is None else POSTCODE_CACHE_TTL
+    )
 
     if status != 200 or result is None:
         # raise Exception(f'Failed to geocode postcode: {postcode}.')
         return None
 
+    store_postcode_results({postcode: result})
     return result
 
 
-@batch_and_aggregate(100)
+def geocode_postcode(postcode: str, country_code: str = "GB"):
+    """
+    A point for a postcode: postcodes.io for the UK, Mapbox otherwise or as a fallback.
+    """
+    from app.models.django import GeocodedPostcode
+
+    if country_code == "GB":
+        point = point_from_postcode_result(postcode_geo(postcode))
+        if point is not None:
+            return point
+
+    postcode = normalise_postcode(postcode)
+    stored = (
+        GeocodedPostcode.objects.filter(postcode=postcode, country=country_code)
+        .exclude(coordinates=None)
+        .first()
+    )
+    if stored is not None:
+        return stored.coordinates
+
+    point = address_geo(postcode, country=country_code)
+    if point is not None:
+        GeocodedPostcode.objects.update_or_create(
+            postcode=postcode,
+            country=country_code,
+            defaults=dict(
+                source=GeocodedPostcode.MAPBOX, result=None, coordinates=point
+            ),
+        )
+    return point
+
+
+class KNNDistance(Func):
+    """
+    PostGIS's `<->` operator. Ordering by it (with a LIMIT) lets Postgres
+    walk a GiST index outwards from the point instead of measuring every row.
+    """
+
+    arg_joiner = " <-> "
+    template = "%(expressions)s"
+    output_field = FloatField()
+
+
+def as_geography(expression):
+    """
+    `expression::geography`, so `<->` measures in metres rather than degrees.
+    Models index `as_geography("coordinates")` for `nearest` to walk.
+    """
+    return Cast(expression, output_field=PointField(geography=True))
+
+
+def nearest(queryset, point: Point, limit=5, field="coordinates"):
+    """
+    The `limit` rows nearest to `point`, annotated with their `distance`.
+    """
+    if point.srid is None:
+        point.srid = 4326
+    return list(
+        queryset.filter(**{f"{field}__isnull": False})
+        .annotate(distance=Distance(field, point))
+        .order_by(
+            KNNDistance(
+                as_geography(field),
+                as_geography(Value(point, output_field=PointField(srid=4326))),
+            )
+        )[:limit]
+    )
+
+
+def fetch_postcodes_io_batch(postcodes):
+    response = postcodes_io.post(
+        "https://api.postcodes.io/postcodes",
+        json={"postcodes": postcodes},
+        timeout=30,
+    )
+    data = response.json()
+    new_data = get(data, "result")
+    status = get(data, "status")
+
+    if status != 200 or new_data is None:
+        # raise Exception(f'Failed to bulk geocode postcodes: {postcodes}.')
+        return []
+    return new_data
+
+
 def bulk_postcode_geo(postcodes):
-    postcodes = [normalise_postcode(postcode) for postcode in postcodes]
+    """
+    Geocode many UK postcodes: from the cache, then the GeocodedPostcode table,
+    then postcodes.io in concurrent batches for whatever is left.
+
+    Postcodes that postcodes.io doesn't know are remembered for a while,
+    so they aren't asked about again on every run.
+    """
+    postcodes = list(
+        dict.fromkeys(normalise_postcode(postcode) for postcode in postcodes)
+    )
     cached_data = cache.get_many(cache_key(postcode) for postcode in postcodes)
-    has_loaded = [
-        {"query": postcode, "result": cached_data.get(postcode)}
+    results = {
+        postcode: cached_data[cache_key(postcode)]
+        for postcode in postcodes
+        if cached_data.get(cache_key(postcode)) is not None
+    }
+
+    needs_loading = [postcode for postcode in postcodes if postcode not in results]
+    if len(needs_loading) > 0:
+        stored_data = stored_postcode_results(needs_loading)
+        cache.set_many(
+            {cache_key(postcode): result for postcode, result in stored_data.items()},
+            POSTCODE_CACHE_TTL,
+        )
+        results.update(stored_data)
+
+    needs_loading = without_known_misses(
+        POSTCODES_IO, [postcode for postcode in postcodes if postcode not in results]
+    )
+    if len(needs_loading) > 0:
+        with ThreadPoolExecutor(max_workers=POSTCODES_IO_CONCURRENCY) as executor:
+            responses = [
+                res
+                for batch in executor.map(
+                    fetch_postcodes_io_batch,
+                    chunk_array(needs_loading, POSTCODES_IO_BATCH_SIZE),
+                )
+                for res in batch
+            ]
+        new_data = {
+            normalise_postcode(res.get("query")): res.get("result")
+            for res in responses
+            if res.get("result") is not None
+        }
+        store_postcode_results(new_data)
+        cache.set_many(
+            {cache_key(postcode): result for postcode, result in new_data.items()},
+            POSTCODE_CACHE_TTL,
+        )
+        # Only what postcodes.io answered for, not batches that failed outright
+        remember_misses(
+            POSTCODES_IO,
+            [
+                normalise_postcode(res.get("query"))
+                for res in responses
+                if res.get("result") is None
+            ],
+        )
+        results.update(new_data)
+
+    return [
+        {"query": postcode, "result": results[postcode]}
         for postcode in postcodes
-        if cached_data.get(postcode) is not None
+        if postcode in results
     ]
 
-    needs_loading = [
-        postcode for postcode in postcodes if cached_data.get(postcode) is None
+
+def miss_cache_key(source, postcode, country="GB"):
+    return f"{source}-miss-{country}-{normalise_postcode(postcode)}"
+
+
+def without_known_misses(source, postcodes, country="GB"):
+    misses = cache.get_many(
+        miss_cache_key(source, postcode, country) for postcode in postcodes
+    )
+    return [
+        postcode
+        for postcode in postcodes
+        if miss_cache_key(source, postcode, country) not in misses
     ]
-    # print('needs_loading')
-    # print(needs_loading)
 
-    if len(needs_loading) == 1:
-        postcode = needs_loading[0]
-        has_loaded += [{"query": postcode, "result": postcode_geo(postcode)}]
 
-    elif len(needs_loading) > 0:
-        response = requests.post(
-            f"https://api.postcodes.io/postcodes", data={"postcodes": needs_loading}
-        )
+def remember_misses(source, postcodes, country="GB"):
+    cache.set_many(
+        {miss_cache_key(source, postcode, country): True for postcode in postcodes},
+        POSTCODE_MISS_TTL,
+    )
 
-        data = response.json()
-        new_data = get(data, "result")
-        status = get(data, "status")
 
-        if status != 200 or new_data is None:
-            # raise Exception(f'Failed to bulk geocode postcodes: {postcodes}.')
-            pass
-        else:
-            has_loaded += new_data
-            cache.set_many(
-                {cache_key(res.get("query")): res.get("result") for res in new_data}
+def mapbox_postcode_points(postcodes, country_code):
+    """
+    Points for postcodes in any country, from the GeocodedPostcode table,
+    then Mapbox for whatever is left.
+    """
+    from app.models.django import GeocodedPostcode
+
+    points = dict(
+        GeocodedPostcode.objects.filter(
+            postcode__in=postcodes, country=country_code, coordinates__isnull=False
+        ).values_list("postcode", "coordinates")
+    )
+
+    needs_loading = without_known_misses(
+        MAPBOX,
+        [postcode for postcode in postcodes if postcode not in points],
+        country_code,
+    )
+    if len(needs_loading) == 0 or not os.getenv("MAPBOX_PRIVATE_API_KEY"):
+        return points
+
+    with ThreadPoolExecutor(max_workers=MAPBOX_CONCURRENCY) as executor:
+        new_points = dict(
+            zip(
+                needs_loading,
+                executor.map(
+                    lambda postcode: address_geo(postcode, country=country_code),
+                    needs_loading,
+                ),
             )
+        )
+    GeocodedPostcode.objects.bulk_create(
+        [
+            GeocodedPostcode(
+                postcode=postcode,
+                country=country_code,
+                source=GeocodedPostcode.MAPBOX,
+                coordinates=point,
+            )
+            for postcode, point in new_points.items()
+            if point is not None
+        ],
+        update_conflicts=True,
+        unique_fields=["postcode", "country"],
+        update_fields=["source", "coordinates", "updated_at"],
+    )
+    remember_misses(
+        MAPBOX,
+        [postcode for postcode, point in new_points.items() if point is None],
+        country_code,
+    )
+    points.update(
+        {postcode: point for postcode, point in new_points.items() if point is not None}
+    )
+    return points
+
 
-    return has_loaded
+def bulk_geocode_postcodes(postcodes, country_code="GB"):
+    """
+    Points for many postcodes in one country, by normalised postcode.
+
+    UK postcodes go to postcodes.io in bulk first; anything it can't place,
+    and postcodes elsewhere, fall back to Mapbox.
+    """
+    postcodes = list(
+        dict.fromkeys(normalise_postcode(postcode) for postcode in postcodes)
+    )
+    points = {}
+    if country_code == "GB":
+        points = {
+            payload["query"]: point_from_postcode_result(payload["result"])
+            for payload in bulk_postcode_geo(postcodes)
+        }
+
+    misses = [postcode for postcode in postcodes if points.get(postcode) is None]
+    if len(misses) > 0:
+        points.update(mapbox_postcode_points(misses, country_code))
+    return {postcode: point for postcode, point in points.items() if point is not None}
+
+
+@lru_cache(maxsize=None)
+def country_code_for(country) -> str:
+    """
+    An ISO 3166 alpha-2 code for a free-text country, assuming the UK
+    when it's blank or unrecognised.
+    """
+    country = (country or "").strip()
+    if len(country) == 0 or country.upper() == "UK":
+        return "GB"
+    if len(country) == 2:
+        return country.upper()
+    try:
+        return pycountry.countries.search_fuzzy(country)[0].alpha_2
+    except LookupError:
+        return "GB"
 
 
 @batch_and_aggregate(25)
@@ -129,7 +426,7 @@ def bulk_coordinate_geo(coordinates):
 
     payload = {"geolocations": coordinates}
 
-    response = requests.post(f"https://api.postcodes.io/postcodes", data=payload)
+    response = postcodes_io.post(f"https://api.postcodes.io/postcodes", data=payload)
     data = response.json()
     status = get(data, "status")
     result = get(data, "result")
@@ -141,7 +438,7 @@ def bulk_coordinate_geo(coordinates):
 
 
 def coordinates_geo(latitude: float, longitude: float):
-    response = requests.get(
+    response = postcodes_io.get(
         f"https://api.postcodes.io/postcodes?lon={longitude}&lat={latitude}"
     )
     data = response.json()
@@ -197,7 +494,7 @@ def geo_by_address(address: str):
         "components": "country:" + os.getenv("CCTLD"),
         "address": address,
     }
-    res = requests.get(
+    res = get_session("google_maps").get(
         f"https://maps.googleapis.com/maps/api/geocode/json?", params=params
     )
     data = res.json()
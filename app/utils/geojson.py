@@ -0,0 +1,145 @@
+import hashlib
+import math
+import uuid
+from dataclasses import dataclass
+
+import orjson
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+
+# Layers also depend on the current time (past events drop off),
+# so don't keep them forever even if nothing is saved
+MAP_LAYER_TTL = 60 * 15
+
+# Web Mercator can't represent the poles
+MAX_LATITUDE = 85.0511
+MAX_ZOOM = 22
+
+
+@dataclass
+class MapLayer:
+    body: bytes
+    etag: str
+
+
+def feature_collection(features):
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            feature
+            for feature in features
+            if feature is not None and feature.get("geometry", None) is not None
+        ],
+    }
+
+
+def with_distance(feature, distance):
+    return {
+        **feature,
+        "properties": {
+            **feature.get("properties", {}),
+            "distance_km": round(distance.km, 2),
+        },
+    }
+
+
+def parse_bbox(value):
+    """
+    Parse a `min_lng,min_lat,max_lng,max_lat` query string value.
+    """
+    min_lng, min_lat, max_lng, max_lat = (float(n) for n in value.split(","))
+    if min_lng > max_lng or min_lat > max_lat:
+        raise ValueError(f"Invalid bbox: {value}")
+    return (
+        max(min_lng, -180),
+        max(min_lat, -MAX_LATITUDE),
+        min(max_lng, 180),
+        min(max_lat, MAX_LATITUDE),
+    )
+
+
+def lng_to_tile(lng, zoom):
+    return math.floor((lng + 180) / 360 * 2**zoom)
+
+
+def lat_to_tile(lat, zoom):
+    lat = math.radians(lat)
+    return math.floor(
+        (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * 2**zoom
+    )
+
+
+def tile_to_lng(x, zoom):
+    return x / 2**zoom * 360 - 180
+
+
+def tile_to_lat(y, zoom):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2**zoom))))
+
+
+def snap_bbox_to_tiles(bbox, zoom):
+    """
+    Grow a bbox out to the edges of the map tiles it touches at this zoom level,
+    so that small pans of the map share a cache entry.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    tiles = 2**zoom
+    min_x = lng_to_tile(min_lng, zoom)
+    max_x = min(lng_to_tile(max_lng, zoom) + 1, tiles)
+    # Tile rows count down from the north
+    min_y = lat_to_tile(max_lat, zoom)
+    max_y = min(lat_to_tile(min_lat, zoom) + 1, tiles)
+    return (
+        tile_to_lng(min_x, zoom),
+        tile_to_lat(max_y, zoom),
+        tile_to_lng(max_x, zoom),
+        tile_to_lat(min_y, zoom),
+    )
+
+
+def bbox_to_polygon(bbox):
+    polygon = Polygon.from_bbox(bbox)
+    polygon.srid = 4326
+    return polygon
+
+
+def map_layer_version(layer_id):
+    version_key = f"map_layer_version.{layer_id}"
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(version_key, version, None)
+    return version
+
+
+def map_layer_cache_key(layer_id, bbox=None):
+    key = f"map_layer.{layer_id}.{map_layer_version(layer_id)}"
+    if bbox is not None:
+        key += ".bbox-" + ",".join(f"{n:.6f}" for n in bbox)
+    return key
+
+
+def get_map_layer(layer_id, build_geojson, bbox=None) -> MapLayer:
+    """
+    The serialised GeoJSON for a map layer, optionally limited to a bbox,
+    built by `build_geojson` at most once until the layer is invalidated or expires.
+    """
+    key = map_layer_cache_key(layer_id, bbox)
+    layer = cache.get(key)
+    if layer is None:
+        if bbox is None:
+            body = orjson.dumps(build_geojson())
+        else:
+            body = orjson.dumps(build_geojson(bbox=bbox_to_polygon(bbox)))
+        layer = MapLayer(body=body, etag=f'"{hashlib.md5(body).hexdigest()}"')
+        cache.set(key, layer, MAP_LAYER_TTL)
+    return layer
+
+
+def invalidate_map_layers(*layer_ids):
+    # Every cached viewport of a layer shares its version,
+    # so changing the version orphans them all at once
+    cache.set_many(
+        {f"map_layer_version.{layer_id}": uuid.uuid4().hex for layer_id in layer_ids},
+        None,
+    )
@@ -0,0 +1,146 @@
+from typing import Optional
+
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+# Connections kept alive per host
+DEFAULT_POOL_SIZE = 10
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+@dataclass
+class IntegrationMetrics:
+    requests: int = 0
+    errors: int = 0
+    total_seconds: float = 0
+    max_seconds: float = 0
+    last_error: Optional[str] = None
+
+    @property
+    def mean_ms(self):
+        return self.total_seconds / self.requests * 1000 if self.requests else 0
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def record_request(integration, seconds, error=None):
+    with _metrics_lock:
+        metrics = _metrics.setdefault(integration, IntegrationMetrics())
+        metrics.requests += 1
+        metrics.total_seconds += seconds
+        metrics.max_seconds = max(metrics.max_seconds, seconds)
+        if error is not None:
+            metrics.errors += 1
+            metrics.last_error = error
+
+
+def http_metrics():
+    """
+    Outbound request counts, errors and latency for this process, by integration.
+    """
+    with _metrics_lock:
+        return {
+            integration: {**asdict(metrics), "mean_ms": metrics.mean_ms}
+            for integration, metrics in _metrics.items()
+        }
+
+
+def reset_http_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def format_http_metrics():
+    return "\n".join(
+        f"{integration}: {metrics['requests']} requests, "
+        f"{metrics['errors']} errors, "
+        f"mean {metrics['mean_ms']:.0f}ms, "
+        f"max {metrics['max_seconds'] * 1000:.0f}ms"
+        for integration, metrics in sorted(http_metrics().items())
+    )
+
+
+class PooledSession(requests.Session):
+    """
+    A keep-alive session for one integration: connections are pooled per host,
+    every request gets a timeout, idempotent requests are retried with backoff
+    on connection errors and 429/5xx responses, and latency is recorded.
+
+    Sessions are shared between threads, so get one with `get_session`
+    rather than constructing your own.
+    """
+
+    def __init__(
+        self,
+        integration,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR,
+        pool_size=DEFAULT_POOL_SIZE,
+    ):
+        super().__init__()
+        self.integration = integration
+        self.timeout = timeout
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                respect_retry_after_header=True,
+                # Hand the last response back rather than raising,
+                # so callers see the status code as they would without retries
+                raise_on_status=False,
+            ),
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get("timeout", None) is None:
+            kwargs["timeout"] = self.timeout
+
+        started_at = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException as e:
+            record_request(
+                self.integration, time.monotonic() - started_at, e.__class__.__name__
+            )
+            raise
+
+        record_request(
+            self.integration,
+            time.monotonic() - started_at,
+            f"HTTP {response.status_code}" if response.status_code >= 400 else None,
+        )
+        return response
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(integration, **options) -> PooledSession:
+    """
+    The shared session for an integration, e.g. `get_session("mapbox")`.
+
+    `options` are passed to PooledSession the first time the session is made.
+    """
+    with _sessions_lock:
+        session = _sessions.get(integration, None)
+        if session is None:
+            session = _sessions[integration] = PooledSession(integration, **options)
+        return session
@@ -1,10 +1,12 @@
 import hashlib
+import json
 
 import mailchimp_marketing as MailchimpMarketing
 from django.conf import settings
 from mailchimp_marketing.api_client import ApiClientError as MailchimpApiClientError
 
-from app.models import User
+from app.models import OutboxEvent, User
+from app.utils.http import get_session
 
 mailchimp = MailchimpMarketing.Client()
 MAILCHIMP_IS_ACTIVE = (
@@ -21,6 +23,30 @@ if MAILCHIMP_IS_ACTIVE:
     )
 
 
+def pooled_request(method, url, query_params=None, headers=None, body=None):
+    """
+    Stands in for the SDK's ApiClient.request, which calls `requests.get` etc.
+    directly and so opens a new connection for every call.
+    """
+    client = mailchimp.api_client
+    auth = ("user", client.api_key) if client.is_basic_auth else None
+    if client.is_oauth:
+        headers.update({"Authorization": "Bearer " + client.access_token})
+
+    return get_session("mailchimp").request(
+        method,
+        url,
+        params=query_params,
+        data=json.dumps(body) if method in ("POST", "PUT", "PATCH") else None,
+        headers=headers,
+        auth=auth,
+        timeout=client.timeout,
+    )
+
+
+mailchimp.api_client.request = pooled_request
+
+
 def email_to_hash(email):
     return hashlib.md5(email.encode("utf-8").lower()).hexdigest()
 
@@ -83,24 +109,30 @@ def mailchimp_contact_for_user(user: User, list_id=settings.MAILCHIMP_LIST_ID):
 
 
 def tag_user_in_mailchimp(user: User, tags_to_enable=list(), tags_to_disable=list()):
+    """
+    Queue a tag update for the outbox worker (`process_outbox`) to send.
+    """
+    if not MAILCHIMP_IS_ACTIVE:
+        print("tag_user_in_mailchimp", tags_to_enable, tags_to_disable)
+        return
+    OutboxEvent.enqueue(
+        OutboxEvent.MAILCHIMP_TAGS,
+        user,
+        tags_to_enable=list(tags_to_enable),
+        tags_to_disable=list(tags_to_disable),
+    )
+
+
+def send_mailchimp_tags(user: User, tags_to_enable=list(), tags_to_disable=list()):
     tags = [{"name": tag, "status": "active"} for tag in tags_to_enable] + [
         {"name": tag, "status": "inactive"} for tag in tags_to_disable
     ]
-    if not MAILCHIMP_IS_ACTIVE:
-        print("tag_user_in_mailchimp", tags)
-        return
-    contact = mailchimp_contact_for_user(user)
-    if contact is None:
-        return
-    try:
-        response = mailchimp.lists.update_list_member_tags(
-            settings.MAILCHIMP_LIST_ID,
-            email_to_hash(user.primary_email),
-            {"tags": tags},
-        )
-        print(f"client.lists.update_list_member_tags() response: {response}")
-    except MailchimpApiClientError as error:
-        print(f"A Mailchimp API exception occurred: {error.text}")
+    response = mailchimp.lists.update_list_member_tags(
+        settings.MAILCHIMP_LIST_ID,
+        email_to_hash(user.primary_email),
+        {"tags": tags},
+    )
+    print(f"client.lists.update_list_member_tags() response: {response}")
 
 
 def format_event_name(event: str):
@@ -112,18 +144,21 @@ def format_event_name(event: str):
 
 
 def track_event_for_user_in_mailchimp(user: User, event: str, properties=dict()):
+    """
+    Queue an event for the outbox worker (`process_outbox`) to send.
+    """
     if not MAILCHIMP_IS_ACTIVE:
         print("track_event_for_user_in_mailchimp", event, properties)
         return
-    contact = mailchimp_contact_for_user(user)
-    if contact is None:
-        return
-    try:
-        response = mailchimp.lists.create_list_member_event(
-            settings.MAILCHIMP_LIST_ID,
-            email_to_hash(user.primary_email),
-            {"name": format_event_name(event), "properties": properties},
-        )
-        print(f"mailchimp.lists.create_list_member_event() response: {response}")
-    except MailchimpApiClientError as error:
-        print(f"A Mailchimp API exception occurred: {error.text}")
+    OutboxEvent.enqueue(
+        OutboxEvent.MAILCHIMP_EVENT, user, event=event, properties=properties
+    )
+
+
+def send_mailchimp_event(user: User, event: str, properties=dict()):
+    response = mailchimp.lists.create_list_member_event(
+        settings.MAILCHIMP_LIST_ID,
+        email_to_hash(user.primary_email),
+        {"name": format_event_name(event), "properties": properties},
+    )
+    print(f"mailchimp.lists.create_list_member_event() response: {response}")
@@ -0,0 +1,133 @@
+import hashlib
+import uuid
+from dataclasses import dataclass
+
+import orjson
+from django.core.cache import cache
+
+PRICE_MATRIX_VERSION_KEY = "price_matrix.version"
+PRICE_MATRIX_TTL = 60 * 60 * 24
+
+
+@dataclass
+class PriceMatrix:
+    data: dict
+    body: bytes
+    etag: str
+
+    def entry(self, price_id, zone_code):
+        price = self.data["prices"].get(str(price_id), None)
+        if price is None:
+            return None
+        return price["zones"].get(zone_code, None)
+
+
+def price_matrix_version():
+    version = cache.get(PRICE_MATRIX_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(PRICE_MATRIX_VERSION_KEY, version, None)
+    return version
+
+
+def prices_version():
+    """
+    Changes whenever a price or a shipping zone does, for keying
+    anything derived from both.
+    """
+    from app.models.stripe import shipping_zone_table
+
+    return f"{price_matrix_version()}.{shipping_zone_table().version}"
+
+
+def invalidate_price_matrix():
+    cache.set(PRICE_MATRIX_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def zone_prices(price, zone):
+    shipping_fee = price.shipping_fee(zone)
+    monthly_shipping_fee = price.equivalent_monthly_shipping_fee(zone)
+    total = price.price + shipping_fee
+    return {
+        "free_shipping": price.ships_free_to(zone),
+        "shipping_fee": str(shipping_fee.amount),
+        "shipping_fee_string": str(shipping_fee),
+        "shipping_price_string": price.shipping_price_string(zone),
+        "equivalent_monthly_shipping_fee": str(round(monthly_shipping_fee.amount, 2)),
+        "equivalent_monthly_shipping_fee_string": str(monthly_shipping_fee),
+        "price_including_shipping": str(total.amount),
+        "price_including_shipping_string": str(total),
+        "price_string_including_shipping": price.price_string_including_shipping(zone),
+        "equivalent_monthly_price_string_including_shipping": price.equivalent_monthly_price_string_including_shipping(
+            zone
+        ),
+    }
+
+
+def build_price_matrix():
+    """
+    Every live plan price in every shipping zone, with the totals and strings
+    the signup pages show, and the country-to-zone lookup to go with them.
+    """
+    from app.models.stripe import shipping_zone_table
+    from app.models.wagtail import MembershipPlanPrice
+
+    table = shipping_zone_table()
+    zones = {**table.zones_by_code, table.default_zone.code: table.default_zone}
+    prices = (
+        MembershipPlanPrice.objects.filter(plan__live=True)
+        .select_related("plan")
+        .prefetch_related("free_shipping_zones")
+    )
+
+    return {
+        "default_zone": table.default_zone.code,
+        "countries": {
+            country: zone.code for country, zone in table.zones_by_country.items()
+        },
+        "zones": {
+            code: {
+                "code": code,
+                "nickname": zone.nickname,
+                "rate": str(zone.rate.amount),
+                "rate_string": str(zone.rate),
+                "currency": str(zone.rate.currency),
+            }
+            for code, zone in zones.items()
+        },
+        "prices": {
+            str(price.id): {
+                "id": price.id,
+                "plan": price.plan_id,
+                "title": price.title,
+                "interval": price.interval,
+                "interval_count": price.interval_count,
+                "humanised_interval": price.humanised_interval(),
+                "price": str(price.price.amount),
+                "currency": str(price.price.currency),
+                "price_string": price.price_string,
+                "equivalent_monthly_price_string": price.equivalent_monthly_price_string,
+                "zones": {
+                    code: zone_prices(price, zone) for code, zone in zones.items()
+                },
+            }
+            for price in prices
+        },
+    }
+
+
+def get_price_matrix() -> PriceMatrix:
+    """
+    The price matrix, built at most once until prices or zones change.
+    """
+    # Keyed on the zone table too, so saving a zone rebuilds the matrix
+    key = f"price_matrix.{prices_version()}"
+    matrix = cache.get(key)
+    if matrix is None:
+        data = build_price_matrix()
+        body = orjson.dumps(data)
+        matrix = PriceMatrix(
+            data=data, body=body, etag=f'"{hashlib.md5(body).hexdigest()}"'
+        )
+        cache.set(key, matrix, PRICE_MATRIX_TTL)
+    return matrix
@@ -1,4 +1,5 @@
 from datetime import datetime
+from itertools import islice
 
 
 def is_sequence(arg):
@@ -61,6 +62,18 @@ def chunk_array(arr, max_size):
         yield arr[i : i + max_size]
 
 
+def chunk_iterable(iterable, max_size):
+    """
+    Like chunk_array, but for iterators that can't be sliced or measured.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, max_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def batch_and_aggregate(arr_limit):
     def decorator(original_fn):
         def resulting_fn(arr):
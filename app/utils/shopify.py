@@ -1,8 +1,18 @@
+from types import SimpleNamespace
+
+import time
+
 import orjson
 import pycountry
 import shopify
 from dateutil.parser import parse
 from django.conf import settings
+from pyactiveresource.connection import ClientError
+from pyactiveresource.connection import Error as ActiveResourceError
+from requests import RequestException
+from shopify.base import ShopifyConnection
+
+from app.utils.http import get_session
 
 
 def create_session(
@@ -37,6 +47,215 @@ def parse_metafield(f):
         return f.value
 
 
+class PooledResponse:
+    """
+    The parts of urllib's HTTPResponse that pyactiveresource reads.
+    """
+
+    def __init__(self, response):
+        self.url = response.url
+        self.code = response.status_code
+        self.msg = response.reason
+        self.headers = response.headers
+        self.content = response.content
+
+    def read(self):
+        return self.content
+
+    def close(self):
+        pass
+
+
+class PooledShopifyConnection(ShopifyConnection):
+    """
+    pyactiveresource opens a new urllib connection for every REST call;
+    send them over the shared keep-alive session instead.
+    """
+
+    def _urlopen(self, request):
+        try:
+            response = get_session("shopify").request(
+                request.get_method(),
+                request.get_full_url(),
+                headers=dict(request.header_items()),
+                data=request.data,
+                timeout=self.timeout,
+            )
+        except RequestException as e:
+            raise ActiveResourceError(e, request.get_full_url())
+        return PooledResponse(response)
+
+
+def use_pooled_shopify_connection():
+    # ShopifyResource builds its per-thread connection from this module attribute
+    shopify.base.ShopifyConnection = PooledShopifyConnection
+
+
+def execute_graphql(query, variables=None):
+    """
+    Like `shopify.GraphQL().execute`, but over the shared session and parsed.
+    """
+    response = get_session("shopify").post(
+        shopify.ShopifyResource.get_site() + "/graphql.json",
+        json={"query": query, "variables": variables},
+        headers={
+            "Accept": "application/json",
+            **shopify.ShopifyResource.get_headers(),
+        },
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+class ShopifyRateLimiter:
+    """
+    Client-side token bucket mirroring Shopify's leaky bucket rate limit.
+
+    REST calls cost one token and the bucket is re-synced from the
+    `X-Shopify-Shop-Api-Call-Limit` header after every call; GraphQL calls
+    are synced from the `throttleStatus` Shopify returns with each query.
+    """
+
+    def __init__(self, capacity=40, leak_rate=2):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.used = 0
+        self.updated_at = time.monotonic()
+
+    def leak(self):
+        now = time.monotonic()
+        self.used = max(0, self.used - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def wait(self, cost=1):
+        self.leak()
+        overflow = self.used + cost - self.capacity
+        if overflow > 0:
+            time.sleep(overflow / self.leak_rate)
+            self.leak()
+        self.used += cost
+
+    def update_from_headers(self, headers):
+        call_limit = (headers or {}).get("X-Shopify-Shop-Api-Call-Limit", None)
+        if call_limit is None:
+            return
+        used, capacity = (int(n) for n in call_limit.split("/"))
+        self.used, self.capacity = used, capacity
+        self.updated_at = time.monotonic()
+
+    def update_from_throttle_status(self, throttle_status):
+        self.capacity = throttle_status["maximumAvailable"]
+        self.leak_rate = throttle_status["restoreRate"]
+        self.used = self.capacity - throttle_status["currentlyAvailable"]
+        self.updated_at = time.monotonic()
+
+    def call(self, fn, *args, cost=1, retries=5, **kwargs):
+        """
+        Run a Shopify REST call once the bucket has room,
+        backing off and retrying if Shopify still says we're throttled.
+        """
+        for attempt in range(retries + 1):
+            self.wait(cost)
+            try:
+                result = fn(*args, **kwargs)
+                self.update_from_headers(last_response_headers())
+                return result
+            except ClientError as e:
+                if e.response.code != 429 or attempt == retries:
+                    raise
+                retry_after = e.response.headers.get("Retry-After", None)
+                # The bucket is full, so wait for it to drain before retrying
+                self.used = self.capacity
+                time.sleep(float(retry_after) if retry_after else 1)
+
+
+def last_response_headers():
+    response = getattr(shopify.ShopifyResource.connection, "response", None)
+    return getattr(response, "headers", None)
+
+
+def iterate_collection_products(collection_id, limiter=None, page_size=250, **filters):
+    """
+    Yield every product in a collection, a page at a time.
+    """
+    limiter = limiter or ShopifyRateLimiter()
+    page = limiter.call(
+        shopify.Product.find, collection_id=collection_id, limit=page_size, **filters
+    )
+    while True:
+        yield list(page)
+        if not page.has_next_page():
+            break
+        page = limiter.call(page.next_page)
+
+
+PRODUCT_METAFIELDS_QUERY = """
+query ProductMetafields($ids: [ID!]!, $first: Int!) {
+  nodes(ids: $ids) {
+    ... on Product {
+      id
+      metafields(first: $first) {
+        edges { node { key value type } }
+        pageInfo { hasNextPage }
+      }
+    }
+  }
+}
+"""
+
+
+# Products with more metafields than this are fetched over REST instead
+PRODUCT_METAFIELDS_PER_PAGE = 50
+
+
+def bulk_product_metafields(
+    product_ids, batch_size=15, per_product=PRODUCT_METAFIELDS_PER_PAGE
+):
+    """
+    Fetch metafields for many products with one GraphQL query per batch,
+    rather than one REST call per product.
+
+    Returns a dict of product ID to the same dict `metafields_to_dict` builds.
+    Products missing from the response, or with more metafields than one page
+    holds, are left out so callers can fall back.
+    """
+    # Keeps each query under Shopify's maximum query cost of 1000
+    limiter = ShopifyRateLimiter(capacity=1000, leak_rate=50)
+    product_ids = list(product_ids)
+    metafields = {}
+
+    for i in range(0, len(product_ids), batch_size):
+        batch = product_ids[i : i + batch_size]
+        # Shopify's upper estimate of the query's cost
+        limiter.wait(cost=len(batch) * (per_product + 2))
+        response = execute_graphql(
+            PRODUCT_METAFIELDS_QUERY,
+            variables={
+                "ids": [f"gid://shopify/Product/{id}" for id in batch],
+                "first": per_product,
+            },
+        )
+
+        throttle_status = (
+            response.get("extensions", {}).get("cost", {}).get("throttleStatus")
+        )
+        if throttle_status is not None:
+            limiter.update_from_throttle_status(throttle_status)
+
+        for node in (response.get("data") or {}).get("nodes") or []:
+            if node is None or "metafields" not in node:
+                continue
+            if node["metafields"].get("pageInfo", {}).get("hasNextPage", False):
+                # Rather than sync a page with some of its fields blanked
+                continue
+            product_id = int(node["id"].rsplit("/", 1)[-1])
+            metafields[product_id] = metafields_to_dict(
+                SimpleNamespace(**edge["node"]) for edge in node["metafields"]["edges"]
+            )
+
+    return metafields
+
+
 def convert_stripe_address_to_shopify(user):
     shipping = user.stripe_customer.shipping
     address = {
@@ -73,58 +292,101 @@ def to_shopify_address(user):
     return None
 
 
+def shopify_order_enabled():
+    return not settings.SHOPIFY_DOMAIN or settings.SHOPIFY_PRIVATE_APP_PASSWORD
+
+
+def build_shopify_order(user, line_items=list(), email=False, tags=list()):
+    """
+    An unsaved Shopify order. Needs an active Shopify session to save.
+    """
+    o = shopify.Order()
+    o.line_items = line_items
+    # [
+    #     {
+    #         # "variant_id": variant_id,
+    #         "title": "New Signup",
+    #         "price": 0,
+    #         "requiresShipping": True,
+    #         "quantity": quantity,
+    #     }
+    # ]
+    o.financial_status = "paid"
+
+    # Shopify customer link
+    # if user.shopify_customer_id is None:
+    #     cs = shopify.Customer.search(email=o.email)
+    #     if len(cs) > 0:
+    #         user.shopify_customer_id = cs[0].id
+    #         user.save()
+    #     else:
+    #         c = shopify.Customer()
+    #         c.first_name = "andres"
+    #         c.last_name = "cepeda"
+    #         if to_shopify_address(user) is not None:
+    #             c.addresses = [to_shopify_address(user)]
+    #             c.default_address = to_shopify_address(user)
+    #         c.save()
+    #         user.shopify_customer_id = c.id
+    #         user.save()
+    # if user.shopify_customer_id is None:
+    #     raise ValueError("Couldn't create shipping order, because customer couldn't be identified")
+
+    # o.customer = { "id": user.shopify_customer_id }
+    if not email:
+        o.send_receipt = False
+        o.send_fulfillment_receipt = False
+        o.note = (
+            f"Email: {user.primary_email}. Stripe customer: {user.stripe_customer.id}."
+        )
+    else:
+        o.email = user.primary_email
+
+    o.shipping_address = to_shopify_address(user)
+    o.tags = list(tags)
+
+    if not settings.STRIPE_LIVE_MODE:
+        o.tags += ["TEST"]
+
+    return o
+
+
 def create_shopify_order(user, line_items=list(), email=False, tags=list()):
-    if not settings.SHOPIFY_DOMAIN or settings.SHOPIFY_PRIVATE_APP_PASSWORD:
+    """
+    Create a Shopify order straight away, in its own session.
+    Prefer `queue_shopify_order` anywhere that might create many.
+    """
+    if shopify_order_enabled():
         with shopify.Session.temp(
             settings.SHOPIFY_DOMAIN, "2021-10", settings.SHOPIFY_PRIVATE_APP_PASSWORD
         ):
-            o = shopify.Order()
-            o.line_items = line_items
-            # [
-            #     {
-            #         # "variant_id": variant_id,
-            #         "title": "New Signup",
-            #         "price": 0,
-            #         "requiresShipping": True,
-            #         "quantity": quantity,
-            #     }
-            # ]
-            o.financial_status = "paid"
-
-            # Shopify customer link
-            # if user.shopify_customer_id is None:
-            #     cs = shopify.Customer.search(email=o.email)
-            #     if len(cs) > 0:
-            #         user.shopify_customer_id = cs[0].id
-            #         user.save()
-            #     else:
-            #         c = shopify.Customer()
-            #         c.first_name = "andres"
-            #         c.last_name = "cepeda"
-            #         if to_shopify_address(user) is not None:
-            #             c.addresses = [to_shopify_address(user)]
-            #             c.default_address = to_shopify_address(user)
-            #         c.save()
-            #         user.shopify_customer_id = c.id
-            #         user.save()
-            # if user.shopify_customer_id is None:
-            #     raise ValueError("Couldn't create shipping order, because customer couldn't be identified")
-
-            # o.customer = { "id": user.shopify_customer_id }
-            if not email:
-                o.send_receipt = False
-                o.send_fulfillment_receipt = False
-                o.note = f"Email: {user.primary_email}. Stripe customer: {user.stripe_customer.id}."
-            else:
-                o.email = user.primary_email
-
-            o.shipping_address = to_shopify_address(user)
-            o.tags = tags
-
-            if not settings.STRIPE_LIVE_MODE:
-                tags += ["TEST"]
-
+            o = build_shopify_order(user, line_items, email=email, tags=tags)
             o.save()
 
             if not settings.STRIPE_LIVE_MODE:
                 o.cancel()
+
+            return o
+
+
+def queue_shopify_order(
+    user, line_items=list(), email=False, tags=list(), reference=None
+):
+    """
+    Queue a Shopify order for the `submit_shopify_orders` worker.
+
+    Orders with a `reference` (say, the Stripe subscription they're for)
+    are only queued once, however many times this is called.
+    """
+    from app.models import ShopifyOrder
+
+    fields = {
+        "user": user,
+        "line_items": list(line_items),
+        "tags": list(tags),
+        "send_receipt": bool(email),
+    }
+    if reference is None:
+        return ShopifyOrder.objects.create(**fields)
+    order, _ = ShopifyOrder.objects.get_or_create(reference=reference, defaults=fields)
+    return order
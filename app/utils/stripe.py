@@ -1,7 +1,13 @@
 from typing import TYPE_CHECKING, Tuple, Union
 
+import threading
+import time
+
 import djstripe.models
 import stripe
+from django.core.cache import cache
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import F, Q
 from django.utils.text import format_lazy
 from djstripe.utils import get_friendly_currency_amount
 
@@ -14,45 +20,198 @@ from app.utils import include_keys
 SHIPPING_PRODUCT_NAME = "Shipping"
 DONATION_PRODUCT_NAME = "Donation"
 
+# Long enough to cover repeated checks while rendering one page
+PROMOTION_CODE_MISS_TTL = 60
+
+# How long after a webhook (or a refresh) synced a customer
+# that their local data is trusted without refetching it
+STRIPE_CUSTOMER_SYNC_FRESHNESS = 10
+
+# Stripe allows 25 requests per second in test mode and 100 in live mode
+STRIPE_REQUESTS_PER_SECOND = 20
+
+_request_stripe_objects = threading.local()
+
+
+class StripeRateLimiter:
+    """
+    Spaces out Stripe API calls made from several threads so that,
+    together, they stay under `rate` requests per second.
+    """
+
+    def __init__(self, rate=STRIPE_REQUESTS_PER_SECOND):
+        self.interval = 1 / rate
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedStripeRateLimiter:
+    """
+    Like StripeRateLimiter, but counted in the shared cache, so that
+    several worker processes together stay under `rate` requests per second.
+
+    The count is only atomic when the shared cache is Redis. Otherwise each
+    of the `processes` sharing the limit is held to its share of `rate`.
+    """
+
+    def __init__(self, rate=STRIPE_REQUESTS_PER_SECOND, name="stripe", processes=1):
+        self.rate = rate
+        self.name = name
+        self.local = StripeRateLimiter(rate / processes)
+
+    def wait(self):
+        if not isinstance(getattr(cache, "shared", cache), RedisCache):
+            return self.local.wait()
+        while True:
+            now = time.time()
+            window = int(now)
+            key = f"rate_limit.{self.name}.{window}"
+            cache.add(key, 0, 5)
+            try:
+                count = cache.incr(key)
+            except ValueError:
+                # Expired between add and incr
+                continue
+            if count <= self.rate:
+                return
+            time.sleep(window + 1 - now)
+
+
+def start_stripe_request_cache():
+    _request_stripe_objects.objects = {}
+
+
+def stop_stripe_request_cache():
+    _request_stripe_objects.objects = None
+
+
+def retrieve_stripe_object(resource, id, expand=None, refresh=False):
+    """
+    `resource.retrieve(id)`, but fetched at most once per request
+    (between `start_stripe_request_cache` and `stop_stripe_request_cache`).
+
+    Pass `refresh=True` after changing the object, to refetch it.
+    """
+    kwargs = {"expand": expand} if expand else {}
+    objects = getattr(_request_stripe_objects, "objects", None)
+    if objects is None:
+        return resource.retrieve(id, **kwargs)
+
+    key = (resource.OBJECT_NAME, id, tuple(expand or ()))
+    if refresh or key not in objects:
+        objects[key] = resource.retrieve(id, **kwargs)
+    return objects[key]
+
+
+def forget_stripe_object(resource, id):
+    objects = getattr(_request_stripe_objects, "objects", None)
+    if objects:
+        for key in [key for key in objects if key[:2] == (resource.OBJECT_NAME, id)]:
+            del objects[key]
+
+
+def stripe_customer_sync_key(customer_id):
+    return f"stripe_customer_synced.{customer_id}"
+
+
+def mark_stripe_customer_synced(customer_id):
+    if customer_id:
+        cache.set(
+            stripe_customer_sync_key(customer_id), True, STRIPE_CUSTOMER_SYNC_FRESHNESS
+        )
+
+
+def stripe_customer_recently_synced(customer_id):
+    return cache.get(stripe_customer_sync_key(customer_id), False)
+
+
+def promotion_code_miss_key(code_or_id):
+    return f"promotion_code_miss.{code_or_id.upper()}"
+
+
+def get_promotion_code(code_or_id: str):
+    """
+    A promotion code by its customer-facing code or ID, from the local
+    StripePromotionCode index, falling back to Stripe (and indexing what
+    it finds) on a miss.
+    """
+    from app.models.stripe import StripePromotionCode
+
+    if not code_or_id:
+        return None
+
+    promo_code = (
+        StripePromotionCode.objects.filter(
+            Q(code__iexact=code_or_id) | Q(id=code_or_id)
+        )
+        # Stripe lists the newest first
+        .order_by("-active", F("created").desc(nulls_last=True))
+        .first()
+    )
+    if promo_code is not None or cache.get(promotion_code_miss_key(code_or_id)):
+        return promo_code
+
+    possible_codes = stripe.PromotionCode.list(code=code_or_id).data
+    if len(possible_codes) > 0:
+        return StripePromotionCode.sync_from_stripe_data(possible_codes[0])
+    if code_or_id.startswith("promo_"):
+        try:
+            return StripePromotionCode.sync_from_stripe_data(
+                stripe.PromotionCode.retrieve(code_or_id)
+            )
+        except stripe.error.InvalidRequestError:
+            pass
+
+    # Don't ask Stripe about the same made-up code over and over
+    cache.set(promotion_code_miss_key(code_or_id), True, PROMOTION_CODE_MISS_TTL)
+    return None
+
 
 def is_real_gift_code(code):
-    possible_codes = stripe.PromotionCode.list(code=code)
+    promo_code = get_promotion_code(code)
     return (
-        len(possible_codes) > 0
-        and possible_codes[0].max_redemptions is not None
-        and possible_codes[0].metadata.get("gift_giver_subscription", False)
+        promo_code is not None
+        and promo_code.max_redemptions is not None
+        and promo_code.metadata.get("gift_giver_subscription", False)
     )
 
 
 def is_redeemable_gift_code(code):
-    possible_codes = stripe.PromotionCode.list(code=code).data
+    promo_code = get_promotion_code(code)
     return (
-        len(possible_codes) > 0
-        and possible_codes[0].active
-        and possible_codes[0].max_redemptions is not None
-        and possible_codes[0].max_redemptions > possible_codes[0].times_redeemed
-        and possible_codes[0].metadata.get("gift_giver_subscription", False)
+        promo_code is not None
+        and promo_code.active
+        and promo_code.max_redemptions is not None
+        and promo_code.max_redemptions > promo_code.times_redeemed
+        and promo_code.metadata.get("gift_giver_subscription", False)
     )
 
 
 def gift_giver_subscription_from_code(
     code: str,
 ) -> Union[djstripe.models.Subscription, None]:
-    promo_code = None
-
-    possible_codes = stripe.PromotionCode.list(code=code).data
-    if len(possible_codes) > 0:
-        promo_code = possible_codes[0]
-    else:
-        # In case you actually passed the promo code ID
-        promo_code = stripe.PromotionCode.retrieve(code)
+    promo_code = get_promotion_code(code)
 
     if promo_code:
         subscription_id = promo_code.metadata.get("gift_giver_subscription", None)
 
         if subscription_id:
+            # dj-stripe keeps subscriptions in sync via webhooks
+            subscription = djstripe.models.Subscription.objects.filter(
+                id=subscription_id
+            ).first()
+            if subscription is not None:
+                return subscription
             return djstripe.models.Subscription.sync_from_stripe_data(
-                stripe.Subscription.retrieve(subscription_id)
+                retrieve_stripe_object(stripe.Subscription, subscription_id)
             )
     return None
 
@@ -65,9 +224,9 @@ def gift_recipient_subscription_from_code(
     if code_or_id.startswith("promo_"):
         promo_code_id = code_or_id
     else:
-        possible_codes = stripe.PromotionCode.list(code=code_or_id).data
-        if len(possible_codes) > 0:
-            promo_code_id = possible_codes[0].id
+        promo_code = get_promotion_code(code_or_id)
+        if promo_code is not None:
+            promo_code_id = promo_code.id
 
     if promo_code_id:
         return djstripe.models.Subscription.objects.filter(
@@ -75,12 +234,22 @@ def gift_recipient_subscription_from_code(
         ).first()
 
 
+def sync_promotion_code(promo_code):
+    """
+    Update the local index after creating or changing a promotion code.
+    """
+    from app.models.stripe import StripePromotionCode
+
+    cache.delete(promotion_code_miss_key(promo_code["code"]))
+    return StripePromotionCode.sync_from_stripe_data(promo_code)
+
+
 def subscription_with_promocode(
     sub: Union[stripe.Subscription, djstripe.models.Subscription]
 ):
     promo_code_id = sub.metadata.get("promo_code", None)
     if promo_code_id is not None:
-        promocode = stripe.PromotionCode.retrieve(promo_code_id)
+        promocode = retrieve_stripe_object(stripe.PromotionCode, promo_code_id)
         setattr(sub, "promo_code", promocode)
     return sub
 
@@ -286,11 +455,13 @@ def configure_gift_giver_subscription_and_code(
         },
         **promo_code_extras,
     )
+    sync_promotion_code(promo_code)
 
     gift_giver_subscription = stripe.Subscription.modify(
         gift_giver_subscription_id,
         metadata={"promo_code": promo_code.id, **metadata},
     )
+    forget_stripe_object(stripe.Subscription, gift_giver_subscription_id)
 
     gift_giver_subscription = djstripe.models.Subscription.sync_from_stripe_data(
         gift_giver_subscription
@@ -306,9 +477,12 @@ def create_gift_recipient_subscription(
 
     if user.stripe_customer is None:
         djstripe.models.Customer.create(user)
+        user.clear_membership_cache()
 
     # Update stripe data so we're working with the latest statuses
-    fresh_sub = stripe.Subscription.retrieve(gift_giver_subscription.id)
+    fresh_sub = retrieve_stripe_object(
+        stripe.Subscription, gift_giver_subscription.id, refresh=True
+    )
     gift_giver_subscription = djstripe.models.Subscription.sync_from_stripe_data(
         fresh_sub
     )
@@ -354,9 +528,7 @@ def create_gift_recipient_subscription(
     ####
 
     product_id = product_price["price_data"]["product"]
-    promo_code = stripe.PromotionCode.retrieve(
-        promo_code_id
-    )
+    promo_code = retrieve_stripe_object(stripe.PromotionCode, promo_code_id)
 
     applies_to_product = promo_code.coupon.metadata.get("gift_product_id") == product_id
 
@@ -370,6 +542,8 @@ def create_gift_recipient_subscription(
             coupon = get_gift_card_coupon(product_id)
             # invalidate the gift card's promo code so it can't be used again
             promo_code = stripe.PromotionCode.modify(promo_code_id, active=False)
+            forget_stripe_object(stripe.PromotionCode, promo_code_id)
+            sync_promotion_code(promo_code)
 
             discount_args = {"coupon": coupon.id}
     else:
@@ -390,11 +564,16 @@ def create_gift_recipient_subscription(
 
     subscription = stripe.Subscription.create(**args)
 
+    if "promotion_code" in discount_args:
+        # Record the redemption locally, so the code stops validating
+        sync_promotion_code(stripe.PromotionCode.retrieve(promo_code_id))
+
     # For easy forward access
     stripe.Subscription.modify(
         gift_giver_subscription.id,
         metadata={"gift_recipient_subscription": subscription.id},
     )
+    forget_stripe_object(stripe.Subscription, gift_giver_subscription.id)
 
     subscription = djstripe.models.Subscription.sync_from_stripe_data(subscription)
     user.refresh_stripe_data()
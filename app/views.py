@@ -19,12 +19,20 @@ from dateutil.relativedelta import relativedelta
 from django import forms
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
 from django.core.mail import send_mail
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+from django.http import (
+    HttpRequest,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotModified,
+    HttpResponseRedirect,
+)
 from django.http.response import Http404, HttpResponse
 from django.shortcuts import redirect
 from django.template.loader import render_to_string
 from django.urls import include, path, re_path, reverse, reverse_lazy
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.views.decorators.csrf import csrf_exempt
@@ -34,7 +42,15 @@ from djmoney.money import Money
 from djstripe import settings as djstripe_settings
 from sentry_sdk import capture_exception, capture_message
 from wagtail.models import Page
-from app.utils.geo import address_geo, postcode_geo
+from app.utils.geo import geocode_postcode, normalise_postcode
+from app.utils.geojson import (
+    MAP_LAYER_TTL,
+    MAX_ZOOM,
+    get_map_layer,
+    map_layer_version,
+    parse_bbox,
+    snap_bbox_to_tiles,
+)
 from django.http import JsonResponse
 
 from app import analytics
@@ -52,13 +68,21 @@ from app.models import LBCProduct, User
 from app.models.stripe import LBCSubscription, ShippingZone
 from app.models.wagtail import BaseShopifyProductPage, MembershipPlanPrice
 from app.utils.mailchimp import tag_user_in_mailchimp
-from app.utils.shopify import create_shopify_order
+from app.utils.price_matrix import (
+    PRICE_MATRIX_TTL,
+    get_price_matrix,
+    prices_version,
+    zone_prices,
+)
+from app.utils.shopify import queue_shopify_order
 from app.utils.stripe import (
     configure_gift_giver_subscription_and_code,
     create_donation_line_item,
     create_gift_recipient_subscription,
+    forget_stripe_object,
     gift_giver_subscription_from_code,
-    get_primary_product_for_djstripe_subscription
+    get_primary_product_for_djstripe_subscription,
+    retrieve_stripe_object,
 )
 
 
@@ -165,9 +189,12 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
         subscription = None
 
         if session_id is not None:
-            session = stripe.checkout.Session.retrieve(session_id)
+            session = retrieve_stripe_object(stripe.checkout.Session, session_id)
             gift_mode = session.metadata.get("gift_mode", None) is not None
-            customer_from_stripe = stripe.Customer.retrieve(session.customer)
+            # Usually already fetched by update_stripe_customer_subscription
+            customer_from_stripe = retrieve_stripe_object(
+                stripe.Customer, session.customer
+            )
             (
                 customer,
                 is_new,
@@ -176,15 +203,17 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
             )
 
             if session.payment_intent is not None:
-                payment_intent = stripe.PaymentIntent.retrieve(session.payment_intent)
+                payment_intent = retrieve_stripe_object(
+                    stripe.PaymentIntent, session.payment_intent
+                )
                 # Context for fbq tracking
                 context["payment_intent"] = payment_intent
                 context["value"] = payment_intent.amount / 100
                 context["currency"] = payment_intent.currency
 
             elif session.subscription is not None:
-                subscription = stripe.Subscription.retrieve(
-                    session.subscription, expand=["latest_invoice"]
+                subscription = retrieve_stripe_object(
+                    stripe.Subscription, session.subscription, expand=["latest_invoice"]
                 )
 
                 # Context for fbq tracking
@@ -207,7 +236,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
                             prod_id = session.metadata.get("primary_product")
                             prod = djstripe.models.Product.objects.get(id=prod_id)
 
-                            create_shopify_order(
+                            queue_shopify_order(
                                 self.request.user,
                                 line_items=[
                                     {
@@ -217,6 +246,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
                                     }
                                 ],
                                 tags=["Gift Card Purchase"],
+                                reference=subscription.id,
                             )
 
                         else:
@@ -231,7 +261,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
                             prod_id = session.metadata.get("primary_product", None)
                             prod = djstripe.models.Product.objects.get(id=prod_id)
 
-                            create_shopify_order(
+                            queue_shopify_order(
                                 self.request.user,
                                 line_items=[
                                     {
@@ -241,6 +271,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
                                     }
                                 ],
                                 tags=["Membership Subscription Purchase"],
+                                reference=subscription.id,
                             )
 
                         analytics.signup(self.request.user)
@@ -248,6 +279,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
                         stripe.Subscription.modify(
                             subscription.id, metadata={"processed": True}
                         )
+                        forget_stripe_object(stripe.Subscription, subscription.id)
 
                     except Exception as e:
                         from sentry_sdk import capture_exception, capture_message
@@ -279,7 +311,7 @@ class StripeCheckoutSuccessView(LoginRequiredMixin, TemplateView):
 
         if promo_code_id is not None:
             # Refreshed the page -- don't let them generate a new coupon each time they do that!
-            promo_code = stripe.PromotionCode.retrieve(promo_code_id)
+            promo_code = retrieve_stripe_object(stripe.PromotionCode, promo_code_id)
             page_context["promo_code"] = promo_code.code
         else:
             (
@@ -326,11 +358,14 @@ class CompletedGiftPurchaseView(MemberSignupUserRegistrationMixin, TemplateView)
     def get_context_data(self, *args, **kwargs):
         page_context = super().get_context_data(**kwargs)
         session_id = self.request.GET.get("session_id")
-        page_context["session"] = stripe.checkout.Session.retrieve(session_id)
-        page_context["gift_giver_subscription"] = stripe.Subscription.retrieve(
-            page_context["session"].subscription
+        page_context["session"] = retrieve_stripe_object(
+            stripe.checkout.Session, session_id
+        )
+        page_context["gift_giver_subscription"] = retrieve_stripe_object(
+            stripe.Subscription, page_context["session"].subscription
         )
-        page_context["promo_code"] = stripe.PromotionCode.retrieve(
+        page_context["promo_code"] = retrieve_stripe_object(
+            stripe.PromotionCode,
             page_context["gift_giver_subscription"]
             .get("metadata", {})
             .get("promo_code")
@@ -457,7 +492,7 @@ class GiftMembershipSetupView(MemberSignupUserRegistrationMixin, FormView):
             tags_to_enable=["MEMBER", "GIFT_RECIPIENT"],
             tags_to_disable=["CANCELLED"],
         )
-        create_shopify_order(
+        queue_shopify_order(
             self.request.user,
             line_items=[
                 {
@@ -473,7 +508,9 @@ class GiftMembershipSetupView(MemberSignupUserRegistrationMixin, FormView):
 
     def finish_gift_redemption(self, gift_giver_subscription_id) -> djstripe.models.Subscription:
         try:
-            stripe_sub = stripe.Subscription.retrieve(gift_giver_subscription_id)
+            stripe_sub = retrieve_stripe_object(
+                stripe.Subscription, gift_giver_subscription_id
+            )
             gift_giver_subscription = (
                 djstripe.models.Subscription.sync_from_stripe_data(stripe_sub)
             )
@@ -565,6 +602,8 @@ class ShippingForProductView(TemplateView):
                     initial={"country": country_id}
                 ),
                 "url_pattern": ShippingCostView.url_pattern,
+                "default_zone": ShippingZone.get_for_country(country_id),
+                "price_version": prices_version(),
                 "current_book": product.current_book,
             }
         )
@@ -573,33 +612,92 @@ class ShippingForProductView(TemplateView):
 
 
 class ShippingCostView(TemplateView):
+    """
+    The price breakdown for a plan price shipped to a zone.
+
+    Nothing in it depends on the visitor, so it's cached by (price, product,
+    zone) and the version of prices and zones. Pages map countries to zones
+    themselves, and pass `?v=` with the version so browsers can keep it.
+    """
+
     template_name = "app/frames/shipping_cost.html"
-    url_pattern = "shippingcosts/<price_id>/<product_id>/<country_id>/"
+    url_pattern = "shippingcosts/<price_id>/<product_id>/zone/<zone_code>/"
+    max_age = 60 * 60 * 24
 
-    def get_context_data(self, price_id, product_id, country_id="GB", **kwargs):
-        """
-        Display shipping fee based on selected country
-        """
-        from app.models.wagtail import MembershipPlanPage, MembershipPlanPrice
+    def get(self, request, price_id, product_id, zone_code, *args, **kwargs):
+        try:
+            price_id = int(price_id)
+        except ValueError:
+            raise Http404
+        # Unknown zones are shown the rest of the world's, so share its entry
+        zone_code = ShippingZone.get_for_code(zone_code).code
+        version = prices_version()
+        key = ".".join(["shipping_cost", str(price_id), product_id, zone_code, version])
+        body = cache.get(key)
+        if body is None:
+            # Unknown prices and products 404 here, so are never cached
+            response = super().get(
+                request,
+                *args,
+                price_id=price_id,
+                product_id=product_id,
+                zone_code=zone_code,
+                **kwargs,
+            )
+            body = response.render().content
+            cache.set(key, body, PRICE_MATRIX_TTL)
 
-        from .models import LBCProduct, ShippingZone
+        response = HttpResponse(body)
+        if request.GET.get("v", None) == version:
+            patch_cache_control(response, public=True, max_age=self.max_age)
+        else:
+            patch_cache_control(response, public=True, max_age=60)
+        return response
 
+    def get_context_data(self, price_id, product_id, zone_code, **kwargs):
+        """
+        Display shipping fee based on selected zone
+        """
         context = super().get_context_data(**kwargs)
-        price = MembershipPlanPrice.objects.get(id=price_id)
-        product = LBCProduct.objects.get(id=product_id)
-        zone = ShippingZone.get_for_country(country_id)
-        context = {
+        try:
+            price = MembershipPlanPrice.objects.select_related("plan").get(id=price_id)
+            LBCProduct.objects.only("id").get(id=product_id)
+        except (MembershipPlanPrice.DoesNotExist, LBCProduct.DoesNotExist):
+            raise Http404
+        zone = ShippingZone.get_for_code(zone_code)
+        prices = get_price_matrix().entry(price.id, zone.code) or zone_prices(
+            price, zone
+        )
+        return {
             **context,
             "zone": zone,
             "price": price,
-            "product": product,
             "shipping_zone": zone,
-            "shipping_price": price.shipping_fee(zone),
-            "final_price": price.price_including_shipping(zone),
-            "url_pattern": self.url_pattern,
+            "shipping_price": Money(prices["shipping_fee"], zone.rate_currency),
+            "final_price": Money(
+                prices["price_including_shipping"], price.price_currency
+            ),
         }
 
-        return context
+
+class ShippingCostForCountryView(RedirectView):
+    """
+    The old per-country URL, sent on to its zone's.
+    """
+
+    permanent = False
+    url_pattern = "shippingcosts/<price_id>/<product_id>/<country_id>/"
+
+    def get_redirect_url(self, price_id, product_id, country_id, *args, **kwargs):
+        zone = ShippingZone.get_for_country(country_id)
+        return reverse(
+            "shippingcosts",
+            kwargs={
+                "price_id": price_id,
+                "product_id": product_id,
+                "zone_code": zone.code,
+            },
+        ) + f"?v={prices_version()}"
 
 
 class SubscriptionCheckoutView(TemplateView):
@@ -843,7 +941,14 @@ class DonationView(UpgradeSuccessDonationTrailerView):
             return initial
 
 
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+
+from .batch_updates import batch_progress
 from .forms import BatchUpdateSubscriptionsForm
+from .models import SubscriptionUpdateBatch
+
+JOBS_PER_PAGE = 50
 
 
 class BatchUpdateSubscriptionsView(SuperUserCheck, LoginRequiredMixin, FormView):
@@ -867,25 +972,97 @@ class BatchUpdateSubscriptionsStatusView(
 
     def get_context_data(self, batch_id=None, **kwargs):
         context = super().get_context_data(**kwargs)
+        try:
+            batch = SubscriptionUpdateBatch.objects.filter(id=batch_id).first()
+        except ValidationError:
+            batch = None
+        if batch is None:
+            raise Http404("Batch not found")
+
         retry_job_id = self.request.GET.get("retry_job_id", None)
         if retry_job_id is not None:
             self.retry_job(retry_job_id)
+            batch.refresh_from_db()
+
         context["batch_id"] = batch_id
-        context["jobs"] = Job.objects.filter(workspace__batch_id=batch_id).order_by(
-            "-created"
+        context["batch"] = batch
+        context["progress"] = batch_progress(batch)
+
+        jobs = Job.objects.filter(workspace__batch_id=batch_id).order_by("-created")
+        state = self.request.GET.get("state", None)
+        if state in Job.STATES.values:
+            jobs = jobs.filter(state=state)
+        context["state"] = state
+        context["states"] = Job.STATES.values
+        context["jobs"] = Paginator(jobs, JOBS_PER_PAGE).get_page(
+            self.request.GET.get("page", None)
         )
         return context
 
     def retry_job(self, retry_job_id):
-        job = Job.objects.filter(id=retry_job_id, workspace__retry_job_id=None).first()
+        # Only a failed job can be retried, and only once
+        job = Job.objects.filter(
+            id=retry_job_id,
+            state=Job.STATES.FAILED,
+            workspace__retry_job_id__isnull=True,
+        ).first()
         if job is None:
             return
         new_job = Job.objects.create(
             name=job.name,
+            queue_name=job.queue_name,
             workspace={**job.workspace, "original_job_id": str(retry_job_id)},
         )
         job.workspace["retry_job_id"] = str(new_job.id)
         job.save()
+        SubscriptionUpdateBatch.record_retry(
+            job.workspace.get("batch_id", None), job.workspace.get("error", None)
+        )
+
+
+from django.http import FileResponse
+
+from .exports import MEMBER_EXPORT_JOB, member_export_storage
+
+
+class MemberExportMixin:
+    def get_export_job(self, job_id):
+        job = Job.objects.filter(id=job_id, name=MEMBER_EXPORT_JOB).first()
+        if job is None:
+            raise Http404("Export not found")
+        return job
+
+
+class MemberExportView(
+    MemberExportMixin, SuperUserCheck, LoginRequiredMixin, TemplateView
+):
+    template_name = "app/member_export.html"
+
+    def get_context_data(self, job_id=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        job = self.get_export_job(job_id)
+        context["job"] = job
+        context["rows"] = len(job.workspace.get("subscription_ids", []))
+        context["ready"] = (
+            job.state == Job.STATES.COMPLETE and "path" in job.workspace
+        )
+        return context
+
+
+class MemberExportDownloadView(
+    MemberExportMixin, SuperUserCheck, LoginRequiredMixin, View
+):
+    def get(self, request, job_id=None):
+        job = self.get_export_job(job_id)
+        path = job.workspace.get("path", None)
+        if job.state != Job.STATES.COMPLETE or path is None:
+            raise Http404("Export not ready")
+        return FileResponse(
+            member_export_storage().open(path, "rb"),
+            as_attachment=True,
+            filename=f"{job.workspace.get('filename', 'export')}.csv",
+            content_type="text/csv",
+        )
 
 
 """
@@ -1166,18 +1343,27 @@ class SelectBillingPlanView(OneAtATimeFormViewStoredToSession):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["payment_options"] = [
-            {
-                "price": price,
-                "shipping_price": price.shipping_fee(self.zone),
-                "price_with_shipping": price.price_string_including_shipping(self.zone),
-                "equivalent_monthly_price_including_shipping": price.equivalent_monthly_price_string_including_shipping(
-                    self.zone
-                ),
-                "equivalent_monthly_shipping_price": self.zone.rate,
-            }
-            for price in self.membership_plan.prices.all()
-        ]
+        matrix = get_price_matrix()
+        payment_options = []
+        for price in self.membership_plan.prices.all():
+            prices = matrix.entry(price.id, self.zone.code)
+            if prices is None:
+                # Not in the matrix, e.g. the plan is being previewed
+                prices = zone_prices(price, self.zone)
+            payment_options.append(
+                {
+                    "price": price,
+                    "shipping_price": Money(
+                        prices["shipping_fee"], self.zone.rate_currency
+                    ),
+                    "price_with_shipping": prices["price_string_including_shipping"],
+                    "equivalent_monthly_price_including_shipping": prices[
+                        "equivalent_monthly_price_string_including_shipping"
+                    ],
+                    "equivalent_monthly_shipping_price": self.zone.rate,
+                }
+            )
+        context["payment_options"] = payment_options
         context["steps"] = [
             {
                 "title": "Reading speed",
@@ -1360,18 +1546,101 @@ class V2SubscriptionCheckoutView(TemplateView):
 
 
 def postcode_lookup_view(request, postcode, country_code):
-    data = None
-    if country_code == "GB":
-        data = postcode_geo(postcode)
-    if data:
+    point = geocode_postcode(postcode, country_code)
+    if point:
         return JsonResponse({
-            "latitude": data["latitude"],
-            "longitude": data["longitude"]
+            "latitude": point.y,
+            "longitude": point.x
         })
-    data = address_geo(postcode, country=country_code)
-    if data:
-        return JsonResponse({
-            "latitude": data.y,
-            "longitude": data.x
-        })
-    return JsonResponse({}, status=404)
\ No newline at end of file
+    return JsonResponse({}, status=404)
+
+
+def nearby_view(request, postcode, country_code):
+    """
+    The reading groups and events nearest to a postcode, with distances.
+    """
+    from app.models.wagtail import MapPage, ReadingGroupsPage
+
+    try:
+        limit = min(max(int(request.GET.get("limit", 5)), 1), 50)
+    except ValueError:
+        return HttpResponseBadRequest("limit should be a number")
+
+    # Keyed on the layer versions, so edits to groups or events invalidate it
+    cache_key = ".".join(
+        [
+            "nearby",
+            country_code,
+            normalise_postcode(postcode),
+            str(limit),
+            map_layer_version("reading_groups"),
+            map_layer_version("events"),
+        ]
+    )
+    data = cache.get(cache_key)
+    if data is None:
+        point = geocode_postcode(postcode, country_code)
+        if point is None:
+            return JsonResponse({}, status=404)
+        data = {
+            "latitude": point.y,
+            "longitude": point.x,
+            "reading_groups": ReadingGroupsPage.get_nearest_features(point, limit),
+            "events": MapPage.get_nearest_features(point, limit),
+        }
+        cache.set(cache_key, data, MAP_LAYER_TTL)
+
+    return JsonResponse(data)
+
+
+class PriceMatrixView(View):
+    """
+    Every plan price in every shipping zone, with the country-to-zone lookup,
+    so signup pages can switch countries without asking the server.
+    """
+
+    def get(self, request, *args, **kwargs):
+        matrix = get_price_matrix()
+        if request.headers.get("If-None-Match") == matrix.etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(matrix.body, content_type="application/json")
+        response["ETag"] = matrix.etag
+        patch_cache_control(response, public=True, max_age=300)
+        return response
+
+
+class MapLayerView(View):
+    """
+    Cached GeoJSON for a map source, so map pages can ship a URL
+    rather than inlining every feature.
+
+    Pass `?bbox=min_lng,min_lat,max_lng,max_lat` to only get features in the
+    viewport, and `&zoom=` to snap that bbox to the map tiles at that zoom level
+    so that nearby viewports share a cache entry.
+    """
+
+    def get(self, request, layer_id, *args, **kwargs):
+        from app.models.wagtail import MAP_LAYERS
+
+        if layer_id not in MAP_LAYERS:
+            raise Http404
+
+        bbox = None
+        try:
+            if request.GET.get("bbox"):
+                bbox = parse_bbox(request.GET["bbox"])
+                if request.GET.get("zoom"):
+                    zoom = min(max(int(float(request.GET["zoom"])), 0), MAX_ZOOM)
+                    bbox = snap_bbox_to_tiles(bbox, zoom)
+        except ValueError:
+            return HttpResponseBadRequest("bbox should be min_lng,min_lat,max_lng,max_lat")
+
+        layer = get_map_layer(layer_id, MAP_LAYERS[layer_id], bbox=bbox)
+        if request.headers.get("If-None-Match") == layer.etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(layer.body, content_type="application/geo+json")
+        response["ETag"] = layer.etag
+        patch_cache_control(response, public=True, max_age=60)
+        return response
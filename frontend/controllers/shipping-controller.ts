@@ -1,5 +1,10 @@
 import { Controller } from "@hotwired/stimulus";
 
+interface PriceMatrix {
+  default_zone: string;
+  countries: Record<string, string>;
+}
+
 class ShippingController extends Controller {
   static targets = ["form", "frame"];
 
@@ -8,13 +13,26 @@ class ShippingController extends Controller {
   readonly priceValue!: string;
   readonly productValue!: string;
   readonly urlValue!: string;
+  readonly matrixUrlValue!: string;
 
   static values = {
     url: String,
+    matrixUrl: String,
     product: String,
     price: String,
   };
 
+  // Country code to shipping zone code, from the price matrix
+  private matrix: Promise<PriceMatrix | null> | null = null;
+
+  connect() {
+    if (this.matrixUrlValue) {
+      this.matrix = fetch(this.matrixUrlValue)
+        .then((response) => (response.ok ? response.json() : null))
+        .catch(() => null);
+    }
+  }
+
   formTargetConnected() {
     const dropdown = this.formTarget.querySelector("select");
     if (!dropdown) return;
@@ -24,13 +42,24 @@ class ShippingController extends Controller {
     );
   }
 
-  updateFrame(country_code: string) {
+  async updateFrame(country_code: string) {
+    const matrix = this.matrix ? await this.matrix : null;
+    // Costs are the same for every country in a zone, so ask by zone
+    // and let the browser cache each zone's frame
+    const path = matrix
+      ? this.urlValue.replace(
+          "<zone_code>",
+          matrix.countries[country_code] || matrix.default_zone
+        )
+      : this.urlValue
+          .replace("zone/<zone_code>", country_code)
+          .replace(/\?.*$/, "");
+
     const newFrameURL = new URL(
       "/" +
-        this.urlValue
+        path
           .replace("<price_id>", this.priceValue)
-          .replace("<product_id>", this.productValue)
-          .replace("<country_id>", country_code),
+          .replace("<product_id>", this.productValue),
       window.location.toString()
     );
     this.frameTarget.src = newFrameURL;
@@ -0,0 +1,52 @@
+import type { GeoJSONSource, Map } from "mapbox-gl";
+import { MapConfigController } from "@commonknowledgecoop/groundwork-django";
+
+/**
+ * Once zoomed in, swap URL-backed GeoJSON sources for just the features
+ * in the current viewport, reloading as the map moves.
+ */
+export default class ViewportSourceController extends MapConfigController {
+  static values = {
+    sourceIds: Array,
+    minZoom: { type: Number, default: 8 },
+  };
+
+  private sourceIdsValue!: string[];
+  private minZoomValue!: number;
+  private layerUrls: Record<string, string> = {};
+
+  connectMap(map: Map) {
+    map.on("moveend", () => this.loadViewport(map));
+  }
+
+  loadViewport(map: Map) {
+    const zoom = Math.floor(map.getZoom());
+    const bounds = map.getBounds();
+    const bbox = [
+      bounds.getWest(),
+      bounds.getSouth(),
+      bounds.getEast(),
+      bounds.getNorth(),
+    ].join(",");
+
+    for (const id of this.sourceIdsValue) {
+      const source = map.getSource(id) as GeoJSONSource | undefined;
+      if (!source) continue;
+
+      // @ts-ignore
+      const data = source._data;
+      if (!this.layerUrls[id]) {
+        if (typeof data !== "string") continue;
+        this.layerUrls[id] = data.split("?")[0];
+      }
+
+      const url =
+        zoom < this.minZoomValue
+          ? this.layerUrls[id]
+          : `${this.layerUrls[id]}?bbox=${bbox}&zoom=${zoom}`;
+      if (url !== data) {
+        source.setData(url);
+      }
+    }
+  }
+}
@@ -23,20 +23,25 @@ export default class ZoomController extends MapConfigController {
     }, this.delayValue);
   }
 
-  zoomToSourceFeatures(
+  async zoomToSourceFeatures(
     { params: { sourceIds } } = { params: { sourceIds: this.sourceIdsValue } }
   ) {
-    const features = this.getSourceFeatures(sourceIds);
+    const features = await this.getSourceFeatures(sourceIds);
     this.zoomToFeatures(features);
   }
 
-  getSourceFeatures(sourceIds = this.sourceIdsValue) {
+  async getSourceFeatures(sourceIds = this.sourceIdsValue) {
     let features: mapboxgl.MapboxGeoJSONFeature[] = [];
     for (const id of sourceIds) {
       const source = this.map?.getSource?.(id);
       if (source) {
         // @ts-ignore
-        features = features.concat(source._data.features || []);
+        let data = source._data;
+        if (typeof data === "string") {
+          // Sources loaded by URL; the browser will have this cached
+          data = await fetch(data).then((response) => response.json());
+        }
+        features = features.concat(data?.features || []);
       }
     }
     return features;